@@ -13,16 +13,49 @@ dimensions of the aal template.  If the input image goes outside of the aal
 template, this area will not be included.
 
 Usage: python AIMTemp.py -o /fullpath/here --input=myimage.nii.gz --name=outname
+       python AIMTemp.py -o /fullpath/here --list=images.txt
+       python AIMTemp.py --refresh
  
 Main Options:
   -h, --help             show this help  
   -i, --input            input nifti file
   -o, --out              output folder (created if doesn't exist)
   -n, --name             output name
+  -l, --list             text file with one image per line, as /path/image.nii.gz,outname (outname defaults to
+                         the image name).  The atlas and AAL dictionary are loaded once for all images
 
 Optional:
+  --atlas                label atlas in MNI space (default MR/aal2mni152.nii.gz, next to this script)
+                         an index of the atlas is saved next to it on first use (see MRtools.Atlas)
   --rdf                  full path to rdf file to map AALID to FMAID
   --url                  url to map this path
+  --fmacache             json file with the AAL to FMA mapping parsed from the rdf or url
+                         (default MR/aal2fma.json, next to this script).  If it was made from the same rdf or url,
+                         it is used instead of fetching and parsing the rdf, otherwise it is rewritten
+  --offline              never fetch the url.  With --rdf, the --fmacache file is used only if it was made from
+                         that rdf, otherwise the rdf is parsed.  Without --rdf, the --fmacache file is used
+                         whatever it was made from, or MR/aal2fma.rdf is parsed if there is no cache
+                         (exits if there is neither)
+  --refresh              fetch and parse the rdf or url again and rewrite the --fmacache file.  Can be run
+                         without an input to only refresh the cache: python AIMTemp.py --refresh
+  --bundle               write all AIM files for the image into one container, AIM-<name>.zip or AIM-<name>.tar.gz
+                         (--bundle=zip or --bundle=tgz), instead of one file per voxel in the output folder
+  --workers              serialize AIM files across a pool of this many processes (--workers=8)
+                         with --list, each worker processes whole images
+  --shard                when writing single files, put them in numbered subfolders of AIM-<name>/ with at
+                         most this many files each (--shard=1000)
+  --regions              one AIM file per atlas label with activation instead of one per voxel, at the peak
+                         (largest absolute value) voxel, AIM-<name>-region_<aalID>.xml.  Also writes
+                         AIM-<name>-regions.csv with voxel count, mean, absolute mean, peak and peak MNI coordinate
+
+The AAL to FMA mapping is NOT shipped with the package: MR/aal2fma.json and MR/aal2fma.rdf don't exist
+in a fresh checkout, so --offline exits until one of them is made.  Run once with network access
+(python AIMTemp.py --refresh) or with a local copy of the rdf (python AIMTemp.py --refresh --rdf=aal2fma.rdf)
+to save MR/aal2fma.json, or copy the rdf to MR/aal2fma.rdf.
+
+AIM files can be read back from a folder (sharded or not), zip or tar.gz with readBundle:
+  for name,xml in AIMTemp.readBundle('/fullpath/here/AIM-outname.zip'): ...
+  for name,xml in AIMTemp.readBundle('/fullpath/here','outname'): ...     (single files in a shared output folder)
 
 Currently only supports 3D image templates and inputs (if 4D input, first TR used)
 
@@ -43,56 +76,65 @@ import getopt
 import scitools.numpytools as scinu
 import MRtools
 import datetime
+import numpy as np
+import zipfile
+import tarfile
+import time
+import multiprocessing
+import hashlib
+import re
+import json
+import csv
+from StringIO import StringIO
+
+# Default label atlas, found relative to this script rather than the working directory
+ATLAS = os.path.join(os.path.dirname(os.path.abspath(__file__)),'MR','aal2mni152.nii.gz')
+# Default cache of the AAL to FMA mapping (fmaGraph.fmaSave), also found relative to this script
+FMACACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'MR','aal2fma.json')
+# Local copy of the AAL to FMA rdf (not shipped, see usage), parsed with --offline when there is no --fmacache file
+FMARDF = os.path.join(os.path.dirname(os.path.abspath(__file__)),'MR','aal2fma.rdf')
+# Predicates (after the #) read from each rdf entry for the AAL to FMA mapping
+FMAFIELDS = ("AALID","FMAID","aalName","fmaName")
 
 #----AIM-TEMPLATE-------------------------------------------------------------------------------
 class AIMTemplate:
-    def __init__(self,infile):
+    def __init__(self,infile,Atlas=None):
         self.infile = infile                                          
-        self.FMRI = MRtools.Data(infile,'3D')                 # Read the input file into a MRTools Data object, for easy query 
-        self.AAL = MRtools.Data('MR/aal2mni152.nii.gz','3D')  # Read the MNI152 template with labels into MRTrans object
-                                                # single analyze volume in MNI152 space with integers 1-116 for anat labels
-                                                # In future this can come from online location, now is hard coded file
+        self.FMRI = MRtools.Data(infile,'3D',xyz=False)       # Read the input file into a MRTools Data object, for easy query 
+        if not Atlas:                                         # Index of the MNI152 template with labels (MRtools Atlas object)
+            Atlas = MRtools.Atlas(ATLAS)                      # single analyze volume in MNI152 space with integers 1-116 for anat labels
+        self.AAL = Atlas                                      # can be shared between images, and is only built once per atlas file
         self.aalID = self.getAALs()             # An array of all IDs found in the AAL input image
-        self.xyzlabels = self.voxelsByLabel()   # Return an array of lists of xyzlabels, one for each label found in the atlas
+        self.xyzlabels = self.voxelsByLabel()   # Return a record array of (x,y,z,label,value), one for each labeled voxel with activation
         self.aimTree = None
         
     # Read aal image to get array of aalIDs
     def getAALs(self):
         '''returns a list of unique values in the atlas image - NOT including 0'''
-        print "Atlas image has unique values: " + str(sorted(self.AAL.getUniqueIDs()))
-        return self.AAL.getUniqueIDs()        
+        print "Atlas image has unique values: " + str(self.AAL.getLabels())
+        return self.AAL.getLabels()
 
-    # Return a list of inputs to configure aimInstance based on anatomical entity (i.e., aalID)
+    # Return a record array of inputs to configure aimInstance based on anatomical entity (i.e., aalID)
     def voxelsByLabel(self):
         '''atlas is a NiBabel 3D array in MNI space. aalID is an integer 1-116 corresponding to a brain structure'''
         print "Labeling voxels in fmri image..."
-        xyzlabels = [] # list that stores 5 items... (x,y,z coordinates, aalID, and zScore)
-        
-        # Go through the entire dimensions of the aal template, and query the data for a value  
-        for x in range(self.AAL.xdim):
-            for y in range(self.AAL.ydim):
-                for z in range(self.AAL.zdim):
-                    aalID = self.AAL.getValRCP([x,y,z])                 # Get the aalID value from the RCP coordinate
-
-                    if aalID in self.aalID:    # Ensures we don't look at values of zero:
-                        try:                                                # Add fMRI coordinate value only if it exists
-                            MNIX,MNIY,MNIZ = self.AAL.rcptoMNI([x,y,z])     # Get the MNI coordinate for this point
-                            fmriVal = self.FMRI.getValMNI([MNIX,MNIY,MNIZ]) # Get the value for this MNI coordinate from input data
-                            if abs(fmriVal) > float(0.000000000001):
-                                # print "MNI Coordinates " + str(MNIX) + ", " + str(MNIY) + ", " + str(MNIZ) + " have value " + str(fmriVal)
-                                xyzlabels.append((MNIX, MNIY, MNIZ, aalID, fmriVal))                                  
-                        except:
-                            # print "fmri data is undefined at " + str(MNIX) + ", " + str(MNIY) + ", " + str(MNIZ) + " and will not be added"
-                            continue
+        # Look up the fMRI value at the MNI coordinate of every labeled voxel of the aal template,
+        # voxels outside of the input image have no value
+        MNI = self.AAL.coordsMNI
+        fmriVals = self.AAL.sample(self.FMRI)
+
+        # Keep only voxels with activation
+        active = np.abs(fmriVals) > float(0.000000000001)
+        xyzlabels = np.rec.fromarrays([MNI[0,active],MNI[1,active],MNI[2,active],self.AAL.voxlabels[active],fmriVals[active]],names='x,y,z,aalID,value')
         print "Found " + str(len(xyzlabels)) + " coordinates in image input with activation." 
         return xyzlabels
 
     # Iterate through voxelsByLabel using the lookup indices as input to configure AIM instance
-    def aimGen(self,aalDict,aimFile,outname):
+    def aimGen(self,aalDict,aimFile,outname,bundle=None,shard=0,workers=1):
         print "Configuring AIM Instance..."
+        Bundle = aimBundle(aimFile,outname,bundle,shard)   # where the AIM files go: folder, sharded folder, zip or tar.gz
         undefinedAAL = []                    # keep a list of aalIDs undefined and defined in rdf...
         definedAAL = []
-        recordcount = 0                      # Keep a count of the number of voxels in the image to label each one
         recordsize = len(self.xyzlabels)
 
         # Grab date and time of file creation, for AIM
@@ -100,13 +142,52 @@ class AIMTemplate:
         timey = datetime.datetime.fromtimestamp(timey)
         self.time = timey.strftime("%Y-%m-%dT%H:%M:%S")
 
-        while self.xyzlabels:
+        # Records are numbered from the end of xyzlabels, and serialized in chunks of consecutive record numbers
+        chunk = min(AIMCHUNK,max(1,recordsize / (workers * 4)))
+        bounds = [(start,min(start + chunk,recordsize)) for start in range(0,recordsize,chunk)]
+        if workers > 1:
+            print "Serializing " + str(recordsize) + " records with " + str(workers) + " workers..."
+            chunks = aimPool(self,aalDict,bounds,workers)
+        else:
+            chunks = aimSerial(self,aalDict,bounds)
+
+        # Chunks come back in record order, so output naming does not depend on the number of workers
+        for aimfiles, defined, undefined in chunks:
+            for recordcount, aimxml in aimfiles:
+                Bundle.add("AIM-" + str(outname) + "_" + str(recordcount) + ".xml", aimxml)  # write out the aim files
+            for aalID in defined:
+                if aalID not in definedAAL: definedAAL.append(aalID)
+            for aalID in undefined:
+                if aalID not in undefinedAAL: undefinedAAL.append(aalID)
 
-            # Each entry in xyzlabels looks like: ([MNIX, MNIY, MNIZ, aalID, fmriVal])
-            # AIM_ROOT = etree.ElementTree('AIM-ROOT') # create a root AIM element for ImageAnnotations returned by aimInstance
-            recordcount = recordcount + 1
+        #self.aimTree = etree.ElementTree(AIM_ROOT) # create an element tree from AIM_ROOT returned from aimInstance
+        Bundle.close()
+        print "AIM Instance configuration complete."
+        print "AIM files written to " + Bundle.path
+        
+        # Report to the user the aalIDs that were defined, and not defined
+        if definedAAL:
+            print "AALIDs with activation, in atlas, found in AAL dictionary:"
+            print definedAAL    
+
+        if undefinedAAL:
+            print "AALIDs with activation, in atlas image, but not in the dictionary, NOT added to AIM:"
+            print undefinedAAL    
+
+    # Serialize records start to end (counted from the end of xyzlabels), returns ([(recordcount,xml)],definedAAL,undefinedAAL)
+    def aimRecords(self,aalDict,start,end):
+        undefinedAAL = []
+        definedAAL = []
+        aimfiles = []
+        recordsize = len(self.xyzlabels)
+
+        # The AIM tree is the same for every voxel except for a few attributes, so it is built once
+        Writer = aimWriter(self.aimInstance(0, 0, 0, '', '', 0, ''))
+
+        for recordcount in range(start + 1,end + 1):
+            # Each entry in xyzlabels looks like: (MNIX, MNIY, MNIZ, aalID, fmriVal)
+            record = self.xyzlabels[recordsize - recordcount]
             recordindex = str(recordcount) + "/" + str(recordsize)
-            record = self.xyzlabels.pop()
             x = record[0]          # MNIX
             y = record[1]          # MNIY
             z = record[2]          # MNIZ
@@ -116,33 +197,82 @@ class AIMTemplate:
             # Each entry in aalDict looks like: aalDict['aalID'] = ('fmaName', 'aalName', 'FMAID'))
             #                                   aalDict['77'] = ('Left thalamus', 'Thalamus_LEFT', '258716')
 
+            # aalIDs that aren't a valid key aren't in the dictionary, and are not added to AIM
+            if str(aalID) not in aalDict:
+                if str(aalID) not in undefinedAAL: undefinedAAL.append(str(aalID))
+                continue
+
+            fmaid = aalDict[str(aalID)][2] # mapping between aalID and fmaid
+            fmaLabel = aalDict[str(aalID)][0]
+            Writer.fill(x, y, z, fmaid, fmaLabel, Zscore, recordindex)
+            aimfiles.append((recordcount, Writer.tostring()))
+            if str(aalID) not in definedAAL: definedAAL.append(str(aalID))
+
+        return aimfiles, definedAAL, undefinedAAL
+
+    # Summarize activation for every atlas label at once, returns a record array with one entry per label with activation
+    def regionSummary(self):
+        '''returns record array of (aalID,voxels,meanval,absmean,peak,x,y,z), peak is the value with the largest absolute value'''
+        labels = np.asarray(self.AAL.getLabels())
+        values = self.xyzlabels.value.astype(float)
+        absvalues = np.abs(values)
+        position = np.searchsorted(labels,self.xyzlabels.aalID)    # position of each voxel's label in labels
+
+        voxels = np.bincount(position,minlength=len(labels))
+        sums = np.bincount(position,weights=values,minlength=len(labels))
+        abssums = np.bincount(position,weights=absvalues,minlength=len(labels))
+        peakabs = np.zeros(len(labels))
+        np.maximum.at(peakabs,position,absvalues)
+
+        # First voxel of each label that has the peak absolute value
+        ispeak = np.nonzero(absvalues == peakabs[position])[0]
+        found, first = np.unique(position[ispeak],return_index=True)
+        peakvoxel = np.zeros(len(labels),dtype=int)
+        peakvoxel[found] = ispeak[first]
+
+        active = voxels > 0
+        peakvoxel = peakvoxel[active]
+        return np.rec.fromarrays([labels[active],voxels[active],sums[active] / voxels[active],abssums[active] / voxels[active],
+                                  values[peakvoxel],self.xyzlabels.x[peakvoxel],self.xyzlabels.y[peakvoxel],self.xyzlabels.z[peakvoxel]],
+                                 names='aalID,voxels,meanval,absmean,peak,x,y,z')
+
+    # One AIM annotation per atlas label with activation, at its peak voxel, and a csv summary of all labels
+    def aimRegions(self,aalDict,aimFile,outname,bundle=None,shard=0):
+        print "Configuring region AIM Instances..."
+        Bundle = aimBundle(aimFile,outname + "-regions",bundle,shard)
+        undefinedAAL = []
+        definedAAL = []
 
-            try:
-                # We go to "except" if the aalID isn't a valid key, meaning it's not in the dictionary
-                fmaid = aalDict[str(aalID)][2] # mapping between aalID and fmaid
-                fmaLabel = aalDict[str(aalID)][0]
-                ImageAnnotation = self.aimInstance(x, y, z, fmaid, fmaLabel, Zscore, recordindex)
-                aimTree = etree.ElementTree(ImageAnnotation)
-                aimTree.write(str(aimFile) + "/AIM-" + str(outname) + "_" + str(recordcount) + ".xml")  # write out the aim files
-                
-                # Read in the file to rewrite it with the xml header (not sure how to do with etree)
-                aimFileTop = open(str(aimFile) + "/AIM-" + str(outname) + "_" + str(recordcount) + ".xml",'r')
-                xmllines = aimFileTop.readlines()
-                aimFileTop.close()
-
-                aimFileTop = open(str(aimFile) + "/AIM-" + str(outname) + "_" + str(recordcount) + ".xml",'w')
-                aimFileTop.write('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n')
-                for line in xmllines: aimFileTop.write(line + "\n")
-                aimFileTop.close()
-        
-                if str(aalID) not in definedAAL: definedAAL.append(str(aalID))
-            except:
-                if str(aalID) not in undefinedAAL: undefinedAAL.append(str(aalID)); continue
+        timey = os.path.getmtime(self.infile)
+        timey = datetime.datetime.fromtimestamp(timey)
+        self.time = timey.strftime("%Y-%m-%dT%H:%M:%S")
+        Writer = aimWriter(self.aimInstance(0, 0, 0, '', '', 0, ''))
+
+        regions = self.regionSummary()
+        csvpath = os.path.join(aimFile,"AIM-" + str(outname) + "-regions.csv")
+        csvout = open(csvpath,'wb')
+        summary = csv.writer(csvout)
+        summary.writerow(["aalID","FMAID","fmaName","aalName","voxels","mean","absmean","peak","x","y","z"])
+        regioncount = 0
+        for region in regions:
+            aalID = str(region.aalID)
+            if aalID in aalDict:
+                fmaName, aalName, fmaid = aalDict[aalID]
+                regioncount = regioncount + 1
+                Writer.fill(region.x, region.y, region.z, fmaid, fmaName, region.peak, str(regioncount) + "/" + str(len(regions)), 'Region')
+                Bundle.add("AIM-" + str(outname) + "-region_" + aalID + ".xml", Writer.tostring())
+                definedAAL.append(aalID)
+            else:
+                fmaName, aalName, fmaid = ("","","")
+                undefinedAAL.append(aalID)
+            summary.writerow([aalID,fmaid,unicode(fmaName).encode('utf-8'),unicode(aalName).encode('utf-8'),region.voxels,
+                              repr(region.meanval),repr(region.absmean),repr(region.peak),region.x,region.y,region.z])
+        csvout.close()
+        Bundle.close()
+        print "Region AIM Instance configuration complete."
+        print str(len(regions)) + " labels with activation summarized in " + csvpath
+        print "AIM files written to " + Bundle.path
 
-        #self.aimTree = etree.ElementTree(AIM_ROOT) # create an element tree from AIM_ROOT returned from aimInstance
-        print "AIM Instance configuration complete."
-        
-        # Report to the user the aalIDs that were defined, and not defined
         if definedAAL:
             print "AALIDs with activation, in atlas, found in AAL dictionary:"
             print definedAAL    
@@ -286,26 +416,236 @@ class AIMTemplate:
 
 
 
+#----AIM-WRITER-------------------------------------------------------------------------------
+class aimWriter:
+    '''Fills in the per-voxel attributes of one AIM ImageAnnotation tree, and writes it with the xml declaration in one pass'''
+    def __init__(self,ImageAnnotation):
+        self.ImageAnnotation = ImageAnnotation
+        self.declaration = '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n'
+        # Elements with attributes that change for each voxel
+        self.CalculationData = ImageAnnotation.find('calculationCollection/Calculation/calculationResultCollection/CalculationResult/calculationDataCollection/CalculationData')
+        self.AnatomicEntity = ImageAnnotation.find('anatomicEntityCollection/AnatomicEntity')
+        self.SpatialCoordinate = ImageAnnotation.find('geometricShapeCollection/GeometricShape/spatialCoordinateCollection/SpatialCoordinate')
+        self.time = ImageAnnotation.attrib['dateTime']
+
+    # Same attributes, in the same way, as AIMTemplate.aimInstance
+    def fill(self,x, y, z, fmaid, fmaLabel, zScore, record, shape='Pixel'):
+        self.ImageAnnotation.attrib['name'] = record
+        self.ImageAnnotation.attrib['uniqueIdentifier'] = self.time + "." + str(record)
+        self.CalculationData.attrib['value'] = str(zScore)
+        self.AnatomicEntity.attrib['codeMeaning'] = fmaLabel
+        self.AnatomicEntity.attrib['codeValue'] = fmaid
+        self.AnatomicEntity.attrib['label'] = '%s in %s' % (shape,fmaLabel)
+        self.SpatialCoordinate.attrib['x'] = x.__str__()
+        self.SpatialCoordinate.attrib['y'] = y.__str__()
+        self.SpatialCoordinate.attrib['z'] = z.__str__()
+
+    def tostring(self):
+        return self.declaration + etree.tostring(self.ImageAnnotation) + "\n"
+
+    def write(self,aimpath):
+        aimout = open(aimpath,'w')
+        aimout.write(self.tostring())
+        aimout.close()
+
+
+#----AIM-WORKERS-------------------------------------------------------------------------------
+# The AIMTemplate (with its voxel records) and AAL dictionary are published here once, before the pool
+# is created, so forked workers share them read-only and only receive the bounds of each chunk
+AIMCHUNK = 2000              # most records serialized per chunk
+workerAIM = None
+workerAalDict = None
+
+def aimWorker(bound):
+    return workerAIM.aimRecords(workerAalDict,bound[0],bound[1])
+
+# Serialize chunks in this process, yielding ([(recordcount,xml)],definedAAL,undefinedAAL) in record order
+def aimSerial(AIM,aalDict,bounds):
+    global workerAIM,workerAalDict
+    workerAIM = AIM
+    workerAalDict = aalDict
+    for bound in bounds:
+        yield aimWorker(bound)
+
+# Serialize chunks across a process pool, yielding the same results as aimSerial, in record order
+def aimPool(AIM,aalDict,bounds,workers):
+    global workerAIM,workerAalDict
+    workerAIM = AIM
+    workerAalDict = aalDict
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(aimWorker,bounds):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+#----AIM-BATCH-------------------------------------------------------------------------------
+# The atlas, AAL dictionary and output options are published here once for all images in a --list,
+# before the pool is created, so forked workers don't load the atlas or parse the rdf again
+batchAtlas = None
+batchAalDict = None
+batchOptions = None
+
+def aimImage(entry):
+    '''Generates AIM files for one (image,outname) entry, returns (image,outname,error)'''
+    infile, outname = entry
+    try:
+        if not os.path.exists(infile):
+            raise IOError("Cannot find image " + infile)
+        aimFile, bundle, shard, regions = batchOptions
+        AIM = AIMTemplate(infile,batchAtlas)
+        if regions:
+            AIM.aimRegions(batchAalDict,aimFile,outname,bundle,shard)
+        else:
+            AIM.aimGen(batchAalDict,aimFile,outname,bundle,shard)
+        return infile,outname,None
+    except:
+        return infile,outname,str(sys.exc_info()[1])
+
+# Generate AIM files for all (image,outname) entries, in this process or across a pool, returns failed entries
+def aimBatch(entries,Atlas,aalDict,aimFile,bundle,shard,workers,regions=False):
+    global batchAtlas,batchAalDict,batchOptions
+    batchAtlas = Atlas
+    batchAalDict = aalDict
+    batchOptions = (aimFile,bundle,shard,regions)
+    failed = []
+    if workers > 1:
+        print "Generating AIM files for " + str(len(entries)) + " images with " + str(workers) + " workers..."
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(aimImage,entries)
+    else:
+        pool = None
+        results = (aimImage(entry) for entry in entries)
+    try:
+        for infile, outname, error in results:
+            if error:
+                print "Error generating AIM files for " + infile + ": " + error
+                failed.append((infile,outname,error))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return failed
+
+
+#----AIM-BUNDLE-------------------------------------------------------------------------------
+class aimBundle:
+    '''Output for the AIM files of one image: the output folder, numbered subfolders of it, a zip or a tar.gz'''
+    def __init__(self,aimFile,outname,bundle=None,shard=0):
+        self.bundle = bundle
+        self.shard = shard
+        self.count = 0
+        self.mtime = time.time()
+        if bundle == 'zip':
+            self.path = os.path.join(aimFile,"AIM-" + str(outname) + ".zip")
+            self.out = zipfile.ZipFile(self.path,'w',zipfile.ZIP_DEFLATED,allowZip64=True)
+        elif bundle == 'tgz':
+            self.path = os.path.join(aimFile,"AIM-" + str(outname) + ".tar.gz")
+            self.out = tarfile.open(self.path,'w:gz')
+        elif shard:
+            self.path = os.path.join(aimFile,"AIM-" + str(outname))
+        else:
+            self.path = aimFile
+
+    # Add one AIM file, by name, with its full xml text
+    def add(self,name,data):
+        if self.bundle == 'zip':
+            self.out.writestr(name,data)
+        elif self.bundle == 'tgz':
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            self.out.addfile(info,StringIO(data))
+        else:
+            folder = self.path
+            if self.shard:
+                folder = os.path.join(self.path,"%05d" % (self.count / self.shard))
+                if self.count % self.shard == 0 and not os.path.exists(folder):
+                    os.makedirs(folder)
+            aimout = open(os.path.join(folder,name),'w')
+            aimout.write(data)
+            aimout.close()
+        self.count = self.count + 1
+
+    def close(self):
+        if self.bundle:
+            self.out.close()
+
+# Read back AIM files written by aimBundle, in the order they were written, as (name,xml) tuples
+# A folder is read for one output name, AIM-<name>_<n>.xml, given or taken from a sharded AIM-<name> folder
+def readBundle(path,outname=None):
+    if os.path.isdir(path):
+        if outname is None and os.path.basename(os.path.normpath(path)).startswith("AIM-"):
+            outname = os.path.basename(os.path.normpath(path))[4:]
+        if outname is None:
+            pattern = re.compile(r"^AIM-(.+)_(\d+)\.xml$")
+        else:
+            pattern = re.compile("^AIM-(" + re.escape(str(outname)) + r")_(\d+)\.xml$")
+        aimfiles = []
+        names = set()
+        skipped = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                match = pattern.match(name)
+                if match:
+                    aimfiles.append((int(match.group(2)),name,root))
+                    names.add(match.group(1))
+                elif name.startswith("AIM-") and name.endswith(".xml"):
+                    skipped = skipped + 1
+        if skipped:
+            print "Skipped " + str(skipped) + " AIM files in " + path + " not named AIM-" + str(outname or "<name>") + "_<n>.xml"
+        if len(names) > 1:
+            print "Folder " + path + " has AIM files for " + ", ".join(sorted(names)) + ", give the output name to read one of them"
+            return
+        # single files are ordered by their record number
+        aimfiles.sort()
+        for number,name,root in aimfiles:
+            aimin = open(os.path.join(root,name),'r')
+            data = aimin.read()
+            aimin.close()
+            yield name, data
+    elif zipfile.is_zipfile(path):
+        bundle = zipfile.ZipFile(path,'r')
+        for name in bundle.namelist():
+            yield name, bundle.read(name)
+        bundle.close()
+    elif tarfile.is_tarfile(path):
+        bundle = tarfile.open(path,'r:*')
+        for info in bundle:
+            if info.isfile():
+                yield info.name, bundle.extractfile(info).read()
+        bundle.close()
+    else:
+        print "Cannot read AIM files from " + path + ": not a folder, zip or tar.gz"
+
+
 #----FMA-GRAPH-------------------------------------------------------------------------------
 class fmaGraph:
     def __init__(self):
        self.url = None
        self.fmaGraph = None
-       self.fmaList = []
-       self.aalList = []
        self.aalDict = {}
+       self.source = None        # url or full path to rdf file that aalDict was made from
+       self.fetched = None       # date and time the source was read
+       self.sha1 = None          # hash of the rdf content
 
 # URL to fmaGraph object
     def fmaURL(self,url):
         print "Checking URL..."
         try:
-            tempGraph = Graph()
             fmaURL = urlopen(url)
-            tempGraph.parse(fmaURL)
+            rdfdata = fmaURL.read()
+            fmaURL.close()
+            tempGraph = Graph()
+            tempGraph.parse(StringIO(rdfdata))
             self.fmaGraph = tempGraph
         except:
             print "Cannot open " + str(url) + ". Exiting."
-            sys.exit()
+            sys.exit(1)
+        self.url = url
+        self.setSource(url,rdfdata)
 
 # RDF file to fmaGraph object
     def fmaRDF(self,rdf):
@@ -316,17 +656,60 @@ class fmaGraph:
             self.fmaGraph = tempGraph
         else:
             print "Cannot find rdf file " + str(rdf) + " . Exiting!"
-            sys.exit()
+            sys.exit(1)
+        self.setSource(os.path.abspath(rdf),open(rdf,'rb').read())
+
+    def setSource(self,source,rdfdata):
+        self.source = source
+        self.fetched = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        self.sha1 = hashlib.sha1(rdfdata).hexdigest()
+
+# Cached aalDict to fmaGraph object, returns True if it was made from source (any source if anysource)
+    def fmaLoad(self,cachefile,source,anysource=False):
+        if not os.path.exists(cachefile):
+            return False
+        try:
+            copen = open(cachefile,'r')
+            cache = json.load(copen)
+            copen.close()
+        except:
+            print "Cannot read AAL to FMA mapping " + cachefile + ", ignoring it."
+            return False
+
+        if cache["source"] != source:
+            if not anysource:
+                return False
+            print "Warning: " + cachefile + " was made from " + cache["source"] + ", not " + source
+        # A local rdf file is cheap to hash, so an edited rdf is parsed again
+        elif os.path.exists(source):
+            if hashlib.sha1(open(source,'rb').read()).hexdigest() != cache["sha1"]:
+                return False
+
+        self.source = cache["source"]
+        self.fetched = cache["fetched"]
+        self.sha1 = cache["sha1"]
+        self.aalDict = dict((aalID,tuple(entry)) for aalID,entry in cache["aalDict"].iteritems())
+        print "Using AAL to FMA mapping " + cachefile + " (" + self.source + ", read " + self.fetched + ")"
+        return True
+
+# Save aalDict (after fmaRead) with its source, read time and rdf hash
+    def fmaSave(self,cachefile):
+        cache = {"source":self.source,"fetched":self.fetched,"sha1":self.sha1,"aalDict":self.aalDict}
+        try:
+            copen = open(cachefile,'w')
+            json.dump(cache,copen,indent=1,sort_keys=True)
+            copen.close()
+            print "Saved AAL to FMA mapping to " + cachefile
+        except:
+            print "Cannot write AAL to FMA mapping " + cachefile + ", it will be read again next time."
 
 # Parse fmaGraph Object    
     def fmaRead(self):
         print "Reading RDF..."
-        self.fma2List()
-        self.list2Nested()
-        self.aalMap()
+        self.fma2Dict()
          
-# Parse rdf into list
-    def fma2List(self):
+# Parse rdf into aalDict, in one pass over the triples
+    def fma2Dict(self):
 
         # Each RDF entry should be organized with something like:
         # <rdf:Description rdf:nodeID="A0">
@@ -336,49 +719,36 @@ class fmaGraph:
         # <result:AALID rdf:datatype="http://www.w3.org/2001/XMLSchema#string">20</result:AALID>
         # </rdf:Description>
 
-        fmaTemp = []
+        # Group the triples by subject node, with each node's fields keyed by predicate name:
+        # nodes['IsOsrOtg99'] --> {'AALID':'77', 'FMAID':'258716', 'aalName':'Thalamus_LEFT', 'fmaName':'Left thalamus'}
+        # Predicates other than these four are ignored
+        nodes = {}
         for s,p,o in self.fmaGraph:
-            fmaTemp.append((str(s),str(p),str(o)))
-            self.fmaList = sorted(fmaTemp)          
-
-            # sorting ensures correct indexing of aalIDs, fmaids, labels, etc in aalDict.
-            # fmaList will have four subsequent entries for each label, in the format:
-            # fmaList[0] --> ('IsOsrOtg10', 'http://sig.uw.edu/result#AALID', '19')
-            # fmaList[1] --> ('IsOsrOtg10', 'http://sig.uw.edu/result#FMAID', '276677')
-            # fmaList[2] --> ('IsOsrOtg10', 'http://sig.uw.edu/result#aalName', 'Supplemental_Motor_Area_LEFT')
-            # fmaList[3] --> ('IsOsrOtg10', 'http://sig.uw.edu/result#fmaName', 'Left supplemental motor cortex')
-
-# Organize fmaList into nested sets
-    def list2Nested(self):
-        aalList = []
-        # Since each fma label has four entires (AALID, FMAID, aalname and fmaname) we add until the length is 4
-        while len(self.fmaList) >= 4:
-            # Clear tempList from the last group of four
-            tempList = []
-            for i in range(4):
-                # We are popping off four members of the fmaList and putting them into tempList
-                # The first pop is the AALID, 2nd: FMAID, 3rd: aalName, 4th: fmaName
-                tempList.append(self.fmaList.pop())
-
-                # Since we "pop" from the start of the list and add to the end, this reverses our data. So tempList looks like:
-                
-                # tempList[0] --> ('IsOsrOtg99', 'http://sig.uw.edu/result#fmaName', 'Left thalamus') fmaName
-                # tempList[1] --> ('IsOsrOtg99', 'http://sig.uw.edu/result#aalName', 'Thalamus_LEFT') aalName
-                # tempList[2] --> ('IsOsrOtg99', 'http://sig.uw.edu/result#FMAID', '258716')  FMAID
-                # tempList[3] --> ('IsOsrOtg99', 'http://sig.uw.edu/result#AALID', '77')  AALID
-
-            # We are then appending ((fmaName, aalName, FMAID, AALID))  or  (('Left thalamus','Thalamus_LEFT','258716','77'))
-            self.aalList.append((tempList[0][2],tempList[1][2],tempList[2][2],tempList[3][2]))
-
-    def aalMap(self):
-        aalDict = {}
-        for i in range(len(self.aalList)):
-            # Pop each [('Left thalamus', 'Thalamus_LEFT', '258716', '77')] entry from the list
-            aalTemp = self.aalList.pop()
+            field = str(p).split('#')[-1]
+            if field in FMAFIELDS:
+                nodes.setdefault(str(s),{})[field] = unicode(o)
 
-            # Add to the AAL dictionary, indexing by the AALID, as a string
-            # aalDict[AALID] = ((fmaName, aalName, FMAID))
-            aalDict[aalTemp[3]] = ((aalTemp[0],aalTemp[1],aalTemp[2]))
+        # Add to the AAL dictionary, indexing by the AALID, as a string
+        # aalDict[AALID] = ((fmaName, aalName, FMAID))  or  aalDict['77'] = (('Left thalamus','Thalamus_LEFT','258716'))
+        aalDict = {}
+        incomplete = 0
+        for node in sorted(nodes):
+            fields = nodes[node]
+            # An entry needs an AALID to be looked up and an FMAID to be written to AIM
+            if "AALID" not in fields or "FMAID" not in fields:
+                incomplete = incomplete + 1
+                continue
+            aalName = fields.get("aalName","")
+            fmaName = fields.get("fmaName",aalName)
+            entry = (fmaName,aalName,fields["FMAID"])
+            aalID = str(fields["AALID"])
+            if aalID in aalDict and aalDict[aalID] != entry:
+                print "Warning: AALID " + aalID + " is mapped more than once, using FMAID " + aalDict[aalID][2]
+                continue
+            aalDict[aalID] = entry
+
+        if incomplete:
+            print "Skipped " + str(incomplete) + " rdf entries without an AALID or FMAID."
         self.aalDict = aalDict
 
 
@@ -386,6 +756,27 @@ class fmaGraph:
 def usage():
     print __doc__
 
+# Read --list file of image,outname lines, returns list of (image,outname)
+def readList(listfile):
+    entries = []
+    print "Reading input file " + listfile
+    try:
+        lopen = open(listfile,'r')
+        for line in lopen:
+            line = line.strip()
+            if not line: continue
+            if "," in line:
+                infile, outname = [field.strip() for field in line.split(",",1)]
+            else:
+                infile = line
+                outname = os.path.basename(infile).split('.')[0]
+            entries.append((infile,outname))
+        lopen.close()
+    except:
+        print "Cannot read file " + listfile + ". Exiting"
+        sys.exit(1)
+    return entries
+
 # Check Directory for Output
 def checkdir(userdir):
     # Make sure we don't end in a slash
@@ -407,7 +798,7 @@ def checkdir(userdir):
 #-----------------------------------------------------------------------------------
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "hi:o:n:ru", ["help","input=","out=","name=","rdf","url"])
+        opts, args = getopt.getopt(argv, "hi:o:n:r:u:l:", ["help","input=","out=","name=","list=","rdf=","url=","fmacache=","offline","refresh","regions","atlas=","bundle=","shard=","workers="])
 
     except getopt.GetoptError:
         usage()
@@ -416,10 +807,19 @@ def main(argv):
     # First cycle through the arguments to collect user variables
     infile = None
     outname = None
+    listfile = None
     outfol = None
     url = 'http://xiphoid.biostr.washington.edu:8080/ValueSetService/ValueSet?qid=96'
     # This rdf maps all AALIDs to all FMAIDS - see http://xiphoid.biostr.washington.edu:8080/QueryManager/QueryManager.html#qid=96 for details 
     rdf = None
+    fmacache = FMACACHE
+    offline = False
+    refresh = False
+    atlas = ATLAS
+    bundle = None
+    shard = 0
+    workers = 1
+    regions = False
 
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -431,31 +831,99 @@ def main(argv):
             outfol = arg
 	if opt in ("--name","-n"):
             outname = arg
-        if opt in ("--rdf","r"):
+        if opt in ("--list","-l"):
+            listfile = arg
+        if opt in ("--rdf","-r"):
             rdf = arg
-        if opt in ("--url","u"):
+        if opt in ("--url","-u"):
             url = arg
+        if opt == "--fmacache":
+            fmacache = arg
+        if opt == "--offline":
+            offline = True
+        if opt == "--refresh":
+            refresh = True
+        if opt == "--atlas":
+            atlas = arg
+        if opt == "--bundle":
+            bundle = arg
+        if opt == "--shard":
+            shard = int(arg)
+        if opt == "--workers":
+            workers = int(arg)
+        if opt == "--regions":
+            regions = True
 
       
-    aimFile = checkdir(outfol)     # check output directory
+    if bundle not in (None,"zip","tgz"):
+        print "--bundle must be zip or tgz"
+        sys.exit(2)
+    if bundle and shard:
+        print "--shard only applies to single AIM files, not a --bundle"
+        sys.exit(2)
+
+    if offline and refresh:
+        print "--offline and --refresh can't be used together"
+        sys.exit(2)
+    refreshonly = refresh and not (infile or listfile)
+    if not refreshonly and (not outfol or not (infile or listfile)):
+        usage()
+        sys.exit(2)
 
-    # Create rdf graph object that maps AAL IDs and FMAIDs
+    # Create rdf graph object that maps AAL IDs and FMAIDs, or use the saved mapping made from the same rdf/url
     FMA = fmaGraph()                              
-    if rdf: FMA.fmaRDF(rdf)       
-    else: FMA.fmaURL(url)                             
+    if rdf: source = os.path.abspath(rdf)
+    else: source = url
+    # Offline, a cache made from the url (or another rdf) is used, unless an rdf was given to read
+    if refresh or not FMA.fmaLoad(fmacache,source,offline and not rdf):
+        # Offline, the mapping can still be parsed from a local rdf
+        if offline and not rdf:
+            if not os.path.exists(FMARDF):
+                print "No AAL to FMA mapping in " + fmacache + " or " + FMARDF + " and --offline was given."
+                print "Run once with --rdf or the url to save " + fmacache + ". Exiting!"
+                sys.exit(1)
+            rdf = FMARDF
+        if rdf: FMA.fmaRDF(rdf)       
+        else: FMA.fmaURL(url)                             
     
-    # Extract aalIDs, fmaids, labels, etc and put into FMA objects aal dictionary
-    FMA.fmaRead()    
+        # Extract aalIDs, fmaids, labels, etc and put into FMA objects aal dictionary
+        FMA.fmaRead()    
+        FMA.fmaSave(fmacache)
 
-    # Create AIMTemplate Object
-    print "Creating AIM Template..."
-    AIM = AIMTemplate(infile)
+    if refreshonly:
+        return
+
+    aimFile = checkdir(outfol)     # check output directory
+
+    # Load the atlas index once, for one image or all images in the list
+    Atlas = MRtools.Atlas(atlas)
+    if not Atlas.go:
+        sys.exit(1)
 
     # Get aal dictionary from rdf object - this is the dict to look up FMAID by aalID
     aalDict = FMA.aalDict    
+
+    # Batch mode: generate AIM files for every image in the list
+    if listfile:
+        entries = readList(listfile)
+        failed = aimBatch(entries,Atlas,aalDict,aimFile,bundle,shard,workers,regions)
+        print "Generated AIM files for " + str(len(entries) - len(failed)) + " of " + str(len(entries)) + " images."
+        if failed:
+            print "Images that failed:"
+            for infile, outname, error in failed:
+                print infile + "," + outname
+            sys.exit(1)
+        return
+
+    # Create AIMTemplate Object
+    print "Creating AIM Template..."
+    AIM = AIMTemplate(infile,Atlas)
     
     # Generate AIM Template with all aalIDs from atlas found with activation in input image
-    AIM.aimGen(aalDict,aimFile,outname)
+    if regions:
+        AIM.aimRegions(aalDict,aimFile,outname,bundle,shard)
+    else:
+        AIM.aimGen(aalDict,aimFile,outname,bundle,shard,workers)
  
 
 if __name__ == "__main__":
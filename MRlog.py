@@ -3,20 +3,40 @@
 MRLog: prints log of imaging data information found in a particular directory.
 FSL is used by default, expected to execute on command line as "fsl." To use
 nibabel, make sure MRtools is in same folder, and specify --sof=nibabel
+For large archives, --sof=header reads only the header bytes of each image with
+nibabel (the first block of a .nii.gz), across a pool of threads, and gives
+the same fields as fsl.  The scandir module is used to walk the tree if installed.
+With --catalog, the fields are kept in an SQLite catalog, MRlog.db at the top of the
+data directory, by path, size and modification time, and only new or changed images
+are read again.  --query selects images from the catalog with an SQL condition on the
+fields (e.g. "timepoints >= 100 and Xpixdim < 3"), and --export writes them out.
+--duplicates finds images in the catalog with the same voxel data: a quick hash of the
+dimensions, data type and first block of voxels is kept for every image, and the voxel
+data is only hashed in full for images that share a quick hash.
 
  
 OPTIONS:
   -h, --help             show this help  
   -d, --dir              path to top data directory
-  -s, --sof              software to read (fsl or nibabel)
+  -s, --sof              software to read (fsl, nibabel or header)
   -o, --out              output folder for log
                          if not specified, uses pwd
+  -w, --workers          number of images read at once with --sof=fsl (fslhd processes) or --sof=header (threads)
+                         (default 16)
+  -c, --catalog          update the catalog at the top of the data directory instead of writing a log
+  -q, --query            condition on catalog fields selecting the images to print or export
+  -e, --export           write the selected catalog images to the output folder, as csv or json
+  -u, --duplicates       hash voxel data of catalog images, and report groups of duplicates in the output folder
 USAGE:
 python MRLog.py --out=/path/to/out --dir=/path/to/Data
+python MRLog.py --dir=/path/to/Data --sof=header --catalog
+python MRLog.py --dir=/path/to/Data --query="timepoints >= 100 and xdim = 64" --export=csv
+python MRLog.py --dir=/path/to/Data --sof=header --catalog --duplicates --out=/path/to/out
 
 OUTPUT: 
 image,path,Ydim,file_type,timepoints,dims,Xpixdim,Zdim,Xdim,Ypixdim,descrip,units,Zpixdim, (fsl)
 image,path,dims,units,Xpixdim,ydim,Zpixdim,file_type,zdim,timepoints,xdim,Ypixdim, (nibabel)
+image,path,Ydim,file_type,timepoints,dims,Xpixdim,Zdim,Xdim,Ypixdim,descrip,units,Zpixdim, (header, same as fsl)
 
 """
 
@@ -33,6 +53,34 @@ import datetime
 import time
 import getopt
 import subprocess
+import gzip
+import hashlib
+import struct
+import csv
+import json
+import sqlite3
+from multiprocessing.pool import ThreadPool
+
+# scandir's walk is much faster than os.walk on large trees, and is a drop in replacement
+try:
+    from scandir import walk
+except ImportError:
+    from os import walk
+
+# Size of the header at the start of a .nii, or in the .hdr of an Analyze or NIfTI pair, and of a NIfTI-2 header
+HEADERSIZE = 348
+NIFTI2SIZE = 540
+
+# Spatial units as fslhd prints them (nifti_units_string), by the nibabel name for the units code
+FSLUNITS = {"meter":"m","mm":"mm","micron":"um","unknown":"Unknown"}
+
+# Catalog kept at the top of the data directory, and the number of images read between commits
+CATALOGNAME = "MRlog.db"
+CATALOGCHUNK = 500
+
+# Bytes of voxel data in the quick hash, and read at a time for the full hash
+HASHBLOCK = 65536
+HASHCHUNK = 1048576
 
 class NoSourceError(Exception): pass
 
@@ -58,9 +106,9 @@ def checkDir(userdir):
 
 # Sets the software to use, fsl or nibabel
 def setSoft(software):
-    if software not in ("fsl","nibabel"):
+    if software not in ("fsl","nibabel","header"):
         print "Error: software " + software + " is not supported."
-        print "Supported types include fsl and nibabel.  Exiting!"
+        print "Supported types include fsl, nibabel and header.  Exiting!"
         sys.exit()
     else:
         print "Software specified is " + software
@@ -85,6 +133,13 @@ def sofCheck(softocheck):
                 return "nibabel"
             except:
                 print "Cannot find nibabel module."    
+        elif soft == "header":
+            try:
+                import nibabel
+                print "Found nibabel, reading headers only."
+                return "header"
+            except:
+                print "Cannot find nibabel module."    
     print "Not found!  FSL or nibabel is required to create MRlog.  Exiting."
     sys.exit()
 
@@ -117,95 +172,372 @@ def setupOutFile(outdir,soft,vals):
         print "Cannot open " + outdir + "/" + logname + " for writing.  Exiting!"
         sys.exit()
 
-# Prints a completed entry to the output file
-def addOutFile(line,outfile):
-    try:
-        fout = open(outfile,'a')
-        fout.write(line + "\n")
-        fout.close()
-    except:
-        print "Cannot print output to " + outfile + ".  Exiting!"
-        sys.exit()
+# Builds the line of the log for an image from its fields, first two entries are image name and path
+def imgLine(entry,fields,empty):
+    img, vals = entry
+    imgvals = os.path.basename(img) + "," + img
+    for desc in vals:
+        if desc in fields:
+            # If it's empty, we should still print some empty space to the file
+            imgvals = imgvals + "," + (fields[desc] or empty)
+    return imgvals
 
 # EXTRACTION FUNCTIONS
 
-def extractFSL(imagefiles,vals,outdir):
-    for img in imagefiles:
-        errorreading = False
-        valtoget = None
+# Extract header data using one fslhd call per image, over a pool of threads (each waiting on its own fslhd)
+def extractFSL(imagefiles,vals,outdir,workers=16):
+    writeLines(fslLine,imagefiles,vals,outdir,workers)
 
-        # Array to hold all values, first two entries are image name and path
-        imgvals = os.path.basename(img) + "," + img
+# One line of the log for an image, from a single fslhd dump
+def fslLine(entry):
+    return imgLine(entry,fslFields(entry),' ')
 
-        for desc,fslval in vals.iteritems():
-            try:
-                valtoget = subprocess.Popen(['fslval',img,fslval],stdout=subprocess.PIPE)
-                valtoget = valtoget.stdout.read().rstrip()
-                # If it's empty, we should still print some empty space to the file
-                if not valtoget:
-                    valtoget = ' '
-                imgvals = imgvals + "," + str(valtoget)
-            except:
-                errorreading = True
-                continue
-        if errorreading: print "Error reading image " + img + ". Skipping."
-        # Print the line of data to the output file
-        addOutFile(imgvals,outdir)
+# Fields of an image from a single fslhd dump, {descriptor:value}, empty if fslhd cannot be run
+def fslFields(entry):
+    img, vals = entry
+    try:
+        fslhd = subprocess.Popen(['fslhd',img],stdout=subprocess.PIPE)
+        dump = fslhd.communicate()[0]
+    except:
+        print "Error reading image " + img + ". Skipping."
+        return {}
+
+    # fslval prints the words after the field name, one value per field, so a repeated name keeps its first line
+    fields = {}
+    for line in dump.splitlines():
+        words = line.split()
+        if words and words[0] not in fields:
+            fields[words[0]] = "".join([word + " " for word in words[1:]])
+    return dict((desc,fields.get(fslval,"").rstrip()) for desc,fslval in vals.iteritems())
 
 # Extract header data using nibabel
 def extractNIB(imagefiles,vals,outdir):
+    writeLines(nibLine,imagefiles,vals,outdir,1)
+
+# One line of the log for an image, read with MRtools
+def nibLine(entry):
+    return imgLine(entry,nibFields(entry),'')
+
+# Fields of an image read with MRtools, {descriptor:value}, fields that cannot be read are left out
+def nibFields(entry):
     import MRtools
-    for img in imagefiles:
-        # Read in image to MRtools Data object
-        image = MRtools.Data(img)
-        errorreading = False
-        valtoget = None
-
-        # Array to hold all values, first two entries are image name and path
-        imgvals = os.path.basename(img) + "," + img
-
-        for desc,nibval in vals.iteritems():
-            nibval = nibval.split(':')
-            
-            try:
-                valtoget = image.getMeta(nibval[0])
-                if isinstance(valtoget,(list)):
-                    valtoget = valtoget[int(nibval[1])]
-
-                # If it's empty, we should still print some empty space to the file
-                if not valtoget:
-                    valtoget = ' '
-                imgvals = imgvals + "," + str(valtoget).rstrip()
-            except:
-                errorreading = True
-                continue
-        if errorreading: print "Error reading image " + img + ". Skipping."
-        # Print the line of data to the output file
-        addOutFile(imgvals,outdir)
+    img, vals = entry
+    # Read in image to MRtools Data object
+    image = MRtools.Data(img)
+    errorreading = False
+    fields = {}
+
+    for desc,nibval in vals.iteritems():
+        nibval = nibval.split(':')
+        try:
+            valtoget = image.getMeta(nibval[0])
+            if isinstance(valtoget,(list)):
+                valtoget = valtoget[int(nibval[1])]
+            fields[desc] = str(valtoget).rstrip() if valtoget else ''
+        except:
+            errorreading = True
+            continue
+    if errorreading: print "Error reading image " + img + ". Skipping."
+    return fields
+
+# Extract header data by reading only the header bytes, with nibabel, over a pool of threads
+def extractHeader(imagefiles,vals,outdir,workers=16):
+    writeLines(headerLine,imagefiles,vals,outdir,workers)
+
+# Run linefunc((img,vals)) for every image on a pool of threads, printing the lines to the output file in image order
+def writeLines(linefunc,imagefiles,vals,outdir,workers):
+    pool = ThreadPool(workers)
+    try:
+        fout = open(outdir,'a')
+        # Lines come back in the order of imagefiles, and are written through one open file
+        for line in pool.imap(linefunc,[(img,vals) for img in imagefiles],max(1,len(imagefiles) / (workers * 16))):
+            fout.write(line + "\n")
+        fout.close()
+    except IOError:
+        print "Cannot print output to " + outdir + ".  Exiting!"
+        sys.exit()
+    finally:
+        pool.close()
+        pool.join()
+
+# One line of the log for an image, fields read from its header as fslval names them
+def headerLine(entry):
+    return imgLine(entry,headerFields(entry),' ')
+
+# Fields of an image read from its header bytes, {descriptor:value}
+def headerFields(entry):
+    img, vals = entry
+    try:
+        fields = readHeader(img)
+    except:
+        print "Error reading image " + img + ": " + str(sys.exc_info()[1]) + ". Skipping."
+        fields = {}
+    return dict((desc,fields.get(fslval,"")) for desc,fslval in vals.iteritems())
+
+# Read the header bytes of a .nii(.gz), or the .hdr(.gz) next to a .img(.gz), returns fslval fields as strings
+def readHeader(img):
+    header, filetype = headerBlock(img)
+
+    fields = {"file_type":filetype}
+    dim = header["dim"]
+    pixdim = header["pixdim"]
+    for i in range(8):
+        fields["dim" + str(i)] = str(int(dim[i]))
+        fields["pixdim" + str(i)] = "%f" % pixdim[i]
+    fields["descrip"] = str(header["descrip"]).split("\x00")[0].strip()
+    if filetype != "ANALYZE-7.5":
+        units = header.get_xyzt_units()[0]
+        fields["vox_units"] = FSLUNITS.get(units,units)
+    else:
+        fields["vox_units"] = str(header["vox_units"]).split("\x00")[0].strip() if "vox_units" in header else ""
+    return fields
+
+# Opens an image file, .gz files are decompressed as they are read
+def openImage(path):
+    if path.endswith(".gz"):
+        return gzip.open(path,'rb')
+    return open(path,'rb')
+
+# Reads the header of a .nii(.gz), or the .hdr(.gz) next to a .img(.gz), returns the nibabel header and file type
+def headerBlock(img):
+    import nibabel
+    hdrpath = img
+    name = img[:-3] if img.endswith(".gz") else img
+    if name.endswith(".img"):
+        hdrpath = name[:-4] + ".hdr" + img[len(name):]
+    hopen = openImage(hdrpath)     # only the first compressed block is decompressed
+    binaryblock = hopen.read(HEADERSIZE)
+    # sizeof_hdr is the first field, 348 for Analyze and NIfTI-1 and 540 for NIfTI-2, in either byte order
+    sizes = struct.unpack("<i",binaryblock[0:4]) + struct.unpack(">i",binaryblock[0:4]) if len(binaryblock) >= 4 else ()
+    if NIFTI2SIZE in sizes:
+        binaryblock += hopen.read(NIFTI2SIZE - HEADERSIZE)
+    hopen.close()
+    if len(binaryblock) < (NIFTI2SIZE if NIFTI2SIZE in sizes else HEADERSIZE):
+        raise IOError("header is only " + str(len(binaryblock)) + " bytes")
+    if HEADERSIZE not in sizes and NIFTI2SIZE not in sizes:
+        raise IOError("not an Analyze or NIfTI header, sizeof_hdr is " + str(sizes[0]))
+
+    magic = binaryblock[344:347]
+    if NIFTI2SIZE in sizes:
+        # The NIfTI-2 magic follows sizeof_hdr, and dim and vox_offset are 64 bit
+        magic = binaryblock[4:7]
+        if magic not in ("n+2","ni2"):
+            raise IOError("NIfTI-2 header without n+2 or ni2 magic")
+        header = nibabel.Nifti2Header(binaryblock,check=False)
+        filetype = "NIFTI-2+" if magic == "n+2" else "NIFTI-2"
+    elif magic in ("n+1","ni1"):
+        header = nibabel.Nifti1Header(binaryblock,check=False)
+        filetype = "NIFTI-1+" if magic == "n+1" else "NIFTI-1"
+    else:
+        header = nibabel.AnalyzeHeader(binaryblock,check=False)
+        filetype = "ANALYZE-7.5"
+    return header, filetype
+
+# Hashes the voxel data of an image, the quick hash covers dimensions, data type and the first HASHBLOCK bytes
+def imageHashes(entry):
+    '''returns (img,quickhash,datahash,error), datahash is only computed if full is set'''
+    img, full = entry
+    try:
+        header, filetype = headerBlock(img)
+        quick = hashlib.sha1(" ".join([str(int(d)) for d in header["dim"]]) + " " + str(int(header["datatype"])))
+        # The voxels of a .nii follow its header, those of an Analyze or NIfTI pair are in the .img
+        dopen = openImage(img)
+        dopen.seek(int(header["vox_offset"]))
+        block = dopen.read(HASHBLOCK)
+        quick.update(block)
+        datahash = None
+        if full:
+            data = hashlib.sha1(block)
+            chunk = dopen.read(HASHCHUNK)
+            while chunk:
+                data.update(chunk)
+                chunk = dopen.read(HASHCHUNK)
+            datahash = data.hexdigest()
+        dopen.close()
+        return img, quick.hexdigest(), datahash, None
+    except:
+        return img, None, None, str(sys.exc_info()[1])
 
 # Get list of all image files below specified data directory
-def getFiles(startdir,extensions):
+def getFiles(startdir,extensions,verbose=True):
     # Make sure we have read access
     if os.access(startdir,os.R_OK):
         imagefiles = []
 
         # Get list of files:
-        for r, d, f in os.walk(startdir, topdown=True):
+        for r, d, f in walk(startdir, topdown=True):
             for filey in f:
                 # Look at the file extension to check for .nii or .img.  Do it twice in the case of .nii.gz
                 if os.path.splitext(filey)[1] in extensions or os.path.splitext(os.path.splitext(filey)[0])[1] in extensions:
                     imagefiles.append(os.path.abspath(r  + "/" + filey))
-                    print "Adding image file " + os.path.abspath(r + "/" + filey)
+                    if verbose: print "Adding image file " + os.path.abspath(r + "/" + filey)
+        print "Found " + str(len(imagefiles)) + " image files under " + startdir
         return imagefiles
 
     else:
         print "Do not have permissions to access " + startdir + ".  Exiting!"
         sys.exit()
 
+# CATALOG
+
+# SQLite catalog of the images under a data directory, one row per image path
+class mrCatalog:
+    def __init__(self,dirtop):
+        self.path = dirtop + "/" + CATALOGNAME
+        try:
+            self.db = sqlite3.connect(self.path)
+            self.db.text_factory = str
+            self.db.execute("CREATE TABLE IF NOT EXISTS images (image TEXT, path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sof TEXT)")
+        except sqlite3.Error:
+            print "Cannot open catalog " + self.path + ".  Exiting!"
+            sys.exit()
+        self.columns = [row[1] for row in self.db.execute("PRAGMA table_info(images)")]
+
+    def addColumns(self,vals,coltype="NUMERIC"):
+        # Fields are NUMERIC so that dims and voxel sizes compare as numbers in a query
+        for desc in vals:
+            if desc not in self.columns:
+                self.db.execute('ALTER TABLE images ADD COLUMN "' + desc + '" ' + coltype)
+                self.columns.append(desc)
+
+    def update(self,imagefiles,soft,vals,fieldfunc,workers=16):
+        '''reads images that are new, changed, or were read with other software, and removes images that are gone'''
+        self.addColumns(vals)
+        known = dict((row[0],row[1:]) for row in self.db.execute("SELECT path,size,mtime,sof FROM images"))
+        stale = []
+        for img in imagefiles:
+            try:
+                stat = os.stat(img)
+            except OSError:
+                continue
+            if known.get(img) != (stat.st_size,stat.st_mtime,soft):
+                stale.append((img,stat))
+
+        gone = set(known) - set(imagefiles)
+        self.db.executemany("DELETE FROM images WHERE path = ?",[(img,) for img in gone])
+        print "Catalog " + self.path + ": " + str(len(stale)) + " new or changed, " + str(len(gone)) + " removed, " + str(len(imagefiles) - len(stale)) + " unchanged"
+
+        descs = list(vals)
+        insert = "INSERT OR REPLACE INTO images (image,path,size,mtime,sof," + ",".join(['"' + desc + '"' for desc in descs]) + ") VALUES (" + ",".join(["?"] * (len(descs) + 5)) + ")"
+        pool = ThreadPool(workers)
+        try:
+            # Committed every CATALOGCHUNK images, so an interrupted run keeps what it has read
+            for start in range(0,len(stale),CATALOGCHUNK):
+                chunk = stale[start:start + CATALOGCHUNK]
+                fields = pool.map(fieldfunc,[(img,vals) for img,stat in chunk])
+                rows = [[os.path.basename(img),img,stat.st_size,stat.st_mtime,soft] + [imgfields.get(desc) or None for desc in descs]
+                        for (img,stat),imgfields in zip(chunk,fields)]
+                self.db.executemany(insert,rows)
+                self.db.commit()
+        finally:
+            pool.close()
+            pool.join()
+        self.db.commit()
+
+    def duplicates(self,workers=16):
+        '''hashes voxel data of images sharing a quick hash, returns {datahash:[paths]} for data found more than once'''
+        # Rows that are read again lose their hashes, so only new or changed images are hashed
+        self.addColumns(["quickhash","datahash"],"TEXT")
+        paths = [row[0] for row in self.db.execute("SELECT path FROM images WHERE quickhash IS NULL")]
+        print "Quick hashing " + str(len(paths)) + " images"
+        self.hashImages(paths,False,workers)
+        paths = [row[0] for row in self.db.execute("SELECT path FROM images WHERE datahash IS NULL AND quickhash IN "
+                                                   "(SELECT quickhash FROM images GROUP BY quickhash HAVING count(*) > 1)")]
+        print "Hashing all voxel data of " + str(len(paths)) + " images with a shared quick hash"
+        self.hashImages(paths,True,workers)
+
+        groups = {}
+        for path,datahash in self.db.execute("SELECT path,datahash FROM images WHERE datahash IN "
+                                             "(SELECT datahash FROM images GROUP BY datahash HAVING count(*) > 1) ORDER BY path"):
+            groups.setdefault(datahash,[]).append(path)
+        return groups
+
+    def hashImages(self,paths,full,workers=16):
+        pool = ThreadPool(workers)
+        try:
+            for start in range(0,len(paths),CATALOGCHUNK):
+                rows = []
+                for img,quickhash,datahash,error in pool.imap_unordered(imageHashes,[(img,full) for img in paths[start:start + CATALOGCHUNK]]):
+                    if error:
+                        print "Error hashing image " + img + ": " + error + ". Skipping."
+                        continue
+                    rows.append((quickhash,datahash,img))
+                if full:
+                    self.db.executemany("UPDATE images SET quickhash = ?, datahash = ? WHERE path = ?",rows)
+                else:
+                    self.db.executemany("UPDATE images SET quickhash = ? WHERE path = ?",[(row[0],row[2]) for row in rows])
+                self.db.commit()
+        finally:
+            pool.close()
+            pool.join()
+
+    def select(self,query=None):
+        '''returns column names and rows of the images matching the query, a condition on the catalog columns'''
+        sql = "SELECT * FROM images"
+        if query: sql = sql + " WHERE " + query
+        try:
+            cursor = self.db.execute(sql + " ORDER BY path")
+        except sqlite3.Error, e:
+            print "Cannot run query " + query + ": " + str(e) + ".  Exiting!"
+            sys.exit()
+        return [column[0] for column in cursor.description], cursor.fetchall()
+
+    def export(self,query,fmt,outdir):
+        '''writes the selected images to MRlog-<date>.csv or .json in outdir, returns the path'''
+        columns, rows = self.select(query)
+        now = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M")
+        outfile = os.path.abspath(outdir + "/MRlog-" + now + "." + fmt)
+        try:
+            fout = open(outfile,'wb')
+            if fmt == "csv":
+                writer = csv.writer(fout)
+                writer.writerow(columns)
+                writer.writerows(rows)
+            else:
+                json.dump([dict(zip(columns,row)) for row in rows],fout,indent=1)
+            fout.close()
+        except IOError:
+            print "Cannot print output to " + outfile + ".  Exiting!"
+            sys.exit()
+        print "Exported " + str(len(rows)) + " images to " + outfile
+        return outfile
+
+    def close(self):
+        self.db.close()
+
+# Prints or exports the catalog images matching the query
+def catalogOut(catalog,query,export,outdir):
+    if export:
+        catalog.export(query,export,outdir)
+    else:
+        columns, rows = catalog.select(query)
+        for row in rows:
+            print row[1]
+        print str(len(rows)) + " images selected from " + catalog.path
+
+# Prints groups of images with the same voxel data, and writes them to MRlog-duplicates-<date>.txt in outdir
+def printDuplicates(groups,outdir):
+    now = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M")
+    outfile = os.path.abspath(outdir + "/MRlog-duplicates-" + now + ".txt")
+    lines = []
+    for datahash,paths in sorted(groups.items(),key=lambda group: group[1][0]):
+        lines.append(datahash + " " + str(len(paths)) + " images")
+        lines.extend(["  " + path for path in paths])
+    try:
+        fout = open(outfile,'w')
+        fout.write("".join([line + "\n" for line in lines]))
+        fout.close()
+    except IOError:
+        print "Cannot print output to " + outfile + ".  Exiting!"
+        sys.exit()
+    for line in lines:
+        print line
+    print str(len(groups)) + " groups of duplicate images, " + str(sum([len(paths) - 1 for paths in groups.values()])) + " extra copies, listed in " + outfile
+
 #----------------------------------------------------------------------------------------
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "hd:spo", ["help","dir=","sof=","pre=","out="])
+        opts, args = getopt.getopt(argv, "hd:s:po:w:cq:e:u", ["help","dir=","sof=","pre=","out=","workers=","catalog","query=","export=","duplicates"])
 
     except getopt.GetoptError:
         usage()
@@ -216,6 +548,12 @@ def main(argv):
     soft = None                        # if not specified, will try fsl first
     extensions = ('.nii','.img')          # file extensions to include, currently hardcoded
     vals = dict()                      # Do not need to specify ".nii.gz"
+    workers = 16                       # images read at once, for --sof=fsl and --sof=header
+    catalog = False                    # update the catalog instead of writing a log
+    query = None                       # condition selecting images from the catalog
+    export = None                      # csv or json, to write selected images from the catalog
+    duplicates = False                 # report catalog images with the same voxel data
+    dirtop = None
 
     # OUTPUT VARIABLES
     # Variables to read from header using FSL.  Dictionary should be in form ('descriptor':'fslval').  Add more as you need!
@@ -223,6 +561,9 @@ def main(argv):
     vals['fsl'] = {'timepoints':'dim4','dims':'dim0','xdim':'dim1','ydim':'dim2','zdim':'dim3','file_type':'file_type','descrip':'descrip','Xpixdim':'pixdim1','Ypixdim':'pixdim2','Zpixdim':'pixdim3','units':'vox_units'}   
     
     # Since nibabel will pull a list of raw data for one field (dim, for example) the format here is {'descriptor':'meta:list_location'}
+    # Reading the header directly gives the same fields, named as for fslval
+    vals['header'] = vals['fsl']
+
     vals['nibabel'] = {'timepoints':'dim:4','dims':'dim:0','xdim':'dim:1','ydim':'dim:2','zdim':'dim:3','file_type':'magic:0','Xpixdim':'dim:5','Ypixdim':'dim:6','Zpixdim':'dim:7','units':'xyzt_units:0'}   
 
     # First cycle through the arguments to collect user variables
@@ -240,6 +581,34 @@ def main(argv):
 	    pre = arg
         if opt in ("--out","-o"):
 	    outdir = checkDir(arg)
+        if opt in ("--workers","-w"):
+            workers = int(arg)
+        if opt in ("--catalog","-c"):
+            catalog = True
+        if opt in ("--query","-q"):
+            query = arg
+        if opt in ("--export","-e"):
+            if arg not in ("csv","json"):
+                print "Error: export format " + arg + " is not supported, use csv or json.  Exiting!"
+                sys.exit()
+            export = arg
+        if opt in ("--duplicates","-u"):
+            duplicates = True
+
+    varcheck({dirtop:"--dir"})
+
+    # Selecting from the catalog doesn't need any images to be read
+    if (query or export or duplicates) and not catalog:
+        if not os.path.isfile(dirtop + "/" + CATALOGNAME):
+            print "No catalog found at " + dirtop + "/" + CATALOGNAME + ", run with --catalog first.  Exiting!"
+            sys.exit()
+        Catalog = mrCatalog(dirtop)
+        if duplicates:
+            printDuplicates(Catalog.duplicates(workers),outdir)
+        if query or export:
+            catalogOut(Catalog,query,export,outdir)
+        Catalog.close()
+        sys.exit()
        
     # if user specified software to use, check for that one first, otherwise check both
     if not soft:
@@ -247,15 +616,28 @@ def main(argv):
     else:
         soft = sofCheck([soft.rstrip()])    
 
+    # Update the catalog, reading only new or changed images
+    if catalog:
+        fieldfunc = {"fsl":fslFields,"nibabel":nibFields,"header":headerFields}[soft]
+        Catalog = mrCatalog(dirtop)
+        Catalog.update(getFiles(dirtop,extensions,False),soft,vals[soft],fieldfunc,1 if soft == "nibabel" else workers)
+        if duplicates:
+            printDuplicates(Catalog.duplicates(workers),outdir)
+        if query or export:
+            catalogOut(Catalog,query,export,outdir)
+        Catalog.close()
+        sys.exit()
+
     # Setup output file for printing results
     fullout = setupOutFile(outdir,soft,vals)
     
     # Get list of imaging files with full paths
-    imagefiles = getFiles(dirtop,extensions)
+    imagefiles = getFiles(dirtop,extensions,soft != "header")
 
     # Perform extraction...
-    if soft is "fsl": extractFSL(imagefiles,vals['fsl'],fullout)
+    if soft is "fsl": extractFSL(imagefiles,vals['fsl'],fullout,workers)
     if soft is "nibabel": extractNIB(imagefiles,vals['nibabel'],fullout)
+    if soft is "header": extractHeader(imagefiles,vals['header'],fullout,workers)
  
     print "Done creating MRlog, located at " + fullout
     sys.exit()
@@ -7,6 +7,8 @@ MRtools.py - Python tools for image manipulation and filtration
 MRtools.Data:   Translate between images of different dimensions and formats
 MRtools.Filter: Determine goodness of an input image and a frequency timeseries
 MRtools.Match:  Return match score for two MRtools Data objects
+MRtools.Atlas:  Persisted index of a label atlas (label --> voxels, MNI coordinates, counts)
+MRtools.Stream: Read the volumes of a 4D image one at a time, in bounded memory
 
 Class to create a nifti image object that can be queued for values in raw coordinate 
 space as well as MNI space.  Intended use is for a translation between
@@ -38,6 +40,17 @@ To use Match class with Image:
 >> Match.addComp(Contender)
 >> Match.doTemplateMatch()
 
+To use Atlas class with a label image (index is saved next to the atlas and reused):
+>> import MRtools
+>> Atlas = MRtools.Atlas('MR/aal2mni152.nii.gz')
+>> Atlas.getLabelMNI(77)
+>> Atlas.sample(MRtools.Data('myimage.nii.gz','3D'))
+
+To use Stream class with a 4D image (only one volume is held in memory at a time):
+>> import MRtools
+>> Stream = MRtools.Stream('filtered_func_data.nii.gz')
+>> for volume in Stream.volumes(): ...
+
 """
 
 __author__ = "Vanessa Sochat (vsochat@stanford.edu)"
@@ -53,10 +66,12 @@ import scitools.numpytools as scinu
 import numpy as np
 import operator
 import getopt
+import hashlib
+import gzip
 
 # Data------------------------------------------------------------------------------
 class Data:
-    def __init__(self,imname,dim=None):
+    def __init__(self,imname,dim=None,xyz=True):
         self.name = imname  # name of the image, as user has input
         self.path = None    # Full path to the image        
         self.img = None     # a nibabel Nifti object to hold image
@@ -76,7 +91,8 @@ class Data:
                         
             self.XYZ = []       # XYZ coordinates to match raw data
             self.RCP = []       # "raw coordinate points"
-            self.readXYZ()
+            if xyz:             # The coordinate grid is not needed for array lookups
+                self.readXYZ()  # (see mnitoRCPArray), and is slow to build
 
     def __repr__(self):
         return self.name
@@ -267,6 +283,12 @@ class Data:
         '''Image.getData() returns entire raw data from nibabel object (in RCP space)'''
         return self.data
 
+    def getVolume(self):
+        '''Image.getVolume() returns raw data as a 3D array (in RCP space), dropping a 4th dimension of 1'''
+        if len(np.shape(self.data)) > 3:
+            return self.data[:,:,:,0]
+        return self.data
+
     def getXYZArray(self):
         '''Image.getXYZArray() returns entire coordinate matrix (as an array) (in MNI space)'''
         return np.array(self.XYZ)
@@ -320,6 +342,20 @@ class Data:
 
         return [coordx,coordy,coordz]
 
+    def mnitoRCPArray(self,coords):
+        '''Image.mnitoRCPArray(coords) returns a 3xn array of RCP from a 3xn array of MNI coordinates'''
+        aff = np.array(self.aff)
+        voxelcoord = np.array([aff[0,0],aff[1,1],aff[2,2]]).reshape(3,1)
+        origindist = aff[0:3,3].reshape(3,1)
+        return (np.asarray(coords) - origindist) / voxelcoord
+
+    def rcptoMNIArray(self,coords):
+        '''Image.rcptoMNIArray(coords) returns a 3xn array of MNI from a 3xn array of RCP coordinates'''
+        aff = np.array(self.aff)
+        voxelcoord = np.array([aff[0,0],aff[1,1],aff[2,2]]).reshape(3,1)
+        origindist = aff[0:3,3].reshape(3,1)
+        return (np.asarray(coords) * voxelcoord) + origindist
+
     def mnitoRCPIndex(self,coord):
         '''Image.mnitoRCP([x,y,z]) returns an RCP from an MNI coordinate input by using XYZ index'''
         # Find MNI coordinate in data.XYZ:
@@ -373,14 +409,211 @@ class Data:
 
     def getUniqueIDs(self):
         '''Image.getUniqueIDs() returns all unique activation values in an image, likely corresponding to an atlas ID, NOT including 0'''
-        uniques = []
-	for p in range(0,self.data.shape[0]-1):
-            for o in range(0,self.data.shape[1]-1):
-                for d in range(0,self.data.shape[2]-1):
-                    if self.data[p,o,d] not in uniques:
-		        uniques.append(self.data[p,o,d])
-        if 0 in uniques: uniques.remove(0) 
-        return uniques
+        uniques = np.unique(self.getVolume())
+        return list(uniques[uniques != 0])
+
+
+# Atlas------------------------------------------------------------------------------
+class Atlas:
+    '''Index of a label atlas, built once and saved next to the atlas keyed by a hash of the atlas file'''
+    def __init__(self,imname):
+        self.name = imname     # name of the atlas image, as user has input
+        self.path = None       # Full path to the atlas image
+        self.hash = None       # sha1 of the atlas file, the index is rebuilt when it changes
+        self.indexfile = None  # Full path to the saved index
+        self.shape = None      # atlas dimensions
+        self.aff = None        # Affine transformation matrix (as an array)
+        self.indices = None    # Flat (C order) indices of all labeled voxels, ascending
+        self.voxlabels = None  # Label of each voxel in indices
+        self.coordsMNI = None  # 3xn array of MNI coordinates of each voxel in indices
+        self.labels = None     # Unique labels, NOT including 0
+        self.counts = None     # Number of voxels for each label
+        self.bylabel = None    # Positions in indices sorted by label: labels[i] voxels are
+        self.offsets = None    # indices[bylabel[offsets[i]:offsets[i+1]]]
+        self.go = self.checkFile()
+        if self.go:
+            self.load()
+
+    def __repr__(self):
+        return "<Atlas> " + self.name
+
+    def checkFile(self):
+        if not os.path.isfile(self.name):
+            print "Cannot find atlas " + self.name + ". Check the path."
+            return False
+        self.path = os.path.abspath(self.name)
+        afile = open(self.path,'rb')
+        self.hash = hashlib.sha1(afile.read()).hexdigest()
+        afile.close()
+        base = os.path.basename(self.path).split('.')[0]
+        self.indexfile = os.path.dirname(self.path) + "/." + base + "-" + self.hash[0:12] + ".index.npz"
+        return True
+
+    # Load the saved index if it matches the atlas, otherwise build and save it
+    def load(self):
+        if os.path.isfile(self.indexfile):
+            try:
+                saved = np.load(self.indexfile)
+                if str(saved['hash']) == self.hash:
+                    for field in ('shape','aff','labels','counts','offsets'):
+                        setattr(self,field,saved[field])
+                    # Voxels are saved label by label as differences between indices, which compress well
+                    labelindices = np.cumsum(saved['deltas'],dtype=np.int64)
+                    saved.close()
+                    self.readIndex(labelindices)
+                    return
+                saved.close()
+            except:
+                print "Cannot read atlas index " + self.indexfile + ", rebuilding."
+        self.build()
+        self.save()
+
+    def build(self):
+        print "Building atlas index for " + self.name + "..."
+        img = nib.load(self.path)
+        data = img.get_data()
+        if len(np.shape(data)) > 3:
+            data = data[:,:,:,0]
+        self.shape = np.array(data.shape[0:3])
+        self.aff = np.array(img.get_affine())
+
+        flat = data.ravel()
+        indices = np.flatnonzero(flat)
+        voxlabels = flat[indices]
+        self.labels,self.counts = np.unique(voxlabels,return_counts=True)
+        self.offsets = np.concatenate(([0],np.cumsum(self.counts)))
+        self.readIndex(indices[np.argsort(voxlabels,kind='mergesort')])
+
+    # Fill in voxel ordered arrays and MNI coordinates from flat indices ordered by label
+    def readIndex(self,labelindices):
+        order = np.argsort(labelindices)
+        self.indices = labelindices[order]
+        self.voxlabels = np.repeat(self.labels,self.counts)[order]
+        self.bylabel = np.argsort(order)
+        RCP = np.vstack(np.unravel_index(self.indices,tuple(self.shape)))
+        voxelcoord = np.array([self.aff[0,0],self.aff[1,1],self.aff[2,2]]).reshape(3,1)
+        self.coordsMNI = (RCP * voxelcoord) + self.aff[0:3,3].reshape(3,1)
+
+    # The index is written to a temporary file first, so a reader never finds a partial index.  When the
+    # atlas folder can't be written (read only install), the index built in memory is used
+    def save(self):
+        tmpfile = self.indexfile + "." + str(os.getpid()) + ".tmp"
+        try:
+            labelindices = self.indices[self.bylabel]
+            deltas = np.diff(np.concatenate(([0],labelindices))).astype(np.int32)
+            tmp = open(tmpfile,'wb')
+            np.savez_compressed(tmp,hash=self.hash,shape=self.shape,aff=self.aff,deltas=deltas,
+                                labels=self.labels,counts=self.counts,offsets=self.offsets)
+            tmp.close()
+            os.rename(tmpfile,self.indexfile)
+            print "Saved atlas index to " + self.indexfile
+        except:
+            print "Cannot write atlas index " + self.indexfile + ", using the index built in memory. It will be rebuilt next time."
+            if os.path.exists(tmpfile):
+                try: os.remove(tmpfile)
+                except OSError: pass
+
+# ATLAS DATA RETURN
+    def getLabels(self):
+        '''Atlas.getLabels() returns all labels in the atlas, NOT including 0'''
+        return list(self.labels)
+
+    def getCount(self,label):
+        '''Atlas.getCount(label) returns the number of voxels with a label'''
+        return int(self.counts[np.searchsorted(self.labels,label)]) if label in self.labels else 0
+
+    def getLabelIndices(self,label):
+        '''Atlas.getLabelIndices(label) returns flat voxel indices for a label'''
+        if label not in self.labels:
+            return np.array([],dtype=self.indices.dtype)
+        i = np.searchsorted(self.labels,label)
+        return self.indices[self.bylabel[self.offsets[i]:self.offsets[i+1]]]
+
+    def getLabelMNI(self,label):
+        '''Atlas.getLabelMNI(label) returns a 3xn array of MNI coordinates for a label'''
+        if label not in self.labels:
+            return np.zeros((3,0))
+        i = np.searchsorted(self.labels,label)
+        return self.coordsMNI[:,self.bylabel[self.offsets[i]:self.offsets[i+1]]]
+
+    def sample(self,Image):
+        '''Atlas.sample(MRDataObj) returns the image value at the MNI coordinate of each labeled voxel (0 outside of the image)'''
+        data = Image.getVolume()
+        RCP = Image.mnitoRCPArray(self.coordsMNI).astype(int)
+        inside = np.all((RCP >= 0) & (RCP < np.array(data.shape[0:3]).reshape(3,1)),axis=0)
+        values = np.zeros(len(self.indices),dtype=data.dtype)
+        values[inside] = data[RCP[0,inside],RCP[1,inside],RCP[2,inside]]
+        return values
+
+
+# Stream------------------------------------------------------------------------------
+class Stream:
+    '''Sequential reader of the volumes of a 4D nifti image, decompressing .nii.gz as it goes'''
+    def __init__(self,imname):
+        self.name = imname     # name of the image, as user has input
+        self.path = None       # Full path to the image
+        self.shape = None      # dimensions of one volume (x,y,z)
+        self.nvols = 0         # number of volumes
+        self.dtype = None      # data type of the voxels on disk (with byte order)
+        self.offset = 0        # byte offset of the first volume
+        self.slope = None      # scaling of the stored values, None if not scaled
+        self.inter = None
+        self.go = self.checkFile()
+
+    def __repr__(self):
+        return "<Stream> " + self.name
+
+    # Only the header is read here, as stored in the file (nibabel images reset the offset and scaling)
+    def checkFile(self):
+        if not os.path.isfile(self.name):
+            print "Cannot find " + self.name + ". Check the path."
+            return False
+        if not (self.name.endswith(".nii") or self.name.endswith(".nii.gz")):
+            print "Cannot stream " + self.name + ", only single file .nii or .nii.gz images can be streamed."
+            return False
+        self.path = os.path.abspath(self.name)
+        try:
+            image = self.open()
+            header = nib.Nifti1Header.from_fileobj(image)
+            image.close()
+        except:
+            print "Cannot read image header " + self.name
+            return False
+        shape = header.get_data_shape()
+        self.shape = tuple(shape[0:3])
+        self.nvols = 1
+        for dim in shape[3:]:
+            self.nvols = self.nvols * dim
+        self.dtype = header.get_data_dtype()
+        self.offset = int(header.get_data_offset())
+        slope, inter = header.get_slope_inter()
+        if slope is not None and (slope != 1 or (inter is not None and inter != 0)):
+            self.slope = slope
+            self.inter = inter or 0.0
+        return True
+
+    def open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path,'rb')
+        return open(self.path,'rb')
+
+    def volumes(self,dtype=np.float64):
+        '''Stream.volumes() yields each volume in order as a 3D array of dtype, reading one volume at a time'''
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        image = self.open()
+        try:
+            # Seeking forward in a gzip file decompresses up to the data, without keeping it
+            image.seek(self.offset)
+            for vol in range(self.nvols):
+                raw = image.read(nbytes)
+                if len(raw) < nbytes:
+                    raise IOError(self.name + " ends after " + str(vol) + " of " + str(self.nvols) + " volumes")
+                volume = np.frombuffer(raw,dtype=self.dtype).reshape(self.shape,order='F').astype(dtype)
+                if self.slope is not None:
+                    volume = volume * self.slope + self.inter
+                yield volume
+        finally:
+            image.close()
 
 
 # Filter------------------------------------------------------------------------------
@@ -512,6 +745,7 @@ class Match:
         self.indexes = []
         self.coordsMNI = []
         self.coordsRCP = []
+        self.coordsMNIArray = None            # coordsMNI as a 3xn array, shared by all components
         self.components = []                  # List of components (MRtools Data objects) to check
 
         # Dictionaries to hold all results for one template across components
@@ -555,6 +789,7 @@ class Match:
             for i in range(0,len(self.indexes[0])):
                 self.coordsMNI.append(self.Data.rcptoMNI([self.indexes[0][i],self.indexes[1][i],self.indexes[2][i]]))
                 self.coordsRCP.append([self.indexes[0][i],self.indexes[1][i],self.indexes[2][i]])
+            self.coordsMNIArray = self.Data.rcptoMNIArray(np.vstack(self.indexes[0:3]))
 
     def doTemplateMatch(self):
         '''doTemplateMatch() performs matching with Match.components, and coordinates Match.coordsMNI, for a specified subject ica directory'''
@@ -795,6 +1030,41 @@ class Match:
             print comname + " absolute activation overlap score: " + str(activation_overlapabs[com.name]) + "\n"
         return activation_overlap,activation_overlapabs
 
+    def stackComps(self,comps):
+        '''stackComps(comps) returns an array with one row per component of values at Match.coordsMNIArray'''
+        '''Coordinates that fall outside of a component are left as NaN, and are not used in scoring'''
+        stack = np.empty((len(comps),self.coordsMNIArray.shape[1]))
+        stack.fill(np.nan)
+        for row,com in enumerate(comps):
+            data = com.getVolume()
+            # Same truncation to an index as a lookup with com.mnitoRCP
+            coordsRCP = com.mnitoRCPArray(self.coordsMNIArray).astype(int)
+            # Coordinates outside of the component, on either side, are not looked up (as in Atlas.sample)
+            inside = np.all((coordsRCP >= 0) & (coordsRCP < np.array(data.shape[0:3]).reshape(3,1)),axis=0)
+            stack[row,inside] = data[coordsRCP[0,inside],coordsRCP[1,inside],coordsRCP[2,inside]]
+        return stack
+
+    def matchOverlapStack(self,names,stack):
+        '''matchOverlapStack(names,stack) performs matchOverlap for all rows of a stackComps array at once'''
+        '''Two dictionaries are returned containing activation overlap scores (and absolute value of the scores) with names as keys'''
+        activation_overlap = {}
+        activation_overlapabs = {}
+
+        values = np.where(np.isnan(stack),0,stack)
+        voxel_in_roi = (values != 0).sum(axis=1)
+        activation_in_roi = values.sum(axis=1)
+        activation_in_roiabs = np.abs(values).sum(axis=1)
+
+        for row,name in enumerate(names):
+            if voxel_in_roi[row] == 0:
+                activation_overlap[name] = 0
+                activation_overlapabs[name] = 0
+            else:
+                activation_overlap[name] = float(activation_in_roi[row] / voxel_in_roi[row])
+                activation_overlapabs[name] = float(activation_in_roiabs[row] / voxel_in_roi[row])
+            print os.path.basename(name.split('.')[0]) + " absolute activation overlap score: " + str(activation_overlapabs[name])
+        return activation_overlap,activation_overlapabs
+
 
 # MAIN ----------------------------------------------------------------------------------
 def main():
@@ -32,6 +32,9 @@ TO RUN SINGLE SUBJECT ICA:
      input.txt is a three column csv file with one row per subject
      each row contains: subjectID,full/path/highres.nii.gz,full/path/functional.nii.gz
      output goes to /my/experiment/ica/sub1.ica, /my/experiment/ica/sub2.ica...
+     add --name=run_name to write the list of ica directories to /my/experiment/list/run_name_ica.txt
+     all subjects are submit as one job array, listed in /my/experiment/list/<date>_ica_tasks.txt,
+     and melodic_array.sh runs the subject for each array index
 
 TO RUN QUALITY ANALYSIS:
    python ica+.py -o /my/experiment --qa=ica_dirs.txt --name=qarun
@@ -53,7 +56,7 @@ TO RUN DUAL REGRESSION:
      group.gica is the group gica directory under /my/experiment/gica/
      design.con and design.mat are created in the FSL GUI with GLM (general linear model)
      500 is the number of iterations to run
-     output goes to /my/experiment/dr/dr_name
+     output goes to /my/experiment/dr/dr_name (an existing dr_name is not overwritten)
 
 TO FIND TOP MATCHES OF DUAL REGRESSION RESULTS TO A TEMPLATE IMAGE:
    python ica+.py -o /my/experiment --match=dr_name --template=template.nii.gz
@@ -74,6 +77,52 @@ TO CREATE AIM TEMPLATES FROM TOP MATCHES
      To use the AIMTemp.py script standalone to create an AIM template
      for one image:  python AIMTemp.py -o /fullpath/here --input=myimage.nii.gz --name=outname
 
+TO RUN A PIPELINE OF STAGES:
+   python ica+.py -o /my/experiment --pipeline=pipeline.ini
+     pipeline.ini has one section per stage, named by run type, with a label after a colon when
+     there is more than one of a kind.  The options of a section are the ica+ options of that run,
+     and a stage runs after the stages making the files or folders it reads, so stages that don't
+     depend on each other (several dual regression designs, several templates) run at once:
+
+       [pipeline]
+       name = study1
+       [ica]
+       ica = input.txt
+       name = cohort                  (ica writes /my/experiment/list/cohort_ica.txt)
+       [qa]
+       qa = /my/experiment/list/cohort_ica.txt
+       name = qa1                     (qa writes /my/experiment/list/qa1_qa.txt)
+       [gica]
+       gica = /my/experiment/list/qa1_qa.txt
+       name = group1                  (gica runs melodic_hp.py filtering at its end)
+       [dr:design1]
+       dr = group1.gica
+       name = dr1
+       con = design1.con
+       mat = design1.mat
+       iter = 500
+       [match:dr1]
+       match = dr1
+       template = template.nii.gz
+
+     Each stage is one job running ica+ for that stage with --wait, submit with a dependency on
+     the stages before it, so it starts as soon as they are done.  Logs go to /my/experiment/pipeline/name/
+     A stage job asks for the run time of the job it waits for (50:30 for gica, 99:30 for dr, match
+     and aim) or --walltime.  With --backend=local, --jobs (default: number of cpus) is shared between
+     the stages that can run at the same time.
+
+JOB OPTIONS (any run type):
+  --backend=...          where jobs run: lsf (bsub, default), slurm (sbatch), local (a pool of processes
+                         on this machine, ica+ waits for them to finish) or dryrun (print the jobs only)
+  --jobs=N               jobs run at once: the size of the local pool (default: number of cpus),
+                         or the %N limit on a job array with lsf or slurm (default: no limit)
+  --mem=MB               memory for every job, instead of each job's default (8192 for gica and dr)
+  --walltime=HH:MM       run time limit for every job, instead of each job's default
+  --queue=...            LSF queue or SLURM partition
+  --wait                 return when the submit jobs have finished, exit with an error if one failed
+
+   python ica+.py -o /my/experiment --ica=input.txt --backend=local --jobs=16
+
 """
 
 __author__ = "Vanessa Sochat (vsochat@stanford.edu)"
@@ -89,22 +138,238 @@ import datetime
 import time
 import getopt
 import subprocess
+import pipes
+import shutil
+import ConfigParser
+import json
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Input headers are read in this process with nibabel if it is installed, otherwise with fslorient and fslval
+try:
+    import nibabel
+    import numpy
+except ImportError:
+    nibabel = None
+
+# Input headers checked before single subject ICA are cached under /experiment/list, and read by this many threads
+HEADERCACHE = "header_cache.json"
+HEADERWORKERS = 16
+
+# Run time limit (HH:MM) of the job each run type submits (no limit: the queue's default), also asked for
+# by the pipeline stage job that waits for it
+WALLTIME = {"ica":None,"qa":None,"gica":"50:30","dr":"99:30","match":"99:30","aim":"99:30"}
 
 class NoSourceError(Exception): pass
 
+#----EXECUTORS-----------------------------------------------------------------------------
+# Every job is submit through an executor, as a name, command (list of arguments), stdout and stderr
+# log files, and the memory (MB) and walltime (HH:MM) it asks for.  mem and walltime given to the
+# executor replace those of every job.  Many jobs of one kind are written to a manifest and submit
+# as one job array, each element running the manifest line for its index with arrayscript.
+# submit returns a handle for the job (LSF job name, SLURM job id), so other jobs can run after it.
+class Executor:
+    def __init__(self,jobs=None,mem=None,walltime=None,queue=None,arrayscript=None,block=False):
+        self.jobs = jobs                 # jobs run at once, where the backend controls it
+        self.mem = mem
+        self.walltime = walltime
+        self.queue = queue
+        self.arrayscript = arrayscript   # melodic_array.sh
+        self.block = block               # submit so that wait() returns when the jobs are done (--wait)
+        self.running = []
+
+    def resources(self,mem,walltime):
+        return self.mem or mem, self.walltime or walltime
+
+    def wait(self):
+        '''waits for jobs submit with block set, returns the number that failed'''
+        if not self.running: return 0
+        print "Waiting for " + str(len(self.running)) + " jobs..."
+        failed = len([job for job in self.running if job.wait() != 0])
+        print str(len(self.running) - failed) + " jobs finished, " + str(failed) + " failed."
+        return failed
+
+# Submits each job with bsub, -K keeps bsub running until the job is done
+class LSFExecutor(Executor):
+    def command(self,name,command,out,err,mem=None,walltime=None,after=None):
+        mem, walltime = self.resources(mem,walltime)
+        bsub = ['bsub','-J',name,'-o',out,'-e',err]
+        if self.queue: bsub = bsub + ['-q',self.queue]
+        if mem: bsub = bsub + ['-R','rusage[mem=' + str(mem) + ']']
+        if walltime: bsub = bsub + ['-W',walltime]
+        if after: bsub = bsub + ['-w'," && ".join(["done(" + job + ")" for job in after])]
+        if self.block: bsub = bsub + ['-K']
+        return bsub + command
+
+    def run(self,bsub):
+        job = subprocess.Popen(bsub)
+        if self.block: self.running.append(job)
+
+    def submit(self,name,command,out,err,mem=None,walltime=None,after=None):
+        self.run(self.command(name,command,out,err,mem,walltime,after))
+        return name
+
+    # Array logs are per index, the tasks themselves log to the files in the manifest
+    def arrayCommand(self,name,manifest,count,logdir,mem=None,walltime=None):
+        throttle = "%" + str(self.jobs) if self.jobs else ""
+        return self.command(name + "[1-" + str(count) + "]" + throttle,[self.arrayscript,manifest],logdir + "/" + name + ".%I.out",logdir + "/" + name + ".%I.err",mem,walltime)
+
+    def submitArray(self,name,manifest,count,logdir,mem=None,walltime=None):
+        self.run(self.arrayCommand(name,manifest,count,logdir,mem,walltime))
+        return name
+
+# Submits each job with sbatch, the command is wrapped in a shell line, --wait keeps sbatch running until the job is done
+class SlurmExecutor(Executor):
+    def command(self,name,command,out,err,mem=None,walltime=None,after=None):
+        mem, walltime = self.resources(mem,walltime)
+        sbatch = ['sbatch','--parsable','-J',name,'-o',out,'-e',err]
+        if self.queue: sbatch = sbatch + ['-p',self.queue]
+        if mem: sbatch = sbatch + ['--mem=' + str(mem)]
+        if walltime: sbatch = sbatch + ['-t',walltime + ':00']
+        if after: sbatch = sbatch + ['--dependency=afterok:' + ":".join(after)]
+        if self.block: sbatch = sbatch + ['--wait']
+        return sbatch + ['--wrap=' + " ".join([pipes.quote(arg) for arg in command])]
+
+    # sbatch prints the job id as soon as the job is submit, also with --wait
+    def run(self,sbatch):
+        job = subprocess.Popen(sbatch,stdout=subprocess.PIPE)
+        jobid = job.stdout.readline().strip().split(";")[0]
+        if self.block:
+            self.running.append(job)
+        else:
+            job.communicate()
+        print "Submitted batch job " + jobid
+        return jobid
+
+    def submit(self,name,command,out,err,mem=None,walltime=None,after=None):
+        return self.run(self.command(name,command,out,err,mem,walltime,after))
+
+    def arrayCommand(self,name,manifest,count,logdir,mem=None,walltime=None):
+        throttle = "%" + str(self.jobs) if self.jobs else ""
+        sbatch = self.command(name,[self.arrayscript,manifest],logdir + "/" + name + ".%a.out",logdir + "/" + name + ".%a.err",mem,walltime)
+        return sbatch[:-1] + ['--array=1-' + str(count) + throttle] + sbatch[-1:]
+
+    def submitArray(self,name,manifest,count,logdir,mem=None,walltime=None):
+        return self.run(self.arrayCommand(name,manifest,count,logdir,mem,walltime))
+
+# A job run on this machine, done is set when it has finished or was not run
+class LocalJob:
+    def __init__(self,name,command,out,err,after=None):
+        self.name = name
+        self.command = command
+        self.out = out
+        self.err = err
+        self.after = after or []         # LocalJobs to run after
+        self.returncode = None
+        self.done = threading.Event()
+
+# Runs each job on this machine, at most jobs at once, logs are appended to as with bsub
+# A job waits for the jobs it runs after, and is not run if one of them failed
+def runLocal(job):
+    try:
+        for previous in job.after:
+            previous.done.wait()
+            if previous.returncode != 0:
+                ferr = open(job.err,'a')
+                ferr.write("Not run, " + previous.name + " failed with exit code " + str(previous.returncode) + "\n")
+                ferr.close()
+                job.returncode = previous.returncode
+                return
+        fout = open(job.out,'a')
+        ferr = open(job.err,'a')
+        try:
+            job.returncode = subprocess.call(job.command,stdout=fout,stderr=ferr)
+        except OSError, e:
+            ferr.write("Cannot run " + job.command[0] + ": " + str(e) + "\n")
+            job.returncode = -1
+        fout.close()
+        ferr.close()
+    finally:
+        if job.returncode is None: job.returncode = -1
+        job.done.set()
+
+# Jobs are queued in the order they are submit, so the jobs one waits for have always been started
+class LocalExecutor(Executor):
+    def __init__(self,jobs=None,mem=None,walltime=None,queue=None,arrayscript=None,block=False):
+        Executor.__init__(self,jobs or multiprocessing.cpu_count(),mem,walltime,queue,arrayscript,block)
+        self.pool = ThreadPool(self.jobs)
+
+    def command(self,name,command,out,err,mem=None,walltime=None,after=None):
+        return command
+
+    def submit(self,name,command,out,err,mem=None,walltime=None,after=None):
+        # Memory and walltime are not enforced on this machine
+        print "Queued " + name + " to run locally, log " + out
+        job = LocalJob(name,command,out,err,after)
+        self.pool.apply_async(runLocal,(job,))
+        self.running.append(job)
+        return job
+
+    # The same manifest is fanned out over the pool, without going through arrayscript
+    def submitArray(self,name,manifest,count,logdir,mem=None,walltime=None):
+        tasks = readManifest(manifest)
+        print "Queued " + str(len(tasks)) + " tasks of " + name + " to run locally, from " + manifest
+        for index,(out,err,command) in enumerate(tasks):
+            job = LocalJob(name + "[" + str(index + 1) + "]",command,out,err)
+            self.pool.apply_async(runLocal,(job,))
+            self.running.append(job)
+
+    def wait(self):
+        if not self.running: return 0
+        print "Waiting for " + str(len(self.running)) + " local jobs, " + str(self.jobs) + " at a time..."
+        self.pool.close()
+        failed = 0
+        for job in self.running:
+            job.done.wait()
+            print "Finished " + job.name + " with exit code " + str(job.returncode)
+            if job.returncode != 0: failed = failed + 1
+        self.pool.join()
+        print str(len(self.running) - failed) + " local jobs finished, " + str(failed) + " failed."
+        return failed
+
+# Prints the bsub line of each job, without running anything
+class DryRunExecutor(LSFExecutor):
+    def submit(self,name,command,out,err,mem=None,walltime=None,after=None):
+        print " ".join([pipes.quote(arg) for arg in self.command(name,command,out,err,mem,walltime,after)])
+        return name
+
+    def submitArray(self,name,manifest,count,logdir,mem=None,walltime=None):
+        print " ".join([pipes.quote(arg) for arg in self.arrayCommand(name,manifest,count,logdir,mem,walltime)])
+        print "  " + str(count) + " tasks listed in " + manifest
+        return name
+
+# Writes tasks (stdout log, stderr log, command) to a manifest, one tab separated line per array index
+def writeManifest(manifest,tasks):
+    mfile = open(manifest,"w")
+    for out,err,command in tasks:
+        mfile.write("\t".join([out,err] + command) + "\n")
+    mfile.close()
+
+def readManifest(manifest):
+    tasks = []
+    mfile = open(manifest,"r")
+    for line in mfile:
+        task = line.rstrip("\n").split("\t")
+        tasks.append((task[0],task[1],task[2:]))
+    mfile.close()
+    return tasks
+
+EXECUTORS = {"lsf":LSFExecutor,"slurm":SlurmExecutor,"local":LocalExecutor,"dryrun":DryRunExecutor}
+
 #----MELODIC-------------------------------------------------------------------------------
 # created as an object to allow for future functionality to perform single and group in same run
 class Melodic:
     def __init__(self):
         self.subs = []
-        self.icas = []                   # Single subject ica directories created
+        self.icas = []                   # Single subject ica directories of the subjects in the input, run now or before
 	self.gica = []			 # Single subject ica directory input
         self.anat = []
 	self.func = []
         self.timepoints = 0
 	self.outdir = None
 
-    def group(self,icadirs,gicaname,outdir,scriptinput,pyexec,filterscript):
+    def group(self,icadirs,gicaname,outdir,scriptinput,pyexec,filterscript,executor):
         self.outdir = outdir
 	
 	# Create an output name based on date / time, if one not specified
@@ -122,11 +387,11 @@ class Melodic:
                     self.gica.append(line)
                 else:
                     print "Cannot find ica directory " + line + ". Exiting."
-                    sys.exit()
+                    sys.exit(1)
             readdata.close
 	except:
             print "Cannot open file " + icadirs + " . Exiting"
-            sys.exit()
+            sys.exit(1)
 	
 	# Create output directories, exit if the run name already exists
 	self.createGPout(outdir + "/gica")
@@ -137,7 +402,7 @@ class Melodic:
 	else:
             print "Run " + gpout + " already exists, and will not be overwritten."
             print "Specify a new name and re-run, or delete old run.  Exiting!"
-            sys.exit()
+            sys.exit(1)
 
 	# Prepare list of input directories into one string
 	# Also print list of data paths to file, for use with dual regression
@@ -148,42 +413,47 @@ class Melodic:
             gica_file.write(gicapath + "/reg_standard/filtered_func_data\n")
         gica_file.close()
 
-        # Submit GICA script
-        scommand = "bsub -J " + gicaname + "_gica -M 8000000 -o " + gpout + "/log/gica.out -e " + gpout + "/log/gica.err -R \"rusage[mem=8192]\" -W 50:30 " + scriptinput + " " + gpout + " " + pyexec + " " + filterscript + " \"" + subinput + "\""
-        # R \"rusage[mem=6144]\"
-        # print scommand
-	subprocess.Popen(['%s' % scommand], shell=True, executable = "/bin/bash")
-        time.sleep(2)	
+        # Submit GICA script, the ica directories go as one argument
+        executor.submit(gicaname + "_gica",[scriptinput,gpout,pyexec,filterscript,subinput],gpout + "/log/gica.out",gpout + "/log/gica.err",8192,WALLTIME["gica"])
 
-    def single(self,anat,func,timepoints,outdir,script):
+    def single(self,anat,func,timepoints,outdir,script,executor,runname=None):
         self.outdir = outdir
         self.anat = anat
         self.func = func
         self.createGPout(outdir + "/ica")
 
+        # Format the date for printing, the run name is used instead if there is one
+        now = datetime.datetime.now()
+        now = runname or now.strftime("%Y-%m-%d_%H_%M")
+
+        tasks = []
         for sub,funcdata in sorted(self.func.items()):
+            ssoutdir = outdir + "/ica/" + str(sub) + ".ica"
             if self.createSSOut(sub):
               self.printSS(sub,self.anat[sub],funcdata)
-              self.runICA(sub,funcdata,self.anat[sub],script,outdir + "/ica/" + str(sub) + ".ica")
-              # Save the full single subject directory path to the icas list
-	      self.icas.append(outdir + "/ica/" + str(sub) + ".ica")
-        
-        # Format the date for printing
-        now = datetime.datetime.now()
-        now = now.strftime("%Y-%m-%d_%H_%M")
+              tasks.append((ssoutdir + "/log/ica.out",ssoutdir + "/log/ica.err",[script,ssoutdir,funcdata,self.anat[sub]]))
+            # Save the full single subject directory path to the icas list, also for subjects run before,
+            # so the list is the same when a run (or a pipeline's ica stage) is repeated
+            self.icas.append(ssoutdir)
+        self.runICA(tasks,now,executor)
+        if not self.icas:
+            return
 
 	# Print the icas list to the list folder, for group melodic input
 	GPfile = open(self.outdir + "/list/" + now + "_ica.txt","w")
-        for eachica in self.icas[:-1]:
-            GPfile.writelines(eachica)
-            GPfile.writelines("\n")
-        GPfile.writelines(self.icas[-1])
+        GPfile.write("\n".join(self.icas))
         GPfile.close()
         
-    def runICA(self,subject,funcinput,anatinput,scriptinput,ssoutdir):
-        # Submit subject ICA script	
-	subprocess.Popen(['bsub','-J',str(subject) + "_ica",'-o',ssoutdir + "/log/ica.out",'-e',ssoutdir + '/log/ica.err',scriptinput,ssoutdir,funcinput, anatinput])
-        time.sleep(2) 
+    def runICA(self,tasks,now,executor):
+        # Submit all subject ICAs as one job array, each element finds its subject in the manifest by index
+        if not tasks:
+            print "No new subjects to run."
+            return
+        manifest = self.outdir + "/list/" + now + "_ica_tasks.txt"
+        writeManifest(manifest,tasks)
+        self.createGPout(self.outdir + "/ica/log")
+        print "Submitting " + str(len(tasks)) + " subject ICAs as one job array..."
+        executor.submitArray(now + "_ica",manifest,len(tasks),self.outdir + "/ica/log")
 
     def createGPout(self,outdir):
 	if not os.path.exists(outdir):
@@ -218,6 +488,7 @@ class Setup:
         self.timepoints = 0
 	    
     def ica(self,scans,outdir):
+        self.outdir = outdir
 	self.readData(scans,outdir)
         self.checkData()
         melodicinput = self.returnData()
@@ -241,57 +512,60 @@ class Setup:
        
 	except:
             print "Cannot open file " + scans + ". Exiting"
-            sys.exit()
+            sys.exit(1)
 
-    def checkData(self):
-        # Check that all files exist for anat, exit if one missing
-	print "Checking for all anatomical raw data..."
-	for k,anatfile in self.anat.items():
-            if not os.path.isfile(anatfile):
-	        print "Cannot find " + anatfile + ". Exiting"
-                sys.exit()
+    def checkData(self,workers=HEADERWORKERS):
+        # All problems are collected and reported together
+        failures = []
 
-        # Check that all files exist for func, exit if one missing
-	print "Checking for all functional raw data..."
-        for k,funcfile in self.func.items():
+        # Check that all files exist for anat and func
+	print "Checking for all anatomical and functional raw data..."
+        for k,anatfile in sorted(self.anat.items()):
+            if not os.path.isfile(anatfile):
+                failures.append("Cannot find anatomical " + anatfile + ".")
+        for k,funcfile in sorted(self.func.items()):
             if not os.path.isfile(funcfile):
-                print "Cannot find " + funcfile + ". Exiting"
-                sys.exit()
+                failures.append("Cannot find functional " + funcfile + ".")
+
+        # Read each header once, on a pool of threads, files unchanged since the last run come from the cache
+        images = sorted(set([i for i in self.anat.values() + self.func.values() if os.path.isfile(i)]))
+        print "Reading headers of " + str(len(images)) + " images..."
+        headers = readHeaders(images,self.outdir + "/list/" + HEADERCACHE,workers)
+        for i in images:
+            if "error" in headers[i]:
+                failures.append("Cannot read header of " + i + ": " + headers[i]["error"])
 
 	# Check that the orientation is LAS for the anatomical data
 	print "Checking for LAS orientation of anatomical data..."
-	for k,i in self.anat.items():
-	    anat_orient = subprocess.Popen(['fslorient','-getorient',i],stdout=subprocess.PIPE)
-            if anat_orient.stdout.read() != "RADIOLOGICAL\n":
-		print "Anatomical " + i + " is not in radiological (LAS) orientation. Exiting."
-		sys.exit(2)
-	
-	# Check that the number of timepoints is equal for all functional runs, and check orientation
-	print "Checking for equal timepoints between functional input..."
-        func_standard = subprocess.Popen(['fslval',self.func.items()[0][1],'dim4'],stdout=subprocess.PIPE)
-	func_standard = func_standard.stdout.read()
-
-	for k,i in self.func.items():
-	    func_check = subprocess.Popen(['fslval',i,'dim4'],stdout=subprocess.PIPE)
-            func_check = func_check.stdout.read()
-	    if func_check != func_standard:
-		print "First subject resting data has " + func_standard + " timepoints"
-                print "Functional " + i + " has " + func_check + " timepoints."
-                print "Timepoints must be equal! Exiting"
-                sys.exit(2)
+	for k,i in sorted(self.anat.items()):
+            if "orient" in headers.get(i,{}) and headers[i]["orient"] != "RADIOLOGICAL":
+                failures.append("Anatomical " + i + " is not in radiological (LAS) orientation.")
+
+	# Check that the number of timepoints and voxel sizes are equal for all functional runs, and check orientation
+	print "Checking for equal timepoints and voxel sizes between functional input, and LAS orientation..."
+        funcheaders = [(i,headers[i]) for k,i in sorted(self.func.items()) if "orient" in headers.get(i,{})]
+        func_standard = None
+        if funcheaders:
+            first, standard = funcheaders[0]
+            func_standard = str(standard["dim4"])
+            for i,header in funcheaders:
+                if header["dim4"] != standard["dim4"]:
+                    failures.append("Functional " + i + " has " + str(header["dim4"]) + " timepoints, " + first + " has " + func_standard + ". Timepoints must be equal!")
+                if header["pixdim"] != standard["pixdim"]:
+                    failures.append("Functional " + i + " has voxel size " + "x".join([str(p) for p in header["pixdim"]]) + ", " + first + " has " + "x".join([str(p) for p in standard["pixdim"]]) + ".")
+                if header["orient"] != "RADIOLOGICAL":
+                    failures.append("Functional " + i + " is not in radiological (LAS) orientation.")
+
+        if failures:
+            for failure in failures:
+                print failure
+            print str(len(failures)) + " problems found with the input data. Exiting"
+            sys.exit(2)
         print "The number of timepoints for all runs is " + func_standard
-	self.timepoints = func_standard      # save this value to print to each ica folder
-
-	print "Checking for LAS orientation of functional data..."		
-	for k,i in self.func.items():
-            func_orient = subprocess.Popen(['fslorient','-getorient',i],stdout=subprocess.PIPE)
-            if func_orient.stdout.read() != "RADIOLOGICAL\n":
-		print "Functional " + i + " is not in radiological (LAS) orientation. Exiting."
-		sys.exit(2)
 
 	# return the number of timepoints
-	self.timepoints = func_standard	
-	
+	self.timepoints = func_standard
+
     def returnData(self):
 	# Make sure the lists are the same length, as a first check
         if len(self.anat) == len(self.func):	
@@ -299,7 +573,94 @@ class Setup:
 	    return (self.anat,self.func,self.timepoints)
         else: 
             print "Error: There are " + str(len(anat)) + " anatomical input and " + str(len(func)) + " functional paths.  Check input file and rerun."
-            sys.exit()
+            sys.exit(1)
+
+# Cache of image headers, by path, checked against the file's modification time and size
+class headerCache:
+    def __init__(self,path):
+        self.path = path                # /experiment/list/header_cache.json
+        self.entries = {}               # image path --> {"mtime","size","orient","dim4","pixdim"}
+        self.changed = False
+        if os.path.isfile(self.path):
+            try:
+                copen = open(self.path,'r')
+                self.entries = json.load(copen)
+                copen.close()
+            except:
+                print "Cannot read header cache " + self.path + ", all headers will be read."
+                self.entries = {}
+
+    def get(self,image):
+        entry = self.entries.get(image)
+        if not entry: return None
+        try:
+            stat = os.stat(image)
+        except OSError:
+            return None
+        if stat.st_mtime != entry["mtime"] or stat.st_size != entry["size"]: return None
+        return entry
+
+    def put(self,image,header):
+        stat = os.stat(image)
+        entry = dict(header)
+        entry["mtime"] = stat.st_mtime
+        entry["size"] = stat.st_size
+        self.entries[image] = entry
+        self.changed = True
+
+    def save(self):
+        if not self.changed: return
+        try:
+            copen = open(self.path + ".tmp",'w')
+            json.dump(self.entries,copen)
+            copen.close()
+            os.rename(self.path + ".tmp",self.path)
+        except:
+            print "Cannot write header cache " + self.path + "."
+
+# Orientation, timepoints and voxel size of an image, as fslorient -getorient and fslval report them
+def readHeader(image):
+    '''returns (image,{"orient","dim4","pixdim"}) or (image,{"error"})'''
+    try:
+        if nibabel:
+            header = nibabel.load(image).header
+            # FSL uses the sform if it is set, then the qform, and takes images with neither (Analyze) as radiological
+            affine = None
+            if header.get("sform_code",0) > 0: affine = header.get_sform()
+            elif header.get("qform_code",0) > 0: affine = header.get_qform()
+            orient = "RADIOLOGICAL" if affine is None or numpy.linalg.det(affine[:3,:3]) < 0 else "NEUROLOGICAL"
+            dim4 = int(header["dim"][4])
+            pixdim = [float(p) for p in header["pixdim"][1:4]]
+        else:
+            orient = subprocess.Popen(['fslorient','-getorient',image],stdout=subprocess.PIPE).communicate()[0].strip()
+            dim4 = int(subprocess.Popen(['fslval',image,'dim4'],stdout=subprocess.PIPE).communicate()[0])
+            pixdim = [float(subprocess.Popen(['fslval',image,'pixdim' + str(d)],stdout=subprocess.PIPE).communicate()[0]) for d in (1,2,3)]
+        # Rounded as fslval prints them, so the same sizes compare equal from either reader or the cache
+        return image, {"orient":orient,"dim4":dim4,"pixdim":[round(p,6) for p in pixdim]}
+    except:
+        return image, {"error":str(sys.exc_info()[1])}
+
+# Headers of all images, read on a pool of threads, images unchanged since they were cached are not read again
+def readHeaders(images,cachefile,workers=HEADERWORKERS):
+    cache = headerCache(cachefile)
+    headers = {}
+    toread = []
+    for image in images:
+        entry = cache.get(image)
+        if entry: headers[image] = entry
+        else: toread.append(image)
+
+    pool = ThreadPool(workers)
+    try:
+        for image,header in pool.imap_unordered(readHeader,toread):
+            headers[image] = header
+            if "error" not in header: cache.put(image,header)
+    finally:
+        pool.close()
+        pool.join()
+    cache.save()
+    print "Read " + str(len(toread)) + " headers, " + str(len(images) - len(toread)) + " unchanged from " + cachefile
+    return headers
 
 #----QUALITY ANALYSIS---------------------------------------------------------------
 class QualityAnalysis:
@@ -315,7 +676,7 @@ class QualityAnalysis:
 	else:
 	    print "Output directory " + outdir + " already created."
 
-    def setup(self,icas,qaname,outdir,scriptinput):
+    def setup(self,icas,qaname,outdir,scriptinput,executor):
         self.qaname = qaname
 
         # Create output QA directory
@@ -332,19 +693,18 @@ class QualityAnalysis:
                 line = line.rstrip("\n").rstrip()
                 if not os.path.isfile(line + "/mc/prefiltered_func_data_mcf.par"):
                     print "Cannot find mc/prefiltered_func_data_mcf.par in " + line + ". Exiting."
-                    sys.exit()
+                    sys.exit(1)
 
         except:
             print "Cannot open " + icas + " for reading.  Exiting"
-            sys.exit()
+            sys.exit(1)
 
         print "Found all mc/prefiltered_func_data_mcf.par files..."
         self.data = icas
         fopen.close
 
         # Submit QA python script to run QA, send same input text file
-        subprocess.Popen(['bsub','-J',self.qaname + "_qa",'-o',self.outdir + "/qa/log/" + self.qaname + ".out",'-e',self.outdir + "/qa/log/" + self.qaname + ".err","python",scriptinput,"-o",self.outdir,"--icas=" + icas,"--rot=2.0","--tran=2.0","--name=" + self.qaname])
-        time.sleep(2) 
+        executor.submit(self.qaname + "_qa",["python",scriptinput,"-o",self.outdir,"--icas=" + icas,"--rot=2.0","--tran=2.0","--name=" + self.qaname],self.outdir + "/qa/log/" + self.qaname + ".out",self.outdir + "/qa/log/" + self.qaname + ".err")
 
 #----DUAL REGRESSION---------------------------------------------------------------
 class DualRegression:
@@ -365,7 +725,7 @@ class DualRegression:
 	    print "Output directory " + outdir + " already created."
 
 
-    def runDR(self,gicadir,drname,outdir,con,mat,iters,scriptinput):
+    def runDR(self,gicadir,drname,outdir,con,mat,iters,scriptinput,executor):
          if os.path.exists(outdir):
              self.outdir = outdir
              self.createGPout(outdir + "/dr")
@@ -376,23 +736,25 @@ class DualRegression:
                      self.createGPout(self.fullout)
                      self.createGPout(self.fullout + "/log")
                  else: 
-                     print outdir + "/dr/" + drname + " already exists"
-                     self.dtOut()
+                     # Stages after this one read dr/drname, so an old run is not replaced by a dated one
+                     print "Run " + outdir + "/dr/" + drname + " already exists, and will not be overwritten."
+                     print "Specify a new name and re-run, or delete old run.  Exiting!"
+                     sys.exit(1)
              else:
                      self.dtOut()
          else: 
              print outdir + "does not exist.  Check path and rerun.  Exiting." 
-             sys.exit()
+             sys.exit(1)
          self.checkGICA(gicadir)
          self.checkDesign(con,mat,iters)
-         self.submitDR(scriptinput)
+         self.submitDR(scriptinput,executor)
 
     def checkGICA(self,gicadir):
         if os.path.isfile(self.outdir + "/gica/" + gicadir + "/groupmelodic.ica/melodic_IC.nii.gz"):
             self.gicadir = self.outdir + "/gica/" + gicadir
         else:
             print "Cannot find" + self.outdir + "/gica/" + gicadir + "/groupmelodic.ica/melodic_IC.nii.gz.  Exiting."
-            sys.exit()
+            sys.exit(1)
 
     def checkDesign(self,con,mat,iters):
         # Check for contrast file
@@ -400,14 +762,14 @@ class DualRegression:
             self.con = os.path.abspath(con)
         else:
             print "Cannot find " + con + ". Make sure it is in the same directory, OR specify full path.  Exiting."
-            sys.exit()  
+            sys.exit(1)  
 
         # Check for design matrix
         if os.path.isfile(mat):
             self.mat = os.path.abspath(mat)
         else:
             print "Cannot find " + mat + ". Make sure it is in the same directory, OR specify full path.  Exiting."
-            sys.exit()
+            sys.exit(1)
 
         # Input iterations
         try:
@@ -425,7 +787,7 @@ class DualRegression:
          self.createGPout(self.fullout)
          self.createGPout(self.fullout + "/log")
 
-    def submitDR(self,scriptinput):
+    def submitDR(self,scriptinput,executor):
         # Get list of files from group run
         gica_filelist = open(self.gicadir + "/.filelist","r")
         sublist = ''
@@ -435,14 +797,13 @@ class DualRegression:
         gica_filelist.close()
 
         # Print group gica directory to log, for later use with match
-        gica_log = open(self.fullout + "/gica_name.txt","w")
+        gica_log = open(self.fullout + "/log/gica_name.txt","w")
         gica_log.write(self.gicadir)
         gica_log.close()
 
         # Submit script for dual regression
-        drcommand = "bsub -J " + self.drname + "_dr -o " + self.fullout + "/log/dr.out -e " + self.fullout + "/log/dr.err -R \"rusage[mem=8192]\" -W 99:30 " + scriptinput + " " + self.gicadir + "/groupmelodic.ica/melodic_IC 1 " + self.mat + " " + self.con + " " + str(self.iter) + " " + self.fullout + "/result " + self.gicadir
-        subprocess.Popen(['%s' % drcommand], shell=True, executable = "/bin/bash")
-        time.sleep(2)
+        drcommand = [scriptinput,self.gicadir + "/groupmelodic.ica/melodic_IC","1",self.mat,self.con,str(self.iters),self.fullout + "/result",self.gicadir]
+        executor.submit(self.drname + "_dr",drcommand,self.fullout + "/log/dr.out",self.fullout + "/log/dr.err",8192,WALLTIME["dr"])
         
 #----MATCH-------------------------------------------------------------------------------
 # do prep to submit pyMatch.py with user specified dual regression results and template image
@@ -456,6 +817,7 @@ class Match:
       self.drimfolder = None          # Dual regression image folder with stage3_corrp* images
       self.tempname = None            # Name of template image
       self.subs = None                # text file for pyMatch with directory name containing contender images, should be dual regression folder
+      self.outdir = outdir
       self.checkMatch(drname)
       self.setupDir(outdir,template)      
       self.setupMatch()
@@ -464,7 +826,7 @@ class Match:
     # Make sure dr_run exists
         if not os.path.exists(self.outdir + "/dr/" + drrun):
             print "Cannot find dual regression run " + drrun + ". Exiting!"
-            sys.exit()         
+            sys.exit(1)         
         else: 
             self.drname = drrun
             self.drimfolder = self.outdir + "/dr/" + self.drname + "/result"
@@ -475,7 +837,7 @@ class Match:
     	    print "Creating output directory " + dirname + "..."
             os.makedirs(dirname)	    	
 	else:
-	    print "Output directory " + outdir + " already created."
+	    print "Output directory " + dirname + " already created."
 
     
     def setupDir(self,outdir,template):
@@ -493,19 +855,19 @@ class Match:
 
             # Check for template, copy to output folder if it exists
             if os.path.isfile(template):
-                if not os.path.isfile(self.fullout + "/" + drname + "-" + os.path.basename(template)):
+                if not os.path.isfile(self.fullout + "/" + self.drname + "-" + os.path.basename(template)):
                     self.tempname = os.path.basename(template)
-                    shutil.copy(template,self.fullout + "/" + drname + "-" + self.tempname )
-                    self.template = self.fullout + "/" + drname + "-" + self.tempname
+                    shutil.copy(template,self.fullout + "/" + self.drname + "-" + self.tempname )
+                    self.template = self.fullout + "/" + self.drname + "-" + self.tempname
                 else:
                     print "Template already been used for this dr_run, please delete old results, or use a different template."
-                    sys.exit()
+                    sys.exit(1)
             else:
                 print "Cannot find " + template + ". Make sure path is correct, and re-run."
-                sys.exit()
+                sys.exit(1)
         else:
             print "Output directory " + self.outdir + " not found! Exiting."
-            sys.exit()
+            sys.exit(1)
 
     def setupMatch(self):
         # Find file of "good" dual regression images from original gica directory
@@ -519,7 +881,7 @@ class Match:
         except:
             print "Cannot find gica_name.txt in " + self.outdir + "/dr/" + self.drname + "/log/.  Make sure this"
             print "text file exists with the full path to the gica directory used for the dual regression, and re-run."
-            sys.exit()
+            sys.exit(1)
         
         # DUAL REGRESSION IMAGES 
         # Read in DR image names from gica_DR-hpfilter-good.txt file in gicadir...
@@ -562,11 +924,11 @@ class Match:
         subfile.close()
         self.subs = self.fullout + "/" + self.tempname + "-subs.txt"
 
-    def runMatch(self,scriptinput,pyexec):
+    def runMatch(self,scriptinput,pyexec,executor):
         
         # Submit script to run Match
-        subprocess.Popen(['bsub','-J',self.drname + "_match",'-o',self.fullout + "/log/" + self.tempname + ".out",'-e',self.fullout + "/log/" + self.tempname + ".err",'-W 99:30',pyexec,scriptinput,"--output=" + self.fullpath,"--subs=" + self.subs,"--template=" + self.template,"--images=" + self.images])
-        time.sleep(2)
+        executor.submit(self.drname + "_match",[pyexec,scriptinput,"--output=" + self.fullout,"--subs=" + self.subs,"--template=" + self.template,"--images=" + self.images],
+                        self.fullout + "/log/" + self.tempname + ".out",self.fullout + "/log/" + self.tempname + ".err",None,WALLTIME["match"])
 
 
 #----AIM-------------------------------------------------------------------------------
@@ -584,6 +946,7 @@ class AIM:
       self.tempname = None            # Name of template image
       self.inputs = {}                # Dictionary of input image paths indexed by image name
       self.scores = {}                # Dictionary of match scores, if we ever need them
+      self.listfile = None            # image,outname list for AIMTemp.py --list
       self.setupDir(outdir,drname)      
      
     def setupDir(self,outdir,drname):
@@ -593,7 +956,7 @@ class AIM:
             self.createDir(outdir + "/aim")
         else:
             print "Cannot find " + outdir + ". Exiting!"
-            sys.exit()
+            sys.exit(1)
 
         # Make sure dr-run exists
         if os.path.exists(outdir + "/dr/" + drname):
@@ -601,7 +964,7 @@ class AIM:
             print "Found dual regression run " + outdir + "/dr/" + drname
         else:
             print "Cannot find dual regression run " + outdir + "/dr/" + drname + ". Exiting!"
-            sys.exit()
+            sys.exit(1)
 
     # Create output folders
     def createDir(self,dirname):
@@ -609,7 +972,7 @@ class AIM:
     	    print "Creating output directory " + dirname + "..."
             os.makedirs(dirname)	    	
 	else:
-	    print "Output directory " + outdir + " already created."
+	    print "Output directory " + dirname + " already created."
 
     # Check if image exists
     def exists(self,imagetocheck,infile):
@@ -618,7 +981,7 @@ class AIM:
             return True
         else:
             print "Cannot find image " + imagetocheck + " in file " + infile + ". Check path.  Exiting!"
-            sys.exit()
+            sys.exit(1)
 
     def DR(self,drinputfile):
         # Read dr_input file - should be single column with full path to template, followed by full paths to each dr image
@@ -635,14 +998,14 @@ class AIM:
                 # The template is a perfect match to itself, so give it a ridiculously high score
                 self.scores[self.tempname + self.drname + '_TEMPLATE'] = 99999
                 # Make output folder to correspond to dual regression name
-                createDir(self.expdir + "/" + self.drname)
-                createDir(self.expdir + "/" + self.drname + "/log")
-                self.fullout = self.expdir + "/" + self.drname
+                self.createDir(self.expdir + "/aim/" + self.drname)
+                self.createDir(self.expdir + "/aim/" + self.drname + "/log")
+                self.fullout = self.expdir + "/aim/" + self.drname
                 
             # Now find the remaining dual regression images
             for line in drinfile:
                 drimres = line.rstrip().split(':')[0]
-                if self.exists(drimres):
+                if self.exists(drimres,drinputfile):
                     # Add to list of input, indexed by image and dr_run name, if we find them
                     self.inputs[self.drname + "-" + os.path.basename(drimres).split('.')[0]] = os.path.abspath(drimres)
                     self.scores[self.drname + "-" + os.path.basename(drimres).split('.')[0]] = line.rstrip().split(':')[1]
@@ -668,15 +1031,136 @@ class AIM:
         except:
             print "Cannot read input file " + icinputfile + ". Exiting!"
 
-    def runAIM(self,scriptinput,pyexec):
-        print "Submitting individual AIM template jobs..."
-        for outname,fullpath in self.images.iteritems():
+    # Write the image,outname list for AIMTemp.py --list
+    def writeList(self):
+        self.listfile = self.fullout + "/" + self.tempname + "-aim.txt"
+        listfile = open(self.listfile,"w")
+        for outname in sorted(self.inputs):
+            listfile.write(self.inputs[outname] + "," + outname + "\n")
+        listfile.close()
+        print "Wrote " + str(len(self.inputs)) + " images to AIM list " + self.listfile
+
+    def runAIM(self,scriptinput,pyexec,executor):
+        # One job creates AIM templates for all images, so the atlas and FMA rdf are only loaded once
+        self.writeList()
+        print "Submitting AIM template job for " + str(len(self.inputs)) + " images..."
+        executor.submit(self.drname + "_aim",[pyexec,scriptinput,"-o",self.fullout,"--list=" + self.listfile],
+                        self.fullout + "/log/" + self.tempname + "_aim.out",self.fullout + "/log/" + self.tempname + "_aim.err",None,WALLTIME["aim"])
+        # Usage: python AIMTemp.py -o /fullpath/here --list=images.txt
+
+#----PIPELINE-------------------------------------------------------------------------------
+# Stages of a pipeline are the sections of an ini file, each run as one job of ica+ with --wait.  A stage
+# runs after the stages that make the files and folders it reads, found from the options of each run.
+STAGES = ("ica","qa","gica","dr","match","aim")
+STAGEOPTIONS = ("ica","qa","gica","dr","match","aim","name","con","mat","iter","template","ics")
+
+class Pipeline:
+    def __init__(self,configfile,outdir):
+        self.outdir = os.path.abspath(outdir)
+        self.name = None
+        self.stages = {}                 # section --> (runtype,[(option,value)])
+        self.sections = []               # sections in the order of the file
+        self.after = {}                  # section --> sections it runs after
+        self.order = []                  # sections, each after those it runs after
+        self.readConfig(configfile)
+        self.findDepends()
+
+    def readConfig(self,configfile):
+        config = ConfigParser.RawConfigParser()
+        try:
+            if not config.read(configfile): raise IOError
+        except (IOError,ConfigParser.Error):
+            print "Cannot read pipeline " + configfile + ". Exiting!"
+            sys.exit(1)
 
-            # Submit script to create AIM templates...
-            print "Submitting job for " + outname + "..."
-            subprocess.Popen(['bsub','-J',outname + "_aim",'-o',self.fullout + "/log/" + outname + ".out",'-e',self.fullout + "/log/" + outname + ".err",'-W 99:30',pyexec,scriptinput,"-o",self.fullpath,"--input=" + fullpath,"--name=" + outname])
-            time.sleep(2)
-            # Usage: python AIMTemp.py -o /fullpath/here --input=myimage.nii.gz --name=outname
+        if config.has_option("pipeline","name"):
+            self.name = config.get("pipeline","name")
+        else:
+            self.name = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M")
+
+        for section in config.sections():
+            if section == "pipeline": continue
+            runtype = section.split(":")[0]
+            options = config.items(section)
+            optiondict = dict(options)
+            if runtype not in STAGES:
+                print "Stage [" + section + "] is not one of " + ", ".join(STAGES) + ". Exiting!"
+                sys.exit(1)
+            if runtype not in optiondict or (runtype != "match" and "name" not in optiondict):
+                print "Stage [" + section + "] needs " + runtype + "=" + ("" if runtype == "match" else " and name=") + ". Exiting!"
+                sys.exit(1)
+            for option,value in options:
+                if option not in STAGEOPTIONS:
+                    print "Option " + option + " in [" + section + "] is not an ica+ option. Exiting!"
+                    sys.exit(1)
+            self.stages[section] = (runtype,options)
+            self.sections.append(section)
+
+    def paths(self,runtype,options):
+        '''returns (reads,makes), files and folders the stage reads that another stage could make, and those it makes'''
+        options = dict(options)
+        out = self.outdir
+        if runtype == "ica": return [os.path.abspath(options["ica"])], [out + "/list/" + options["name"] + "_ica.txt"]
+        if runtype == "qa": return [os.path.abspath(options["qa"])], [out + "/list/" + options["name"] + "_qa.txt"]
+        if runtype == "gica": return [os.path.abspath(options["gica"])], [out + "/gica/" + options["name"] + ".gica"]
+        if runtype == "dr": return [out + "/gica/" + options["dr"]], [out + "/dr/" + options["name"]]
+        if runtype == "match": return [out + "/dr/" + options["match"]], [out + "/match/" + options["match"]]
+        reads = [os.path.abspath(options["aim"]),out + "/dr/" + options["name"]]
+        if "ics" in options: reads.append(os.path.abspath(options["ics"]))
+        return reads, [out + "/aim/" + options["name"]]
+
+    def findDepends(self):
+        paths = dict((section,self.paths(*self.stages[section])) for section in self.sections)
+        for section in self.sections:
+            reads = paths[section][0]
+            self.after[section] = [other for other in self.sections if other != section and
+                                   [read for read in reads for make in paths[other][1] if read == make or read.startswith(make + "/")]]
+
+        # Stages are added once all the stages they run after have been
+        while len(self.order) < len(self.sections):
+            ready = [section for section in self.sections if section not in self.order and not [other for other in self.after[section] if other not in self.order]]
+            if not ready:
+                print "Stages " + ", ".join([section for section in self.sections if section not in self.order]) + " depend on each other. Exiting!"
+                sys.exit(1)
+            self.order.extend(ready)
+
+    def runsAfter(self,section):
+        '''returns the stages section runs after, directly or through other stages'''
+        before = set()
+        todo = list(self.after[section])
+        while todo:
+            other = todo.pop()
+            if other not in before:
+                before.add(other)
+                todo.extend(self.after[other])
+        return before
+
+    def independent(self,section):
+        '''returns the stages that run neither before nor after section, and so can run at the same time'''
+        before = self.runsAfter(section)
+        return [other for other in self.sections if other != section and other not in before and section not in self.runsAfter(other)]
+
+    def submit(self,executor,pyexec,icaplus,backend,passthrough,cpus=None):
+        '''submits one job per stage, running after the jobs of the stages it depends on.  With cpus, each stage
+           runs its jobs on a share of them, so stages running at the same time don't run more than cpus jobs'''
+        logdir = self.outdir + "/pipeline/" + self.name
+        if not os.path.exists(logdir): os.makedirs(logdir)
+        jobs = {}
+        for section in self.order:
+            runtype, options = self.stages[section]
+            # The run type goes first, ica+ takes the first run type option it finds
+            command = [pyexec,icaplus,"-o",self.outdir,"--" + runtype + "=" + dict(options)[runtype]]
+            command = command + ["--" + option + "=" + value for option,value in options if option != runtype]
+            command = command + ["--backend=" + backend,"--wait"] + passthrough
+            # A stage can run next to every stage it is independent of, and gets an equal share at worst
+            if cpus: command = command + ["--jobs=" + str(max(1,cpus / (1 + len(self.independent(section)))))]
+            stagename = section.replace(":","_")
+            if self.after[section]: print "Stage [" + section + "] runs after [" + "], [".join(self.after[section]) + "]"
+            else: print "Stage [" + section + "] can start now"
+            # The stage job waits for the job of its run, so it asks for the same run time
+            jobs[section] = executor.submit(self.name + "_" + stagename,command,logdir + "/" + stagename + ".out",logdir + "/" + stagename + ".err",
+                                            None,WALLTIME[runtype],[jobs[other] for other in self.after[section]])
+        print "Submitted " + str(len(self.order)) + " stages of pipeline " + self.name + ", logs in " + logdir
 
 #-----------------------------------------------------------------------------------
 def usage():
@@ -688,17 +1172,17 @@ def fslcheck():
     dirfsl = subprocess.Popen(['which','fsl'],stdout=subprocess.PIPE)
     if len(dirfsl.stdout.read()) is 0:
         print "Cannot find FSL installation.  Exiting."
-        sys.exit() 
+        sys.exit(1) 
 
 # Finds .sh scripts to run jobs and remembers full path
 def scriptcheck():
     scriptdict = {}
-    for scriptname in ("melodic_ss.sh","melodic_gp.sh","melodic_dr.sh","melodic_qa.py","run_Bandpass.sh","Bandpass","AIMTemp.py","MRtools.py","pyMatch.py","melodic_hp.py"):
+    for scriptname in ("melodic_ss.sh","melodic_gp.sh","melodic_dr.sh","melodic_qa.py","melodic_array.sh","run_Bandpass.sh","Bandpass","AIMTemp.py","MRtools.py","pyMatch.py","melodic_hp.py"):
         if os.path.isfile(scriptname):
 	    scriptdict[scriptname] = os.path.abspath(scriptname)
         else:
             print "Cannot find " + scriptname + ". Make sure it is in the same directory, and re-run."
-            sys.exit()
+            sys.exit(1)
     return scriptdict
 
 # Setup experiment directories
@@ -724,14 +1208,15 @@ def varcheck(vartocheck):
     for varname, desname in vartocheck.items():
         if not varname:
             print "Missing variable " + desname + ".  Please specify and re-run!" 
-            sys.exit()
+            sys.exit(2)
 
 #----------------------------------------------
 # MAIN SCRIPT STARTS RUNNING HERE  
 #----------------------------------------------
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "ho:", ["help","output=","qa=","ica=","gica=","dr=",'name=',"con=","mat=","iter=","match="])
+        opts, args = getopt.getopt(argv, "ho:", ["help","output=","qa=","ica=","gica=","dr=",'name=',"con=","mat=","iter=","match=","aim=","template=","ics=",
+                                                 "backend=","jobs=","mem=","walltime=","queue=","wait","pipeline="])
 
     except getopt.GetoptError:
         usage()
@@ -744,6 +1229,18 @@ def main(argv):
     runname = None
     gicadir = None
     matchdrname = None
+    aimtemp = None
+    con = None
+    mat = None
+    iters = None
+    ics = None
+    backend = "lsf"                # lsf, slurm, local or dryrun
+    jobs = None                    # jobs at once for the local backend, defaults to cpu count
+    mem = None
+    walltime = None
+    queue = None
+    block = False                  # wait for the submit jobs to finish
+    pipeline = None
 
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -768,6 +1265,9 @@ def main(argv):
         if opt in ("--aim") and not runtype:
 	    aim = arg
             runtype = "aim" 
+        if opt == "--pipeline" and not runtype:
+            pipeline = arg
+            runtype = "pipeline"
 
         if opt in ("-o", "--output"):
             outdir = arg        
@@ -783,11 +1283,27 @@ def main(argv):
             iters = arg
         if opt in ("--ics"):
             ics = arg
+        if opt == "--backend":
+            if arg not in EXECUTORS:
+                print "Error: backend " + arg + " is not supported, use one of " + ", ".join(sorted(EXECUTORS)) + ". Exiting!"
+                sys.exit(2)
+            backend = arg
+        if opt == "--jobs":
+            jobs = int(arg)
+        if opt == "--mem":
+            mem = int(arg)
+        if opt == "--walltime":
+            walltime = arg
+        if opt == "--queue":
+            queue = arg
+        if opt == "--wait":
+            block = True
 
     fslcheck()            	  # Check to make sure fsl is installed!
     scriptdict = scriptcheck()	  # look for required scripts
     outdir = setupout(outdir)     # setup output directory
     pyexec = sys.executable       # save path to current python executable, to pass along
+    executor = EXECUTORS[backend](jobs,mem,walltime,queue,scriptdict["melodic_array.sh"],block)
 
     # SINGLE SUBJECT ICA
     if runtype is "ica":
@@ -796,18 +1312,17 @@ def main(argv):
             varcheck({scans:"scan list file (--ica=file.txt)",outdir:"experiment output directory (-o)"})
         except:
             usage()
-            sys.exit()
+            sys.exit(2)
         icaRun = Setup()
         melodicinput = icaRun.ica(scans,outdir)  
         anat = melodicinput[0]
         func = melodicinput[1]
         timepoints = melodicinput[2]
         melRun = Melodic()
-        melRun.single(anat,func,timepoints,outdir,scriptdict["melodic_ss.sh"])
+        melRun.single(anat,func,timepoints,outdir,scriptdict["melodic_ss.sh"],executor,runname)
         print "Done submitting ICA jobs."
         print "Follow output at " + outdir + "/ica/"
         print "When complete, use " + outdir + "/list/*_ica.txt for qa or gica input file."
-        sys.exit()
 
     # GROUP ICA
     elif runtype is "gica":
@@ -815,9 +1330,9 @@ def main(argv):
         try: varcheck({icadirs:"ica directory file (--gica=icadirs.txt)",outdir:"experiment output directory (-o)",runname:"name for run (--name=run_name)"})
         except:
              usage()
-             sys.exit()
+             sys.exit(2)
         melGP = Melodic()
-        melGP.group(icadirs,runname,outdir,scriptdict["melodic_gp.sh"],pyexec,scriptdict["melodic_hp.py"])
+        melGP.group(icadirs,runname,outdir,scriptdict["melodic_gp.sh"],pyexec,scriptdict["melodic_hp.py"],executor)
         print "Done submitting GICA job."
         print "Follow output at " + outdir + "/gica/"
         print "HP Filtering will happen at end, good IC and DR image lists will be under gica/filter"
@@ -827,34 +1342,32 @@ def main(argv):
         try: varcheck({icadirs:"ica directory file (--qa=icadirs.txt)",outdir:"experiment output directory (-o)",runname:"name for qa run (--name=qa_run)"})
         except:
             usage()
-            sys.exit()
+            sys.exit(2)
         qaRun = QualityAnalysis()
-        qaRun.setup(icadirs,runname,outdir,scriptdict["melodic_qa.py"])
+        qaRun.setup(icadirs,runname,outdir,scriptdict["melodic_qa.py"],executor)
         
     # DUAL REGRESSION
     elif runtype is "dr":
         try: varcheck({gicadir:"gica directory (--dr=group.gica)",outdir:"experiment output directory (-o)",con:"design contrasts (--con=design.con",mat:"design matrix (--mat=design.mat)",iters:"iterations (--iter=500)"})
         except:
             usage()
-            sys.exit()
+            sys.exit(2)
         drRun = DualRegression()
-        drRun.runDR(gicadir,runname,outdir,con,mat,iters,scriptdict["melodic_dr.sh"])
+        drRun.runDR(gicadir,runname,outdir,con,mat,iters,scriptdict["melodic_dr.sh"],executor)
         print "Dual Regression job submit."
         print "Output will be in /dr/" + runname
         
     # MATCH
     elif runtype is "match":
-        import shutil
-        import dircache
         try: varcheck({matchdrname:"dual regression results folder to match (--match=dr_name)",outdir:"experiment output directory (-o)",aimtemp:"template image (--template=image.nii.gz"})
         except:
             usage()
-            sys.exit()
+            sys.exit(2)
         print "Preparing Match Object to perform matching..."
         MatchRun = Match(outdir,matchdrname,aimtemp)
-        MatchRun.runMatch(scriptdict["pyMatch.py"],pyexec)
+        MatchRun.runMatch(scriptdict["pyMatch.py"],pyexec,executor)
         print "Match job submit."
-        print "Output will be in /match/" + runname
+        print "Output will be in /match/" + matchdrname
         print "Top three matches (for excel import) in file " + aimtemp + "-beststats.txt"
         print "File (for ica+ --aim= input) is " + aimtemp + "-bestcomps.txt"  
 
@@ -864,19 +1377,36 @@ def main(argv):
         try: varcheck({aim:"*-bestcomps.txt file input under match/drname/ (--aim=template_bestcomps.txt)",outdir:"experiment output directory (-o)",ics:"original filtered network components (--ics=/path/to/match/template-original-ics.txt)",runname:"dual regression run name (--name=dr_run"})
         except:
             usage()
-            sys.exit()
+            sys.exit(2)
         AIMRun = AIM(outdir,runname)             # Setup AIM instance
         if not ics: AIMRun.DR(aim)       # If user didn't specify original IC networks to create AIM instances for 
         else: AIMRun.DRandIC(aim,ics)    # If user specified IC networks
-        AIMRun.runAIM(scriptdict["AIMTemp.py"],pyexec)
+        AIMRun.runAIM(scriptdict["AIMTemp.py"],pyexec,executor)
         print "Finished submitting AIM xml template jobs."
         print "Look for output in " + outdir + "/aim/" + runname
 
+    # PIPELINE
+    elif runtype is "pipeline":
+        Run = Pipeline(pipeline,outdir)
+        # Each stage job waits for the jobs of its stage, with the same job options.  Locally, --jobs (or the
+        # number of cpus) is shared between the stages that run at the same time
+        cpus = None
+        if backend == "local":
+            cpus = jobs or multiprocessing.cpu_count()
+            jobs = None
+        passthrough = [option + "=" + str(value) for option,value in (("--jobs",jobs),("--mem",mem),("--walltime",walltime),("--queue",queue)) if value]
+        executor = EXECUTORS[backend](len(Run.order) if backend == "local" else None,None,walltime,queue,scriptdict["melodic_array.sh"],block)
+        Run.submit(executor,pyexec,os.path.abspath(__file__),"lsf" if backend == "dryrun" else backend,passthrough,cpus)
+
     # USER FAIL
     else: 
         print "Error, you must specify a run type!"
         usage()
-        sys.exit()
+        sys.exit(2)
+
+    # Jobs run by the local backend, or submit with --wait, have to finish before ica+ exits
+    if executor.wait():
+        sys.exit(1)
     
 if __name__ == "__main__":
     main(sys.argv[1:])
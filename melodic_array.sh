@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# This bash script runs one element of a job array submit by ica+.py, the task on line N of a manifest.
+# Each manifest line is tab separated: stdout log, stderr log, then the command and its arguments.
+# N comes from LSF (LSB_JOBINDEX), SLURM (SLURM_ARRAY_TASK_ID), or the second argument when run by hand.
+
+# VARIABLES SET AT RUN TIME
+MANIFEST=$1                                                 # Task manifest written by ica+.py
+INDEX=${2:-${LSB_JOBINDEX:-$SLURM_ARRAY_TASK_ID}}           # Line of the manifest to run, starting at 1
+
+if [ -z "$INDEX" ]; then
+    echo "No array index found in LSB_JOBINDEX or SLURM_ARRAY_TASK_ID. Exiting"
+    exit 32
+fi
+
+TASKLINE=`sed -n "${INDEX}p" $MANIFEST`
+if [ -z "$TASKLINE" ]; then
+    echo "Cannot find task " $INDEX " in " $MANIFEST ". Exiting"
+    exit 32
+fi
+
+# Each task keeps its own logs, as if it had been submit on its own
+IFS=$'\t' read -r -a TASK <<< "$TASKLINE"
+exec >> "${TASK[0]}" 2>> "${TASK[1]}"
+exec "${TASK[@]:2}"
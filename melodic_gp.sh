@@ -10,8 +10,8 @@ COMPS=30        # Number of components for GICA
 # VARIABLES SET AT RUN TIME
 OUTPUT=$1       
 PYEXEC=$2       # Python executable to use to run filtering, will be same used to run ica+.py
-FILTERSCRIPT=$2 # Path to melodic_hp.py, should be in same directory as MRTools.py
-SUBJECTS=( $3 ) # List of all subject ICA directories
+FILTERSCRIPT=$3 # Path to melodic_hp.py, should be in same directory as MRTools.py
+SUBJECTS=( $4 ) # List of all subject ICA directories
 
 # make sure output directory was made by submission script.
 if [ ! -d "$OUTPUT" ]; then
@@ -159,9 +159,10 @@ echo "Performing highpass filtering of output networks..."
 
 mkdir -p $OUTPUT/filter
 
-echo "Command is bsub -J gica_filter -o $OUTPUT/log/filter.out -e $OUTPUT/log/filter.err $PYEXEC $FILTERSCRIPT -o $OUTPUT/filter --name=gica --ts=$OUTPUT/groupmelodic.ica/report --gica=$OUTPUT/groupmelodic.ica/stats "
+echo "Command is $PYEXEC $FILTERSCRIPT -o $OUTPUT/filter --name=gica --ts=$OUTPUT/groupmelodic.ica/report --gica=$OUTPUT/groupmelodic.ica/stats "
 
-# Submit group filter script to produce files with lists of good ICA and (potential future) dual regression results
-bsub -J "gica_filter" -o $OUTPUT/log/filter.out -e $OUTPUT/log/filter.err $PYEXEC $FILTERSCRIPT -o $OUTPUT/filter --name=gica --ts=$OUTPUT/groupmelodic.ica/report --gica=$OUTPUT/groupmelodic.ica/stats
+# Run group filter script in this job to produce files with lists of good ICA and (potential future) dual regression results,
+# so the filter lists exist as soon as the gica job is done, whichever backend ran it
+$PYEXEC $FILTERSCRIPT -o $OUTPUT/filter --name=gica --ts=$OUTPUT/groupmelodic.ica/report --gica=$OUTPUT/groupmelodic.ica/stats >> $OUTPUT/log/filter.out 2>> $OUTPUT/log/filter.err
 
 echo "Results gica_IC-hpfilter-good.txt and gica_DR-hpfilter-good.txt will be in " $OUTPUT"/filter, for use with Match functionality of ica+ package."
@@ -67,12 +67,12 @@ def getImages(gicadir):
                     time.sleep(.2)
         else:
             print "Cannot find gica image directory " + gicadir + ". Exiting!"
-            sys.exit()
+            sys.exit(1)
 
         # If no thresh_zstat images found, exit
         if not zstats: 
             print "Error: no thresh_zstat*.nii.gz images found in " + gicadir + ". Exiting!"
-            sys.exit()
+            sys.exit(1)
 
         return zstats
 
@@ -169,7 +169,7 @@ def main(argv):
                 badlist.append(zstatnum)
         except: 
 	    print "Problem with reading " + img + " with MRtools for Filtering.  Exiting!"
-            sys.exit()    
+            sys.exit(1)    
                
     # PRINT RESULTS
     print "Printing results to " + output
@@ -4,7 +4,21 @@
  
  This python script does a quick quality analysis - it simply reads the mcflirt output and flags
  subjects with rotational or translational motion that exceeds a user set threshold, set below.
- It outputs a *_qa.txt file with a list of subjects ica directories that pass, for gica use.
+ It also computes framewise displacement (FD, Power et al. 2012: sum of absolute volume to volume
+ changes in translation, plus rotation as arc length on a 50mm sphere) and counts volumes with FD
+ over a spike threshold.
+ It outputs a *_qa.txt file with a list of subjects ica directories that pass, for gica use, and
+ a *_motion.txt table of max rotation, max translation, mean FD, max FD and spikes for every subject.
+ The HTML report has inline SVG plots of rotation, translation and FD for each flagged subject,
+ drawn from the motion parameters, so preprocessing doesn't need to plot them.
+ With --signal, it also reads the 4D data of each subject, one volume at a time, for DVARS (root mean
+ square change in signal from the previous volume, as % of the mean signal), global signal spikes
+ (volumes with global signal more than --gsz standard deviations from its mean) and median temporal
+ SNR over the brain mask, written to a *_signal.txt table.
+ Motion summaries are cached in /qa/motion_cache.json under the experiment, by .par path, modification
+ time, size and content hash, so rerunning QA with new benchmarks or new subjects only reads new or
+ changed .par files.  Only the max motion, mean and max FD and the volumes with FD over 0.2 mm are
+ cached: an FD threshold below 0.2 mm reads the .par files again, and so does plotting flagged subjects.
 
 McFlirt output utilized (under sub.ica/mc folder)
   prefiltered_func_data_mcf.par: contains rotation and translation motion parameters estimated by MCFLIRT, one row per volume
@@ -12,6 +26,7 @@ McFlirt output utilized (under sub.ica/mc folder)
   rot_x rot_y rotz tran_x tran_y tran_z
 
 Usage: python melodic_qa.py -o /my/experiment --icas=input.txt --name=subgroup --rot=2.0 --tran=2.0
+       python melodic_qa.py -o /my/experiment --icas=input.txt --name=subgroup --sweep --rot=0.5:3:0.5 --tran=0.5,1,2,3
  
 Options:
   -h, --help             show this help  
@@ -20,13 +35,41 @@ Options:
   --name                 name for qa run (for output file under /my/experiment/qa
   --rot                  rotational motion benchmark (degrees)
   --tran                 translational motion benchmark (mm)
+  --fd                   FD spike threshold (mm, default 0.5), or a grid of thresholds with --sweep
+  --spikes               flag subjects with more than this many FD spikes (default: don't flag on spikes)
+                         with --signal, also more than this many DVARS or global signal spikes
+  --workers              read and summarize motion files across a pool of this many processes
+  --nocache              read every .par file again, and rebuild /qa/motion_cache.json
+
+Signal QA:
+  --signal               4D image under each ica directory to compute DVARS, global signal spikes and tSNR from,
+                         (--signal=reg_standard/filtered_func_data.nii.gz or --signal=prefiltered_func_data_mcf.nii.gz)
+                         mask.nii.gz next to the image is used as the brain mask, otherwise voxels nonzero in the first volume
+  --dvars                DVARS spike threshold (% of mean signal, default 0.5)
+  --gsz                  global signal spike threshold (standard deviations, default 3)
+  --tsnr                 flag subjects with median tSNR below this value (default: don't flag on tSNR)
+
+Threshold sweep:
+  --sweep                count passing subjects for every combination of --rot, --tran (and --spikes and --fd) benchmarks,
+                         given as comma separated values (0.5,1,2) or start:stop:step ranges (0.5:3:0.5, stop included).
+                         --fd thresholds are only swept with --spikes, spikes are counted again at each FD threshold.
+                         Writes /qa/(name)_sweep.txt and a /qa/(name)_sweep.html heatmap of passing subjects
+  --pick                 with --sweep, also write /list/(name)_qa.txt with the subjects passing at one
+                         grid point, given as rot,tran or rot,tran,spikes or rot,tran,spikes,fd (--pick=1.5,2)
+                         fd can be left out when a single --fd threshold is swept
 
 """
 import os
 import sys
 import getopt
-import csv
 import math
+import multiprocessing
+import hashlib
+import json
+import numpy as np
+
+FDRADIUS = 50.0     # mm, head radius used to convert rotations (radians) to displacement for FD
+SPIKEFLOOR = 0.2    # mm, volumes with FD over this are kept in the motion summary, lower FD thresholds read the .par again
 
 # ------------------------------------------------------------------------------------
 class melodic_qa(Exception): pass
@@ -39,7 +82,7 @@ def varcheck(vartocheck):
     for varname, desname in vartocheck.items():
         if not varname:
             print "Missing variable " + desname + ".  Please specify and re-run!" 
-            sys.exit()
+            sys.exit(2)
 
 # Checks again for each data file, in case script run separately from submission python
 def checkData(inputfile):
@@ -51,76 +94,364 @@ def checkData(inputfile):
             data.append(line)
         else: 
             print "Cannot find mc/prefiltered_func_data_mcf.par in " + line + ". Exiting."
-            sys.exit()
+            sys.exit(1)
 
     print "Found all mc/prefiltered_func_data_mcf.par files..."
     fopen.close
     return data
 	    
 
+# Motion parameters for one ica directory, (volumes,6) rot_x rot_y rot_z in radians, tran_x tran_y tran_z in mm
+def readPar(icadir):
+    '''returns (par,sha1) of the mcflirt .par file, raises ValueError if it doesn't have six values per volume'''
+    # The whole file is parsed at once, and must have six values per volume
+    parfile = open(icadir + "/mc/prefiltered_func_data_mcf.par",'rb')
+    pardata = parfile.read()
+    parfile.close()
+    par = np.fromstring(pardata,sep=" ")
+    if par.size == 0 or par.size % 6:
+        raise ValueError("expected six motion parameters per volume, found " + str(par.size) + " values")
+    return par.reshape(-1,6),hashlib.sha1(pardata).hexdigest()
+
+# Framewise displacement per volume from motion parameters, FD of the first volume is 0
+def framewiseDisplacement(par):
+    delta = np.abs(np.diff(par,axis=0))
+    return np.concatenate(([0.0],delta[:,3:6].sum(axis=1) + FDRADIUS * delta[:,0:3].sum(axis=1)))
+
+# FD summary kept instead of the FD of every volume: spikes are [volume,fd] for volumes with FD over floor
+def fdSummary(fd,floor):
+    over = np.nonzero(fd > floor)[0]
+    # Rounded to the 6 decimals of the .par file, to keep the cache small
+    return {"nvols":len(fd),"meanfd":float(fd.mean()),"maxfd":float(fd.max()),"floor":floor,
+            "spikes":[[int(vol),round(float(fd[vol]),6)] for vol in over]}
+
+# Number of volumes with FD over thresh, thresh must not be below the summary floor
+def spikeCount(fdsummary,thresh):
+    return sum(1 for vol, value in fdsummary["spikes"] if value > thresh)
+
+# Motion summary for one ica directory, from its mcflirt parameters (entry is (icadir,floor))
+def motionSummary(entry):
+    '''returns (icadir,maxrot,maxtran,fdsummary,sha1,error), maxrot and maxtran are max absolute x,y,z values, fdsummary
+       is from fdSummary'''
+    icadir, floor = entry
+    try:
+        par, sha1 = readPar(icadir)
+        maxrot = np.abs(par[:,0:3]).max(axis=0)
+        maxtran = np.abs(par[:,3:6]).max(axis=0)
+        return icadir,maxrot,maxtran,fdSummary(framewiseDisplacement(par),floor),sha1,None
+    except:
+        return icadir,None,None,None,None,str(sys.exc_info()[1])
+
+# Summarize motion for all ica directories in input order, in this process or across a pool.
+# Only directories without a current entry in cache are read, and cache is updated with them.
+# Spikes are kept for FD over floor, the lowest FD threshold the summaries will be used with
+def motionSummaries(inputdata,workers,cache,floor=SPIKEFLOOR):
+    summaries = {}
+    todo = []
+    for icadir in inputdata:
+        cached = cache.get(icadir,floor)
+        if cached: summaries[icadir] = cached
+        else: todo.append((icadir,floor))
+    print "Motion summaries for " + str(len(summaries)) + " subjects found in " + cache.path + ", reading " + str(len(todo)) + "..."
+
+    if workers > 1 and len(todo) > 1:
+        print "Reading motion parameters with " + str(workers) + " workers..."
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(motionSummary,todo,max(1,len(todo) / (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [motionSummary(entry) for entry in todo]
+
+    for summary in results:
+        summaries[summary[0]] = summary
+        if not summary[5]: cache.put(summary)
+    return [summaries[icadir] for icadir in inputdata]
+
+# ------------------------------------------------------------------------------------
+# Experiment level cache of motion summaries, indexed by ica directory
+class motionCache:
+    def __init__(self,path,use=True):
+        self.path = path                # /experiment/qa/motion_cache.json
+        self.entries = {}               # ica directory --> {"mtime","size","sha1","maxrot","maxtran","fdsummary"}
+        self.changed = False
+        if use: self.read()
+
+    def read(self):
+        if os.path.isfile(self.path):
+            try:
+                copen = open(self.path,'r')
+                self.entries = json.load(copen)
+                copen.close()
+            except:
+                print "Cannot read motion cache " + self.path + ", all .par files will be read."
+                self.entries = {}
+
+    def get(self,icadir,floor=SPIKEFLOOR):
+        '''returns cached summary (icadir,maxrot,maxtran,fdsummary,sha1,None) if the .par file is unchanged and its spikes
+           go down to floor, otherwise None'''
+        entry = self.entries.get(icadir)
+        if not entry: return None
+        if "fdsummary" in entry and entry["fdsummary"]["floor"] > floor: return None
+        parpath = icadir + "/mc/prefiltered_func_data_mcf.par"
+        try:
+            stat = os.stat(parpath)
+        except OSError:
+            return None
+        # A touched or copied file with the same content is still current, only its hash has to be checked
+        if stat.st_size != entry["size"]: return None
+        if stat.st_mtime != entry["mtime"]:
+            parfile = open(parpath,'rb')
+            sha1 = hashlib.sha1(parfile.read()).hexdigest()
+            parfile.close()
+            if sha1 != entry["sha1"]: return None
+            entry["mtime"] = stat.st_mtime
+            self.changed = True
+        # Older entries keep the FD of every volume, they are summarized and rewritten in the new form
+        if "fdsummary" not in entry:
+            entry["fdsummary"] = fdSummary(np.array(entry.pop("fd")),floor)
+            self.changed = True
+        return icadir,np.array(entry["maxrot"]),np.array(entry["maxtran"]),entry["fdsummary"],entry["sha1"],None
+
+    def put(self,summary):
+        icadir,maxrot,maxtran,fdsummary,sha1,error = summary
+        stat = os.stat(icadir + "/mc/prefiltered_func_data_mcf.par")
+        self.entries[icadir] = {"mtime":stat.st_mtime,"size":stat.st_size,"sha1":sha1,
+                                "maxrot":maxrot.tolist(),"maxtran":maxtran.tolist(),"fdsummary":fdsummary}
+        self.changed = True
+
+    def save(self):
+        if not self.changed: return
+        try:
+            # Written to a temporary file first, so an interrupted run doesn't leave a broken cache
+            copen = open(self.path + ".tmp",'w')
+            json.dump(self.entries,copen)
+            copen.close()
+            os.rename(self.path + ".tmp",self.path)
+        except:
+            print "Cannot write motion cache " + self.path + "."
+
+# Signal summary for one ica directory, streamed from its 4D image (signal is the path under the ica directory)
+def signalSummary(entry):
+    '''returns (icadir,summary,error), summary has per volume global signal "gs" and "dvars", and median "tsnr"'''
+    icadir, signal = entry
+    try:
+        # Only needed (with its scitools and nibabel dependencies) for --signal
+        import MRtools
+        imagepath = os.path.join(icadir,signal)
+        Stream = MRtools.Stream(imagepath)
+        if not Stream.go:
+            raise IOError("Cannot stream " + imagepath)
+        maskpath = os.path.join(os.path.dirname(imagepath),"mask.nii.gz")
+        mask = None
+        if os.path.isfile(maskpath):
+            mask = np.asarray(MRtools.Data(maskpath,'3D',xyz=False).getVolume()) > 0
+
+        # Only the previous volume and running mean and sum of squared deviations (Welford) are kept per voxel
+        gs = np.zeros(Stream.nvols)
+        dvars = np.zeros(Stream.nvols)
+        for vol, volume in enumerate(Stream.volumes()):
+            if mask is None:
+                mask = volume != 0
+            values = volume[mask]
+            if vol == 0:
+                mean = np.zeros(len(values))
+                m2 = np.zeros(len(values))
+            else:
+                dvars[vol] = np.sqrt(np.mean((values - previous) ** 2))
+            gs[vol] = values.mean()
+            delta = values - mean
+            mean += delta / (vol + 1)
+            m2 += delta * (values - mean)
+            previous = values
+
+        std = np.sqrt(m2 / max(Stream.nvols - 1,1))
+        nonzero = std > 0
+        tsnr = float(np.median(mean[nonzero] / std[nonzero])) if nonzero.any() else 0.0
+        return icadir,{"gs":gs,"dvars":dvars,"tsnr":tsnr},None
+    except:
+        return icadir,None,str(sys.exc_info()[1])
+
+# Stream signal summaries for all ica directories in input order, in this process or across a pool
+def signalData(inputdata,signal,dvarsthresh=0.5,gsz=3.0,workers=1):
+    entries = [(icadir,signal) for icadir in inputdata]
+    if workers > 1 and len(entries) > 1:
+        print "Streaming " + signal + " with " + str(workers) + " workers..."
+        pool = multiprocessing.Pool(workers)
+        try:
+            # One subject per task, subjects are large and take about the same time
+            results = pool.map(signalSummary,entries,1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [signalSummary(entry) for entry in entries]
+
+    signals = {}
+    for icadir,summary,error in results:
+        if error:
+            print "Cannot compute signal QA for " + icadir + ": " + error
+            continue
+        gs = summary["gs"]
+        # DVARS as % of the mean global signal, global signal spikes as z scores
+        dvarspct = summary["dvars"] * 100 / gs.mean()
+        gsstd = gs.std()
+        if gsstd > 0: gszscores = np.abs(gs - gs.mean()) / gsstd
+        else: gszscores = np.zeros(len(gs))
+        signals[icadir] = {"nvols":len(gs),"tsnr":summary["tsnr"],"meandvars":dvarspct[1:].mean() if len(gs) > 1 else 0.0,
+                           "maxdvars":dvarspct.max(),"dvarsspikes":int((dvarspct > float(dvarsthresh)).sum()),
+                           "gsspikes":int((gszscores > float(gsz)).sum())}
+    return signals
+
+# Move subjects with more than maxspikes DVARS or global signal spikes, median tSNR below mintsnr (or without signal QA)
+# from passing to flagged, as readData does for motion
+def signalCheck(qa_output,signals,mintsnr=None,maxspikes=None):
+    passing = []
+    for icadir in qa_output["passing"]:
+        if icadir not in signals:
+            flagSubject(icadir,"signal","unreadable",qa_output["flags"])
+            qa_output["flagged"].append(icadir)
+        elif maxspikes is not None and signals[icadir]["dvarsspikes"] > int(maxspikes):
+            flagSubject(icadir,"dvars","spikes",qa_output["flags"])
+            qa_output["flagged"].append(icadir)
+        elif maxspikes is not None and signals[icadir]["gsspikes"] > int(maxspikes):
+            flagSubject(icadir,"gs","spikes",qa_output["flags"])
+            qa_output["flagged"].append(icadir)
+        elif mintsnr is not None and signals[icadir]["tsnr"] < float(mintsnr):
+            flagSubject(icadir,"signal","tsnr",qa_output["flags"])
+            qa_output["flagged"].append(icadir)
+        else:
+            passing.append(icadir)
+    qa_output["passing"] = passing
+
 # Read each file, compare against benchmark
-def readData(inputdata,rotation,translation,outdir,qa_name):
+def readData(inputdata,rotation,translation,outdir,qa_name,fdthresh=0.5,maxspikes=None,workers=1,usecache=True):
     passing = []
     flagged = []
+    flags = []      # lines for the .flag file, written once all subjects are checked
+    motion = {}
 
     # Convert degrees to radians
     pi = math.pi
     radians = pi * float(rotation) / 180
     print rotation + " degrees has been converted to " + str(radians) + " radians."	
 
-    # Read from input file and compare motion parameters to benchmarks    
-    for icadir in inputdata:
-	rot = {"x":[],"y":[],"z":[]}
-	tran = {"x":[],"y":[],"z":[]}
-	f = open(icadir + "/mc/prefiltered_func_data_mcf.par", 'rb')
-	reader = csv.reader(f, delimiter='\t')
-        
-        # Read all data from file into arrays, converting to float
-        for row in reader:
-            rot_x,rot_y,rot_z,tran_x,tran_y,tran_z = row[0].split()
-            rot_x = float(rot_x)
-            rot_y = float(rot_y)
-            rot_z = float(rot_z)
-            tran_x = float(tran_x)
-            tran_y = float(tran_y)
-            tran_z = float(tran_z)
-            rot["x"].append(rot_x)
-            rot["y"].append(rot_y)
-            rot["z"].append(rot_z)
-            tran["x"].append(tran_x)
-            tran["y"].append(tran_y)
-            tran["z"].append(tran_z)
-	
-        # Close the file     
-        f.close()
-    
+    # Read from input file (or motion cache) and compare motion parameters to benchmarks    
+    cache = motionCache(outdir + "/qa/motion_cache.json",usecache)
+    summaries = motionSummaries(inputdata,workers,cache,min(SPIKEFLOOR,float(fdthresh)))
+    cache.save()
+    for icadir,maxrot,maxtran,fdsummary,sha1,error in summaries:
+        if error:
+            print "Cannot read motion parameters for " + icadir + ": " + error
+            flagSubject(icadir,"motion","unreadable",flags)
+            flagged.append(icadir)
+            continue
+
+        spikes = spikeCount(fdsummary,float(fdthresh))
+        motion[icadir] = {"rot":maxrot * 180 / pi,"tran":maxtran,"meanfd":fdsummary["meanfd"],"maxfd":fdsummary["maxfd"],"spikes":spikes}
+
         # Rotation: go through x,y,z, flag subject if greater than bench, add to passing list otherwise
-	if flagCheck(rot,icadir,"rotation",radians,outdir,qa_name) and flagCheck(tran,icadir,"translation",translation,outdir,qa_name):
-            passing.append(icadir)
+        if flagCheck(maxrot,icadir,"rotation",radians,flags) and flagCheck(maxtran,icadir,"translation",translation,flags):
+            if maxspikes is not None and spikes > int(maxspikes):
+                flagSubject(icadir,"fd","spikes",flags)
+                flagged.append(icadir)
+            else:
+                passing.append(icadir)
         else:
             flagged.append(icadir)               
 
     # Combine flagged and passing list into a dictionary to return
-    qa_output = {"passing":passing,"flagged":flagged}
+    qa_output = {"passing":passing,"flagged":flagged,"motion":motion,"flags":flags,"fdthresh":float(fdthresh)}
 	
     # Return list of passing ica directories, to be printed to file    
     return qa_output
 
-# Flagcheck takes a dictionary of lists, returns False if a value exceeds benchmark
-def flagCheck(timeseries,icadir,descriptor,benchmark,outdir,qa_name):
-    for direction,valuelist in timeseries.items():
-        for value in valuelist: 
-            if abs(value) > float(benchmark): 
-                flagSubject(icadir,descriptor,direction,outdir,qa_name)
-                return False
+# Flagcheck takes max absolute x,y,z values, returns False if a value exceeds benchmark
+def flagCheck(maxvalues,icadir,descriptor,benchmark,flags):
+    over = np.nonzero(maxvalues > float(benchmark))[0]
+    if len(over):
+        flagSubject(icadir,descriptor,"xyz"[over[0]],flags)
+        return False
     return True
 
+# ------------------------------------------------------------------------------------
+# Parse a sweep grid, comma separated values or a start:stop:step range (stop included)
+def parseGrid(grid,cast=float):
+    if ":" in grid:
+        start,stop,step = [float(value) for value in grid.split(":")]
+        values = np.arange(start,stop + step / 2.0,step)
+        return [cast(round(value,6)) for value in values]
+    return [cast(value) for value in grid.split(",")]
+
+# Count passing subjects for every (rotation,translation,FD threshold,spikes) benchmark at once
+def sweepData(inputdata,rotations,translations,spikelist,fdlist=[0.5],workers=1,usecache=True,outdir=None):
+    '''returns (counts,passing), counts[r,t,f,s] is the number of subjects passing rotations[r],translations[t] with at most
+       spikelist[s] volumes over FD fdlist[f], passing is the boolean (rotation,translation,fd,spikes,subject) array it is counted from'''
+    cache = motionCache(outdir + "/qa/motion_cache.json",usecache)
+    summaries = motionSummaries(inputdata,workers,cache,min([SPIKEFLOOR] + list(fdlist)))
+    cache.save()
+
+    # Largest rotation (radians) and translation over x,y,z, and spike count, for each subject.
+    # Subjects whose .par file can't be read never pass
+    readable = np.array([summary[5] is None for summary in summaries],dtype=bool)
+    maxrot = np.array([summary[1].max() if summary[5] is None else np.inf for summary in summaries])
+    maxtran = np.array([summary[2].max() if summary[5] is None else np.inf for summary in summaries])
+    # Spike counts at each FD threshold, (fd,subject)
+    spikes = np.array([[spikeCount(summary[3],thresh) if summary[5] is None else 0 for summary in summaries]
+                       for thresh in fdlist],dtype=int).reshape(len(fdlist),len(summaries))
+    for summary in summaries:
+        if summary[5]: print "Cannot read motion parameters for " + summary[0] + ": " + summary[5]
+
+    # Same comparisons as flagCheck, a subject passes when no value exceeds the benchmark
+    radians = math.pi * np.array(rotations,dtype=float) / 180
+    rotok = maxrot[np.newaxis,:] <= radians[:,np.newaxis]
+    tranok = maxtran[np.newaxis,:] <= np.array(translations,dtype=float)[:,np.newaxis]
+    if spikelist:
+        spikeok = spikes[:,np.newaxis,:] <= np.array(spikelist)[np.newaxis,:,np.newaxis]
+    else:
+        spikeok = np.tile(readable,(len(fdlist),1,1))
+    passing = rotok[:,np.newaxis,np.newaxis,np.newaxis,:] & tranok[np.newaxis,:,np.newaxis,np.newaxis,:] & spikeok[np.newaxis,np.newaxis,:,:,:]
+    return passing.sum(axis=4),passing
+
+# Print the sweep as one rotation x translation table of passing subjects per FD threshold and spikes benchmark
+def printSweep(output,qa_name,counts,rotations,translations,spikelist,fdlist,total):
+    sweepfile = open(output + "/qa/" + qa_name + "_sweep.txt","w")
+    sweephtml = open(output + "/qa/" + qa_name + "_sweep.html","w")
+    sweephtml.write("<html>\n<body>\n<h1>ica+ Motion Threshold Sweep</h1>\n")
+    sweephtml.write("<p><strong>Experiment</strong>: " + output + "</p>\n")
+    sweephtml.write("<p><strong>QA Report Name</strong>: " + qa_name + "</p>\n")
+    sweephtml.write("<p><strong>Total Subjects</strong>: " + str(total) + "</p>\n")
+    for f, s in [(f,s) for f in range(counts.shape[2]) for s in range(counts.shape[3])]:
+        if spikelist:
+            title = "Passing subjects, at most " + str(spikelist[s]) + " FD spikes over " + str(fdlist[f]) + " mm"
+        else:
+            title = "Passing subjects"
+        sweepfile.write("# " + title + ", rotation benchmark (deg) by translation benchmark (mm)\n")
+        sweepfile.write("rot\\tran\t" + "\t".join([str(tran) for tran in translations]) + "\n")
+        sweephtml.write("<h2>" + title + "</h2>\n<table border=\"1\" cellpadding=\"4\">\n")
+        sweephtml.write("<tr><th>rot (deg) \\ tran (mm)</th>" + "".join(["<th>" + str(tran) + "</th>" for tran in translations]) + "</tr>\n")
+        for r in range(len(rotations)):
+            sweepfile.write(str(rotations[r]) + "\t" + "\t".join([str(count) for count in counts[r,:,f,s]]) + "\n")
+            sweephtml.write("<tr><th>" + str(rotations[r]) + "</th>")
+            for count in counts[r,:,f,s]:
+                # Lighter green for fewer passing subjects
+                shade = int(255 - 155 * count / max(total,1))
+                sweephtml.write("<td style=\"background-color:rgb(%d,255,%d)\">%d</td>" % (shade,shade,count))
+            sweephtml.write("</tr>\n")
+        sweepfile.write("\n")
+        sweephtml.write("</table>\n")
+    sweephtml.write("</body>\n</html>")
+    sweephtml.close()
+    sweepfile.close()
+
 # Prepare the output file
 def setupOutfile(output,qa_name):
-    if os.path.isfile(output + "/qa/" + qa_name + ".flag") or os.path.isfile(output + "/qa/" + qa_name + ".html") or os.path.isfile(output + "/list/" + qa_name + "_qa.txt"):
+    if os.path.isfile(output + "/qa/" + qa_name + ".flag") or os.path.isfile(output + "/qa/" + qa_name + ".html") or os.path.isfile(output + "/list/" + qa_name + "_qa.txt") or os.path.isfile(output + "/qa/" + qa_name + "_motion.txt"):
          print "QA output files with name " + qa_name + " already exist under " + output
          print "Delete old files or choose a different name. Exiting."
-         sys.exit()
+         sys.exit(1)
     else:    
         print "Creating new flagged subjects file..."
         flagfile = open(output + "/qa/" + qa_name + ".flag",'w').close()
@@ -136,7 +467,7 @@ def setupout(outdir):
     if not os.path.exists(outdir):
         print "Cannot find experiment directory " + outdir
         print "Check name and rerun! Exiting."
-        sys.exit()
+        sys.exit(1)
     else:
         if os.path.exists(outdir + "/qa"):
             print "QA output directory already exists."
@@ -145,67 +476,176 @@ def setupout(outdir):
             os.makedirs(outdir + "/qa")
     return outdir
 
-# Print flagged subject
-def flagSubject(icadir,flagtype,flagdirection,output,qa_name):
-    flagfile = open(output + "/qa/" + qa_name + ".flag",'a')
-    flagfile.writelines(flagtype + " " + flagdirection + ": " + icadir + "\n")
+# Add flagged subject to the list of flags
+def flagSubject(icadir,flagtype,flagdirection,flags):
+    flags.append(flagtype + " " + flagdirection + ": " + icadir + "\n")
+
+# Print all flagged subjects at once
+def printFlags(output,qa_name,flags):
+    flagfile = open(output + "/qa/" + qa_name + ".flag",'w')
+    flagfile.write("".join(flags))
     flagfile.close()
 
+# Inline SVG line plot of the columns of values (volumes x lines), in the style of fsl_tsplot
+def svgPlot(values,title,labels,width=640,height=144,hline=None):
+    colors = ("#d62728","#2ca02c","#1f77b4")
+    margin = 24
+    values = np.asarray(values,dtype=float).reshape(len(values),-1)
+    low = min(values.min(),0.0)
+    high = max(values.max(),hline or 0.0)
+    if high == low: high = low + 1.0
+
+    # Scale all lines to the plot area at once
+    nvols = max(len(values) - 1,1)
+    xs = margin + np.arange(len(values)) * float(width - 2 * margin) / nvols
+    ys = height - margin - (values - low) * float(height - 2 * margin) / (high - low)
+
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' % (width,height),
+           '<rect width="%d" height="%d" fill="white" stroke="#999999"/>' % (width,height),
+           '<text x="%d" y="14" font-size="12">%s</text>' % (margin,title),
+           '<text x="2" y="%d" font-size="9">%.3g</text>' % (margin,high),
+           '<text x="2" y="%d" font-size="9">%.3g</text>' % (height - margin,low)]
+    if hline is not None:
+        y = height - margin - (hline - low) * float(height - 2 * margin) / (high - low)
+        svg.append('<line x1="%d" x2="%d" y1="%.1f" y2="%.1f" stroke="#999999" stroke-dasharray="4,2"/>' % (margin,width - margin,y,y))
+    for line in range(values.shape[1]):
+        points = " ".join(["%.1f,%.1f" % point for point in zip(xs,ys[:,line])])
+        svg.append('<polyline fill="none" stroke="%s" points="%s"/>' % (colors[line % len(colors)],points))
+        svg.append('<text x="%d" y="14" font-size="11" fill="%s">%s</text>' % (width - margin - 40 * (values.shape[1] - line),colors[line % len(colors)],labels[line]))
+    svg.append('</svg>')
+    return "".join(svg)
+
 # Print HTML report with motion charts for flagged subjects
 def printReport(qa_output,output,qa_name,RM,TM):
     if not os.path.isfile(output + "/qa/" + qa_name + ".html"):
         print "Creating flagged subjects HTML report..."
-        flagreport = open(output + "/qa/" + qa_name + ".html",'w')
-        flagreport.write("<html>\n<body>\n<h1>ica+ Motion Report</h1>\n")
-        flagreport.write("<p><strong>Experiment</strong>: " + output + "</p>\n")
-	flagreport.write("<p><strong>QA Report Name</strong>: " + qa_name + "</p>\n")
-        flagreport.write("<p><strong>Total Subjects</strong>: " + str(len(qa_output["passing"])+len(qa_output["flagged"])) + "</p>\n")
-	flagreport.write("<p><strong>Flagged Subjects</strong>: " + str(len(qa_output["flagged"])) + "</p>\n")
-	flagreport.write("<p><strong>Passing Subjects</strong>: " + str(len(qa_output["passing"])) + "</p>\n")
-	flagreport.write("<p><strong>Rotational Motion Benchmark (deg)</strong>: " + str(RM) + "</p>\n")
-	flagreport.write("<p><strong>Translational Motion Benchmark (mm)</strong>: " + str(TM) + "</p>\n")
-	
-	# Open flagged subject summary file, print to page
-	if len(qa_output["flagged"]) > 0:
-            flagreport.write("<h1>Flagged Subject Summary</h1>\n<p>")
-	    flagfile = open(output + "/qa/" + qa_name + ".flag",'r')
-	    for line in flagfile:
-	        flagreport.write(line + "<br /><br />")
-	    flagfile.close		
-	    flagreport.write("</p>\n")
-
-
-	    # Cycle through list of flagged ica directories, print name and links to motion images:
-	    flagreport.write("<h1>Flagged Subjects</h1>\n<p>")
-	    for flagged in qa_output["flagged"]:
-   	        icadir_name = os.path.basename(flagged)
-                flagreport.write("<p>" + icadir_name + "</p>\n")
-                flagreport.write("<img src=\"../ica/" + icadir_name + "/mc/rot.png\" />\"\n")
-                flagreport.write("<img src=\"../ica/" + icadir_name + "/mc/trans.png\" />\"\n")
-                flagreport.write("<img src=\"../ica/" + icadir_name + "/mc/disp.png\" />\"\n")
-  
-	# Print list of passing subjects
+        # The whole report is built in memory and written at once
+        report = ["<html>\n<body>\n<h1>ica+ Motion Report</h1>\n"]
+        report.append("<p><strong>Experiment</strong>: " + output + "</p>\n")
+        report.append("<p><strong>QA Report Name</strong>: " + qa_name + "</p>\n")
+        report.append("<p><strong>Total Subjects</strong>: " + str(len(qa_output["passing"])+len(qa_output["flagged"])) + "</p>\n")
+        report.append("<p><strong>Flagged Subjects</strong>: " + str(len(qa_output["flagged"])) + "</p>\n")
+        report.append("<p><strong>Passing Subjects</strong>: " + str(len(qa_output["passing"])) + "</p>\n")
+        report.append("<p><strong>Rotational Motion Benchmark (deg)</strong>: " + str(RM) + "</p>\n")
+        report.append("<p><strong>Translational Motion Benchmark (mm)</strong>: " + str(TM) + "</p>\n")
+        report.append("<p><strong>FD Spike Threshold (mm)</strong>: " + str(qa_output["fdthresh"]) + "</p>\n")
+
+        # Flagged subject summary, same lines as the .flag file
+        if len(qa_output["flagged"]) > 0:
+            report.append("<h1>Flagged Subject Summary</h1>\n<p>")
+            for line in qa_output["flags"]:
+                report.append(line + "<br /><br />")
+            report.append("</p>\n")
+
+            # Cycle through list of flagged ica directories, print name and motion plots
+            report.append("<h1>Flagged Subjects</h1>\n<p>")
+            for flagged in qa_output["flagged"]:
+                icadir_name = os.path.basename(flagged)
+                report.append("<p>" + icadir_name + "</p>\n")
+                if flagged in qa_output["motion"]:
+                    summary = qa_output["motion"][flagged]
+                    report.append("<p>Mean FD: %.3f mm, Max FD: %.3f mm, FD spikes: %d</p>\n" % (summary["meanfd"],summary["maxfd"],summary["spikes"]))
+                if flagged in qa_output.get("signal",{}):
+                    signal = qa_output["signal"][flagged]
+                    report.append("<p>tSNR: %.1f, Mean DVARS: %.3f %%, DVARS spikes: %d, Global signal spikes: %d</p>\n" % (signal["tsnr"],signal["meandvars"],signal["dvarsspikes"],signal["gsspikes"]))
+                if flagged in qa_output["motion"]:
+                    # Only the summary is cached, the .par file is read again for the subjects that are plotted
+                    try:
+                        par, sha1 = readPar(flagged)
+                    except:
+                        report.append("<p>Cannot read motion parameters for plots: " + str(sys.exc_info()[1]) + "</p>\n")
+                        continue
+                    report.append(svgPlot(par[:,0:3],"MCFLIRT estimated rotations (radians)",("x","y","z")) + "<br />\n")
+                    report.append(svgPlot(par[:,3:6],"MCFLIRT estimated translations (mm)",("x","y","z")) + "<br />\n")
+                    report.append(svgPlot(framewiseDisplacement(par),"Framewise displacement (mm)",("FD",),hline=qa_output["fdthresh"]) + "<br />\n")
+
+        # Print list of passing subjects
         if len(qa_output["passing"]) > 0: 
-	    flagreport.write("<h1>Passing Subjects</h1>\n<p>")
-	    for passing in qa_output["passing"]:
-   	        flagreport.write(passing + "<br /><br />\n")
-	
+            report.append("<h1>Passing Subjects</h1>\n<p>")
+            for passing in qa_output["passing"]:
+                report.append(passing + "<br /><br />\n")
 
-        flagreport.write("</body>\n</html>")
+        report.append("</body>\n</html>")
+        flagreport = open(output + "/qa/" + qa_name + ".html",'w')
+        flagreport.write("".join(report))
         flagreport.close()
 
+# Print motion summary table for all subjects that could be read, in input order
+def printMotion(output,qa_name,inputdata,motion):
+    motionfile = open(output + "/qa/" + qa_name + "_motion.txt","w")
+    motionfile.write("icadir\trot_x\trot_y\trot_z\ttran_x\ttran_y\ttran_z\tmean_fd\tmax_fd\tspikes\n")
+    for icadir in inputdata:
+        if icadir in motion:
+            summary = motion[icadir]
+            values = list(summary["rot"]) + list(summary["tran"]) + [summary["meanfd"],summary["maxfd"]]
+            motionfile.write(icadir + "\t" + "\t".join(["%.4f" % value for value in values]) + "\t" + str(summary["spikes"]) + "\n")
+    motionfile.close()
+
+# Print signal QA table for all subjects it could be computed for, in input order
+def printSignal(output,qa_name,inputdata,signals):
+    signalfile = open(output + "/qa/" + qa_name + "_signal.txt","w")
+    signalfile.write("icadir\tvolumes\ttsnr\tmean_dvars\tmax_dvars\tdvars_spikes\tgs_spikes\n")
+    for icadir in inputdata:
+        if icadir in signals:
+            summary = signals[icadir]
+            signalfile.write(icadir + "\t" + str(summary["nvols"]) + "\t%.2f\t%.4f\t%.4f\t" % (summary["tsnr"],summary["meandvars"],summary["maxdvars"]) +
+                             str(summary["dvarsspikes"]) + "\t" + str(summary["gsspikes"]) + "\n")
+    signalfile.close()
+
 # Print passing subjects to file
 def printPassing(output,qa_name,passingData):
     PASSfile = open(output + "/list/" + qa_name + "_qa.txt","w")
-    for eachica in passingData[:-1]:
-        PASSfile.writelines(eachica)
-        PASSfile.writelines("\n")
-    PASSfile.writelines(passingData[-1])
+    PASSfile.write("\n".join(passingData))
     PASSfile.close()
 
+# Sweep mode: count passing subjects over a grid of benchmarks, optionally write the passing list for one point
+def sweepQA(outdir,runname,icas,RM,TM,FD,spikes,workers,usecache,pick):
+    if os.path.isfile(outdir + "/qa/" + runname + "_sweep.txt") or (pick and os.path.isfile(outdir + "/list/" + runname + "_qa.txt")):
+        print "QA sweep output files with name " + runname + " already exist under " + outdir
+        print "Delete old files or choose a different name. Exiting."
+        sys.exit(1)
+    rotations = parseGrid(RM)
+    translations = parseGrid(TM)
+    spikelist = []
+    if spikes: spikelist = parseGrid(spikes,int)
+    fdlist = parseGrid(str(FD))
+    # Without a spikes benchmark, FD thresholds don't change who passes
+    if not spikelist and len(fdlist) > 1:
+        print "FD thresholds are only swept with --spikes, using --fd=" + str(fdlist[0]) + "."
+        fdlist = fdlist[0:1]
+
+    # The chosen point is added to the grid if it isn't on it, so it comes from the same pass
+    if pick:
+        point = pick.split(",")
+        if spikelist and len(point) == 3 and len(fdlist) == 1:
+            point.append(str(fdlist[0]))
+        if len(point) < 2 or (len(point) == 4) != bool(spikelist):
+            print "--pick needs rot,tran" + (",spikes,fd" if spikelist else "") + ". Exiting."
+            sys.exit(2)
+        if float(point[0]) not in rotations: rotations.append(float(point[0]))
+        if float(point[1]) not in translations: translations.append(float(point[1]))
+        if spikelist and int(point[2]) not in spikelist: spikelist.append(int(point[2]))
+        if spikelist and float(point[3]) not in fdlist: fdlist.append(float(point[3]))
+        rotations.sort(); translations.sort(); spikelist.sort(); fdlist.sort()
+
+    data = checkData(icas)           # make sure files exist in all ica directories
+    counts,passing = sweepData(data,rotations,translations,spikelist,fdlist,workers,usecache,outdir)
+    printSweep(outdir,runname,counts,rotations,translations,spikelist,fdlist,len(data))
+    print "See /qa/" + runname + "_sweep.txt and /qa/" + runname + "_sweep.html for passing subjects at each benchmark."
+
+    if pick:
+        f, s = 0, 0
+        if spikelist: f, s = fdlist.index(float(point[3])), spikelist.index(int(point[2]))
+        chosen = passing[rotations.index(float(point[0])),translations.index(float(point[1])),f,s]
+        passingData = [data[i] for i in np.nonzero(chosen)[0]]
+        print str(len(passingData)) + " of " + str(len(data)) + " subjects pass at " + pick
+        if passingData:
+            printPassing(outdir,runname,passingData)
+            print "Use /list/" + runname + "_qa.txt for gica input file."
+
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "o:", ["output=","icas=","name=","rot=","tran="])
+        opts, args = getopt.getopt(argv, "o:", ["output=","icas=","name=","rot=","tran=","fd=","spikes=","workers=","nocache","sweep","pick=","signal=","dvars=","gsz=","tsnr="])
 
     except getopt.GetoptError:
         usage()
@@ -213,8 +653,19 @@ def main(argv):
     
     # First cycle through the arguments to collect user variables
     subs = []
+    icas = None
     outdir = None
-    name = None
+    runname = None
+    FD = 0.5    # framewise displacement spike threshold (mm)
+    spikes = None
+    workers = 1
+    usecache = True
+    sweep = False
+    pick = None
+    signal = None   # 4D image under each ica directory for signal QA
+    DVARS = 0.5     # DVARS spike threshold (% of mean signal)
+    GSZ = 3.0       # global signal spike threshold (standard deviations)
+    mintsnr = None
     TM = None	# translational motion benchmark (mm)
     RM = None   # rotational motion benchmark (degrees)
 
@@ -232,17 +683,48 @@ def main(argv):
 	    TM = arg
         if opt in ("--name"):
             runname = arg
+        if opt == "--fd":
+            FD = arg
+        if opt == "--spikes":
+            spikes = arg
+        if opt == "--workers":
+            workers = int(arg)
+        if opt == "--nocache":
+            usecache = False
+        if opt == "--sweep":
+            sweep = True
+        if opt == "--pick":
+            pick = arg
+        if opt == "--signal":
+            signal = arg
+        if opt == "--dvars":
+            DVARS = float(arg)
+        if opt == "--gsz":
+            GSZ = float(arg)
+        if opt == "--tsnr":
+            mintsnr = float(arg)
 
     varcheck({icas:"input icas (--icas=dirs.txt)",outdir:"experiment output directory (-o)",RM:"rotation benchmark, degrees (--rot=2.0)",TM:"translation benchmark, mm (--tran=2.0)",runname:"name for qa run (--name=run_name)"})
     outdir = setupout(outdir)        # setup output directory
+    if sweep:
+        sweepQA(outdir,runname,icas,RM,TM,FD,spikes,workers,usecache,pick)
+        sys.exit()
     setupOutfile(outdir,runname)     # ready output files
     data = checkData(icas)           # make sure files exist in all ica directories
-    qa_output = readData(data,RM,TM,outdir,runname) # Read each file, compare against benchmarks
+    qa_output = readData(data,RM,TM,outdir,runname,FD,spikes,workers,usecache) # Read each file, compare against benchmarks
+    if signal:
+        qa_output["signal"] = signalData(data,signal,DVARS,GSZ,workers) # Stream 4D data for DVARS, global signal and tSNR
+        printSignal(outdir,runname,data,qa_output["signal"])
+        if mintsnr is not None or spikes is not None: signalCheck(qa_output,qa_output["signal"],mintsnr,spikes)
+    printFlags(outdir,runname,qa_output["flags"])        # print all flagged subjects
     printPassing(outdir,runname,qa_output["passing"])   # print passing subject IDs to ica list output file
+    printMotion(outdir,runname,data,qa_output["motion"])  # print motion summary for every subject
     printReport(qa_output,outdir,runname,RM,TM) # print HTML page with motion charts for flags  
     print "Done checking QA."
     print "See /qa/" + runname + ".html for flagged subject overview."
     print "See /qa/" + runname + ".flag for flagged subject list."
+    print "See /qa/" + runname + "_motion.txt for max motion and framewise displacement of every subject."
+    if signal: print "See /qa/" + runname + "_signal.txt for tSNR, DVARS and global signal spikes of every subject."
     print "Use /list/" + runname + "_qa.txt for gica input file."
     sys.exit()
 
@@ -74,15 +74,6 @@ mcflirt -in prefiltered_func_data -out prefiltered_func_data_mcf -mats -plots -r
 mkdir -pv mc
 mv -f prefiltered_func_data_mcf.mat prefiltered_func_data_mcf.par prefiltered_func_data_mcf_abs.rms prefiltered_func_data_mcf_abs_mean.rms prefiltered_func_data_mcf_rel.rms prefiltered_func_data_mcf_rel_mean.rms mc
 
-# Plot the Mcflirt rotational data
-fsl_tsplot -i mc/prefiltered_func_data_mcf.par -t 'MCFLIRT estimated rotations (radians)' -u 1 --start=1 --finish=3 -a x,y,z -w 640 -h 144 -o mc/rot.png
-
-# Plot the Mcflirt translational data
-fsl_tsplot -i mc/prefiltered_func_data_mcf.par -t 'MCFLIRT estimated translations (mm)' -u 1 --start=4 --finish=6 -a x,y,z -w 640 -h 144 -o mc/trans.png 
-
-# Plot the Mcflirt mean displacement data
-fsl_tsplot -i mc/prefiltered_func_data_mcf_abs.rms,mc/prefiltered_func_data_mcf_rel.rms -t 'MCFLIRT estimated mean displacement (mm)' -u 1 -w 640 -h 144 -a absolute,relative -o mc/disp.png 
-
 # take the motion corrected functional data and calculate the mean across time - mean_func
 fslmaths prefiltered_func_data_mcf -Tmean mean_func
 
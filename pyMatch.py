@@ -18,6 +18,17 @@ INPUT:
 -t --template=  The template image to match, such as a group network
 -i --images =   Single column text file with a list of component images in folders
 -o --output=    Name of output folder.  If not specified, will use pwd
+-b --batch      Score all subjects in one process: component images are stacked and scored
+                against the template index at once, and loaded images are shared across subjects
+   --cache=     Number of loaded component images to keep in memory with --batch (default 64)
+   --workers=   Score subjects across a pool of N processes (implies --batch).  Results are
+                written in the same order as the subject list
+
+With --batch or --workers, each scored subject is checkpointed to (template_name)_journal.txt
+in the output folder, keyed by subject path and the size and modification time of the template
+and component images.  Rerunning the same command skips subjects already scored with unchanged
+inputs.  Subjects with a missing or unreadable image are recorded as failed instead of ending
+the run, and are retried on the next run.
 
 If you input a list of subjects longer than one, keep in mind that each should have the
 corresponding component images in the designated folder.  Whether 3D or 4D, the first
@@ -26,11 +37,14 @@ empty, the script will try the second.  If the second is also empty, it will exi
 error, because there is something wrong with your template or image!
 
 USAGE: python pyMatch.py --subs=sublist.txt --template=/path/to/image.nii.gz --images=imagelist.txt --output=/path/for/outfile
+       python pyMatch.py --batch --cache=256 --subs=sublist.txt --template=/path/to/image.nii.gz --images=imagelist.txt
+       python pyMatch.py --workers=16 --subs=sublist.txt --template=/path/to/image.nii.gz --images=imagelist.txt
 
 Intended usage is for one template for 1+ subjects/groups with a list of component images.  
 Currently only supports matching 3D images (if 4D input, first timepoint will be used)
 
 OUTPUT: (template_name)_bestcomps.txt and (template_name)_beststats.txt w/ top 3 components for each subject/group
+        (template_name)_journal.txt with per-subject checkpoints, for --batch and --workers
 
 """
 
@@ -45,6 +59,10 @@ import MRtools # includes classes Data, Filter, and Match
 import operator
 import getopt
 import re
+import collections
+import multiprocessing
+import hashlib
+import json
 
 
 # RESULT------------------------------------------------------------------------------
@@ -76,9 +94,10 @@ class pyMatchRes:
 	    fopen = open(self.fullpath,'w')
 	    fopen.write("ID Match1 Score1 Match2 Score2 Match3 Score3\n")
             fopen.close()
+            open(self.imagepath,'w').close()
 	except:
             print "Cannot write file " + self.fullpath + ". Exiting"
-            sys.exit()
+            sys.exit(1)
         
     def addResult(self,result):
 	try:
@@ -89,7 +108,7 @@ class pyMatchRes:
             fopen.close()
 	except:
             print "Cannot write file " + self.fullpath + ". Exiting"
-            sys.exit()
+            sys.exit(1)
 
     # Prints a single column test file, template image at top, in format /full/image/path:match_score
     def addImages(self,imagelist):
@@ -99,6 +118,97 @@ class pyMatchRes:
         iopen.close()
 	
 
+# JOURNAL-----------------------------------------------------------------------------
+class pyMatchJournal:
+    '''Per-subject checkpoints for a match run, one json entry per line, the last entry for a subject wins'''
+    def __init__(self,output,filename):
+        base,ext = os.path.splitext(os.path.basename(filename))
+        self.fullpath = output + "/" + base + "_journal.txt"
+        self.entries = {}         # Latest entry for each subject path
+        self.read()
+
+    def read(self):
+        if not os.path.isfile(self.fullpath):
+            return
+        print "Reading checkpoints from " + self.fullpath
+        jopen = open(self.fullpath,'r')
+        for line in jopen:
+            try:
+                entry = json.loads(line)
+                self.entries[entry["subject"]] = entry
+            except ValueError:
+                # A run killed mid-write can leave a partial last line
+                continue
+        jopen.close()
+
+    def inputKey(self,template,subject,imgfiles):
+        '''returns a hash of the template and component image paths, sizes and modification times'''
+        key = hashlib.sha1()
+        for imgpath in [template] + [subject + "/" + img for img in imgfiles]:
+            key.update(os.path.abspath(imgpath))
+            try:
+                stat = os.stat(imgpath)
+                key.update(":" + str(stat.st_size) + ":" + str(stat.st_mtime))
+            except OSError:
+                key.update(":missing")
+        return key.hexdigest()
+
+    def scored(self,subject,key):
+        '''returns absolute overlap scores if subject has been scored with the same inputs, otherwise None'''
+        entry = self.entries.get(subject)
+        if entry and entry["key"] == key and entry["status"] == "scored":
+            return entry["scores"]
+        return None
+
+    def record(self,subject,key,scores,error=None):
+        entry = {"subject":subject,"key":key}
+        if scores is None:
+            entry["status"] = "failed"
+            entry["error"] = error
+        else:
+            entry["status"] = "scored"
+            entry["scores"] = scores
+        self.entries[subject] = entry
+        try:
+            jopen = open(self.fullpath,'a')
+            jopen.write(json.dumps(entry) + "\n")
+            jopen.close()
+        except:
+            print "Cannot write file " + self.fullpath + ". Exiting"
+            sys.exit(1)
+
+    def failed(self,subjects):
+        return [subject for subject in subjects if subject in self.entries and self.entries[subject]["status"] == "failed"]
+
+
+# CACHE-------------------------------------------------------------------------------
+class pyMatchCache:
+    '''Least recently used cache of component images (MRtools Data objects), shared across subjects'''
+    def __init__(self,size):
+        self.size = size                            # maximum number of images to keep loaded
+        self.images = collections.OrderedDict()     # images indexed by path, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,imgpath):
+        if imgpath in self.images:
+            self.hits = self.hits + 1
+            image = self.images.pop(imgpath)
+        else:
+            self.misses = self.misses + 1
+            image = MRtools.Data(imgpath,'3D',xyz=False)
+            if not image.go:
+                raise IOError("Cannot read " + imgpath)
+        # Most recently used images go to the end, so the oldest are dropped first
+        self.images[imgpath] = image
+        while len(self.images) > self.size:
+            self.images.popitem(last=False)
+        return image
+
+    def __repr__(self):
+        return "<pyMatchCache " + str(len(self.images)) + "/" + str(self.size) + " hits:" + str(self.hits) + " misses:" + str(self.misses) + ">"
+
+
 # USAGE ---------------------------------------------------------------------------------
 def usage():
     print __doc__
@@ -114,7 +224,7 @@ def readInput(readfile):
         rfile.close()
     except:
         print "Cannot open file " + readfile + ". Exiting"
-        sys.exit()
+        sys.exit(1)
     flist
     return flist
 
@@ -126,20 +236,96 @@ def checkInput(subinput,compinput):
            for comp in compinput:
                if not os.path.isfile(sub + "/" + comp):
                    print "Cannot find " + comp + " for " + sub + ". Exiting!"
-                   sys.exit()
+                   sys.exit(1)
    print "All components for all subjects have been found!  Continuing analysis..." 
+
+# Score all component images for one subject against the template index, for --batch
+def scoreSubject(Match,subject,imgfiles,cache):
+    comps = []
+    for img in imgfiles:
+        comps.append(cache.get(subject + "/" + img))
+    stack = Match.stackComps(comps)
+    return Match.matchOverlapStack([com.name for com in comps],stack)
+
+# WORKERS -------------------------------------------------------------------------------
+# The template Match object and image list are published here once, before the pool is created,
+# so forked workers share the template mask and index arrays instead of receiving a copy per subject
+workerMatch = None
+workerImages = None
+workerCache = None
+
+def initWorker(cachesize):
+    global workerCache
+    workerCache = pyMatchCache(cachesize)
+
+def scoreWorker(subject):
+    try:
+        return subject,scoreSubject(workerMatch,subject,workerImages,workerCache),None
+    except:
+        return subject,None,str(sys.exc_info()[1])
+
+# Score subjects in this process, yielding (subject,scores,error) in subject list order
+def scoreSerial(Match,subjects,imgfiles,cachesize):
+    global workerMatch,workerImages
+    workerMatch = Match
+    workerImages = imgfiles
+    initWorker(cachesize)
+    for subject in subjects:
+        print "Computing similarity scores for images in directory " + subject
+        yield scoreWorker(subject)
+
+# Score subjects across a process pool, yielding (subject,scores,error) in subject list order
+def scorePool(Match,subjects,imgfiles,cachesize,workers):
+    global workerMatch,workerImages
+    workerMatch = Match
+    workerImages = imgfiles
+    pool = multiprocessing.Pool(workers,initWorker,(cachesize,))
+    try:
+        for result in pool.imap(scoreWorker,subjects,max(1,len(subjects) / (workers * 4))):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+# Write the top three matches for one subject to the results files
+def writeTop(Result,Template,subject,activation_overlapabs):
+    # We rank with activation_overlapabs, which is looking at absolute activation values (negative and positive Z ranked equally)
+    ranked = sorted(activation_overlapabs.iteritems(), key=operator.itemgetter(1))
+    topmatch = list(ranked[-1])
+    secondmatch = list(ranked[-2])
+    thirdmatch = list(ranked[-3])
+
+    # Print information about the top three to the final results log
+    # VANESSA - IT MIGHT MAKE SENSE TO PRINT ALL RESULTS, AND THEN USE NUMERICAL FILTER WHEN WE SELECT TO GENERATE AIM TEMPLATES FOR...
+    resultitem = [subject,os.path.basename(topmatch[0]),topmatch[1],os.path.basename(secondmatch[0]),secondmatch[1],os.path.basename(thirdmatch[0]),thirdmatch[1]]
+    Result.addResult(resultitem)
+
+    # Add full paths to images to bestcomps.txt file, to create AIM templates for
+    Result.addImages([str(topmatch[0]) + ":" + str(topmatch[1]),str(secondmatch[0]) + ":" + str(secondmatch[1]),str(thirdmatch[0]) + ":" + str(thirdmatch[1])])
+
+    print "Top matches for " + Template.name + " are:"
+    print "    1) " + str(os.path.basename(topmatch[0]))
+    print "    2) " + str(os.path.basename(secondmatch[0]))
+    print "    3) " + str(os.path.basename(thirdmatch[0])) + "\n"
+
+    print "Full results printed to: " + Result.getFullPath()
+    print "Image list printed to: " + Result.getImPath()
     
 
 # MAIN ----------------------------------------------------------------------------------
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "ht:s:i:o:", ["help","template=","subs=","images=","output="])
+        opts, args = getopt.getopt(argv, "ht:s:i:o:b", ["help","template=","subs=","images=","output=","batch","cache=","workers="])
 
     except getopt.GetoptError:
         usage()
         sys.exit(2)
     
     # First cycle through the arguments to collect user variables
+    output = None
+    batch = False
+    cachesize = 64
+    workers = 1
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             usage()
@@ -152,13 +338,21 @@ def main(argv):
             sublist = arg
         if opt in ("-o","--output"):
             output = arg
+        if opt in ("-b","--batch"):
+            batch = True
+        if opt == "--cache":
+            cachesize = int(arg)
+        if opt == "--workers":
+            workers = int(arg)
+            batch = True
 
     # Get list of subject and component paths
     subfile = readInput(sublist)
     imgfiles = readInput(input2)
 
-    # Check that all components exist for each subject
-    checkInput(subfile,imgfiles)
+    # Check that all components exist for each subject (batch runs record missing images as failures)
+    if not batch:
+        checkInput(subfile,imgfiles)
         
     # Read in template image to MRtools Data object, and get xyz and raw data
     Template = MRtools.Data(input1,'3D')
@@ -184,6 +378,53 @@ def main(argv):
                     
     # Note that "subject" might also be a group .gica folder, or a dual regression results folder, however the idea is the same  
     # This script assumes that input image lists have already been filtered, etc.
+
+    # BATCH: the template index is shared, and component images are stacked and scored together
+    if batch:
+        Journal = pyMatchJournal(output,Template.name)
+        # Each directory is scored and written once, so repeats in the list don't take another directory's scores
+        subjects = []
+        for sub in subfile:
+            if sub and sub not in subjects:
+                subjects.append(sub)
+        if len(subjects) < len([sub for sub in subfile if sub]):
+            print "Directories listed more than once in " + sublist + " are scored once."
+        keys = dict([(sub,Journal.inputKey(input1,sub,imgfiles)) for sub in subjects])
+        todo = [sub for sub in subjects if Journal.scored(sub,keys[sub]) is None]
+        print str(len(subjects) - len(todo)) + " of " + str(len(subjects)) + " directories already scored, " + str(len(todo)) + " to score..."
+
+        if workers > 1:
+            print "Computing similarity scores with " + str(workers) + " workers..."
+            results = scorePool(Match,todo,imgfiles,cachesize,workers)
+        else:
+            results = scoreSerial(Match,todo,imgfiles,cachesize)
+
+        # Results are written in subject list order, from the journal or as they are scored
+        for subject in subjects:
+            activation_overlapabs = Journal.scored(subject,keys[subject])
+            if activation_overlapabs is None:
+                scored,scores,error = results.next()
+                if scored != subject:
+                    print "Error: scores for " + scored + " returned in place of " + subject + ". Exiting!"
+                    sys.exit(1)
+                if scores is None:
+                    print "Problem with images for output " + subject + ": " + error + ". Recorded as failed."
+                    Journal.record(subject,keys[subject],None,error)
+                    continue
+                activation_overlapabs = scores[1]
+                Journal.record(subject,keys[subject],activation_overlapabs)
+            writeTop(Result,Template,subject,activation_overlapabs)
+
+        # Only known in this process, workers each keep their own cache
+        if workerCache is not None:
+            print "Component image cache: " + str(workerCache)
+
+        failed = Journal.failed(subjects)
+        if failed:
+            print str(len(failed)) + " directories failed and are not in the results, rerun to retry:"
+            for subject in failed:
+                print "    " + subject
+        return
  
     for subject in subfile:
         if subject:
@@ -204,7 +445,7 @@ def main(argv):
                     Match.addComp(Contender)
                 except:
                     print "Problem with " + img + " for output " + subject + ". Exiting!"
-		    sys.exit()    
+		    sys.exit(1)    
                     
             # DO TEMPLATE MATCHING
             # Get dictionaries of activation overlap scores, and activation overlap absolute value scores
@@ -213,27 +454,7 @@ def main(argv):
 
             # CHOOSE TOP RESULTS ----------------------------------------------------------------------------------	
             # When we finish cycling through the components, we want to find the top three matching (the most similar) components
-	    # We rank with activation_overlapabs, which is looking at absolute activation values (negative and positive Z ranked equally)
-			
-	    topmatch = list(sorted(activation_overlapabs.iteritems(), key=operator.itemgetter(1))[-1])
-	    secondmatch = list(sorted(activation_overlapabs.iteritems(), key=operator.itemgetter(1))[-2])
-	    thirdmatch = list(sorted(activation_overlapabs.iteritems(), key=operator.itemgetter(1))[-3])
-
-	    # Print information about the top three to the final results log
-            # VANESSA - IT MIGHT MAKE SENSE TO PRINT ALL RESULTS, AND THEN USE NUMERICAL FILTER WHEN WE SELECT TO GENERATE AIM TEMPLATES FOR...
-	    resultitem = [subject,os.path.basename(topmatch[0]),topmatch[1],os.path.basename(secondmatch[0]),secondmatch[1],os.path.basename(thirdmatch[0]),thirdmatch[1]]	
-	    Result.addResult(resultitem)
-
-            # Add full paths to images to bestcomps.txt file, to create AIM templates for
-            Result.addImages([str(topmatch[0]) + ":" + str(topmatch[1]),str(secondmatch[0]) + ":" + str(secondmatch[1]),str(thirdmatch[0]) + ":" + str(thirdmatch[1])])
-
-            print "Top matches for " + Template.name + " are:"
-            print "    1) " + str(os.path.basename(topmatch[0]))
-            print "    2) " + str(os.path.basename(secondmatch[0]))
-            print "    3) " + str(os.path.basename(thirdmatch[0])) + "\n"
-
-            print "Full results printed to: " + Result.getFullPath()
-            print "Image list printed to: " + Result.getImPath()
+            writeTop(Result,Template,subject,activation_overlapabs)
 
             # Clear the Match object to prepare for the next subject or group, if applicable
             Match.reset()